@@ -0,0 +1,260 @@
+import asyncio
+import socket
+import threading
+import time
+
+from EventLog import log
+from ExchangeProtocol import ExchangeProtocol
+from ExchangeResponse import ExchangeResponse
+from ExchangeService import ExchangeService
+from LatencyStats import LatencyStats
+from WireCodec import BinaryCodec, WireCodec
+
+
+class SessionOutbox:
+    """ Bounded queue of the frames to send on one session, written by its own task, so that a session that does not
+    read only holds up itself. Responses release the window slot of their request once written, which keeps a session
+    reading its requests at the pace it reads its responses. A session whose queue fills up with pushed reports has
+    fallen too far behind and is disconnected.
+    """
+    def __init__(self, codec, writer, size):
+        self.codec = codec # Codec of the session
+        self.writer = writer
+        self.size = size # Most frames waiting to be written before the session is disconnected
+        self.closed = False # Whether the session stopped taking frames
+        self.__frames = asyncio.Queue() # (frame, window to release or None) waiting to be written, None to stop
+        self.__task = asyncio.create_task(self.__write_forever())
+
+    def send(self, frame, window=None):
+        """ Queue a frame without waiting, disconnecting the session if its queue is full
+
+        :param: the framed message and the window semaphore of the request it answers, if any
+        """
+        if not self.closed:
+            if self.__frames.qsize() < self.size:
+                self.__frames.put_nowait((frame, window))
+                return
+            log.warning("Disconnecting a session %d frames behind", self.size)
+            self.abort()
+        if window is not None:
+            window.release()
+
+    def abort(self):
+        """ Drop the connection of the session and the frames it did not get
+        """
+        self.closed = True
+        self.writer.transport.abort()
+
+    async def close(self):
+        """ Write the queued frames and stop the writer task. If the loop cancels the closing session, the frames are
+        dropped and the connection with them.
+        """
+        self.closed = True
+        self.__frames.put_nowait(None)
+        try:
+            await self.__task
+        except asyncio.CancelledError:
+            self.__task.cancel()
+            self.writer.transport.abort()
+
+    async def __write_forever(self):
+        frames = self.__frames
+        writer = self.writer
+        try:
+            while True:
+                item = await frames.get()
+                if item is None:
+                    break
+                frame, window = item
+                writer.write(frame)
+                # Wait for the trader to read once the transport buffer is over its high-water mark
+                await writer.drain()
+                if window is not None:
+                    window.release()
+        except (ConnectionError, OSError):
+            pass # The connection was lost or aborted
+        finally:
+            self.closed = True
+            # Release the requests whose response will not be written
+            while not frames.empty():
+                item = frames.get_nowait()
+                if item is not None and item[1] is not None:
+                    item[1].release()
+
+
+class AsyncExchangeServer:
+    """ Exchange server serving every trader session with a coroutine on one asyncio event loop.
+    Sessions put their decoded requests on a single bounded sequencer queue, and one matching task drains that queue in
+    batches. The matching engine is only ever called from that task, so requests are matched in arrival order without
+    locks. The execution reports of the orders of a trader are pushed to every session the trader sent requests on,
+    after the responses of the batch that generated them. Every session writes its frames from a bounded SessionOutbox.
+    It offers the serve_forever, shutdown and server_close methods of the socketserver servers.
+    """
+    def __init__(self, host="localhost", port=9999, codecs=(BinaryCodec.CODEC_ID,), queue_size=4096, window=32,
+                 batch_size=256, matching_engine=None, instrument=False, outbox_size=4096):
+        self.stats = LatencyStats() if instrument else None # Latency and throughput statistics, served to STATS requests
+        self.__service = ExchangeService(matching_engine, self.stats) # A MatchingEngine by default, or a
+                                                                      # ShardedMatchingEngine
+        self.codecs = codecs # Ids of the wire codecs sessions may use. Pickle is only safe with trusted peers.
+        self.queue_size = queue_size # Most requests waiting for the matching task, sessions wait when it is full
+        self.window = window # Most requests of one session waiting for their response
+        self.batch_size = batch_size # Most requests the matching task runs before yielding to the sessions
+        self.outbox_size = outbox_size # Most frames waiting to be written on a session before it is disconnected
+        # Bind now, so that the address is known before serving like with socketserver
+        self.socket = socket.create_server((host, port))
+        self.server_address = self.socket.getsockname()
+        self.__loop = None
+        self.__stopped = None
+        self.__queue = None
+        self.__sessions = {} # Dictionary of the task of every open session mapping to its stream writer
+        self.__shutdown_request = False
+        self.__state_lock = threading.Lock()
+        self.__is_shut_down = threading.Event()
+        log.info("Starting ExchangeServer on port %d", self.server_address[1])
+
+    def get_matching_engine(self):
+        return self.__service.get_matching_engine()
+
+    def serve_forever(self):
+        """ Serve the trader sessions until shutdown is called
+        """
+        self.__is_shut_down.clear()
+        try:
+            asyncio.run(self.__serve())
+        finally:
+            self.__is_shut_down.set()
+
+    def shutdown(self):
+        """ Stop serve_forever and wait until it returns. It must be called from another thread.
+        """
+        with self.__state_lock:
+            self.__shutdown_request = True
+            if self.__loop is not None:
+                self.__loop.call_soon_threadsafe(self.__stopped.set)
+        self.__is_shut_down.wait()
+
+    def server_close(self):
+        """ Close the listening socket
+        """
+        self.socket.close()
+
+    async def __serve(self):
+        with self.__state_lock:
+            self.__loop = asyncio.get_running_loop()
+            self.__stopped = asyncio.Event()
+            if self.__shutdown_request:
+                self.__stopped.set()
+        self.__queue = asyncio.Queue(self.queue_size)
+        matcher = asyncio.create_task(self.__match())
+        server = await asyncio.start_server(self.__session, sock=self.socket)
+        try:
+            await self.__stopped.wait()
+        finally:
+            server.close()
+            # Drop the connections of the sessions still open and let them finish while the matcher answers their
+            # queued requests, so that no session is left to the cancellation of the loop
+            for writer in list(self.__sessions.values()):
+                writer.transport.abort()
+            if self.__sessions:
+                await asyncio.wait(list(self.__sessions))
+            matcher.cancel()
+            with self.__state_lock:
+                self.__loop = None
+                self.__shutdown_request = False
+
+    async def __session(self, reader, writer):
+        """ Serve the requests of one trader session until the trader disconnects
+        """
+        log.info("Opening session from %s", writer.get_extra_info('peername')[0])
+        task = asyncio.current_task()
+        self.__sessions[task] = writer
+        window = asyncio.Semaphore(self.window)
+        outbox = None
+        # Sessions on a socket passed to start_server do not get TCP_NODELAY, and a report written right after a
+        # response would wait for the delayed acknowledgement of the response
+        writer.get_extra_info('socket').setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        try:
+            # Agree on the codec of the session, closing it if there is none in common
+            codec_id = WireCodec.choose(WireCodec.load_hello(await ExchangeProtocol.read_frame(reader) or b''),
+                                        self.codecs)
+            writer.write(ExchangeProtocol.frame(WireCodec.dump_hello([codec_id] if codec_id else [])))
+            if codec_id is None:
+                return
+            codec = WireCodec.get(codec_id)
+            outbox = SessionOutbox(codec, writer, self.outbox_size)
+
+            while True:
+                # Stop reading while the trader has a full window of requests waiting for their response to be written
+                data = await ExchangeProtocol.read_frame(reader)
+                if data is None:
+                    break
+                if self.stats is None:
+                    request = codec.decode_request(data)
+                    decoded = 0
+                else:
+                    start = time.perf_counter_ns()
+                    request = codec.decode_request(data)
+                    decoded = time.perf_counter_ns()
+                    self.stats.record('decode', request.request_type, decoded - start)
+                await window.acquire()
+                await self.__queue.put((request, outbox, window, decoded))
+
+            # Answer the requests still waiting before closing the session
+            for i in range(self.window):
+                await window.acquire()
+        except (ConnectionError, ValueError):
+            pass
+        except asyncio.CancelledError:
+            writer.transport.abort() # The loop is closing
+        finally:
+            if outbox is not None:
+                # Closed first, so that the matcher does not subscribe the session again for its queued requests
+                outbox.closed = True
+                self.__service.unsubscribe(outbox)
+                await outbox.close()
+            writer.close()
+            del self.__sessions[task]
+
+    async def __match(self):
+        """ Run the queued requests against the matching engine in batches, in the order they were queued
+        """
+        queue = self.__queue
+        service = self.__service
+        stats = self.stats
+        while True:
+            batch = [await queue.get()]
+            while len(batch) < self.batch_size and not queue.empty():
+                batch.append(queue.get_nowait())
+
+            responses = []
+            for request, outbox, window, decoded in batch:
+                if stats is not None:
+                    stats.record('queue', request.request_type, time.perf_counter_ns() - decoded)
+                if not outbox.closed:
+                    service.subscribe(request.trader_id, outbox)
+                try:
+                    response = service.execute_request(request)
+                except Exception as e:
+                    log.error("Failed %s request: %s", request.request_type.name, e)
+                    response = ExchangeResponse(False, None)
+                response.request_id = request.request_id
+                responses.append((response, service.take_reports()))
+
+            # Group commit of the journal of the whole batch before any of its responses is sent
+            service.commit()
+            for (request, outbox, window, decoded), (response, reports) in zip(batch, responses):
+                if outbox.closed:
+                    window.release()
+                elif stats is None:
+                    outbox.send(ExchangeProtocol.frame(outbox.codec.encode_response(response)), window)
+                else:
+                    start = time.perf_counter_ns()
+                    data = outbox.codec.encode_response(response)
+                    encoded = time.perf_counter_ns()
+                    outbox.send(ExchangeProtocol.frame(data), window)
+                    stats.record('encode', request.request_type, encoded - start)
+                    stats.record('send', request.request_type, time.perf_counter_ns() - encoded)
+                # Then push the execution reports the request generated
+                for report_outbox, report in reports:
+                    if not report_outbox.closed:
+                        report_outbox.send(ExchangeProtocol.frame(report_outbox.codec.encode_response(report)))
@@ -0,0 +1,457 @@
+import argparse
+import contextlib
+import gc
+import os
+import random
+import resource
+import tempfile
+import threading
+import time
+
+from AsyncExchangeServer import AsyncExchangeServer
+from CommandType import CommandType
+from EquityBook import EquityBook
+from EventLog import LogLevel, log
+from ExchangeClient import ExchangeClient
+from ExchangeRequest import ExchangeRequest, ExchangeRequestType
+from ExchangeServer import ExchangeServer
+from Journal import Journal
+from MatchingEngine import MatchingEngine
+from Order import Order
+from OrderArchive import OrderArchive
+from OrderStore import OrderStore
+from OrderType import OrderType
+from ShardedMatchingEngine import ShardedMatchingEngine
+from Side import Side
+from Snapshot import Snapshot
+
+
+def build_book(depth, levels=100, seed=1):
+    """ Build an EquityBook with resting LIMIT orders that do not cross
+
+    :param: number of resting orders, number of price levels per side and random seed
+    :return: The EquityBook and the list of resting order ids
+    """
+    rnd = random.Random(seed)
+    book = EquityBook('BENCH')
+    for oid in range(1, depth + 1):
+        # Bids rest below 1000 and offers above 1000 so that no order is matched
+        if oid % 2:
+            order = Order(oid, oid, rnd.randint(1, 100), 0, Side.BUY, 'BENCH', OrderType.LIMIT,
+                          1000 - rnd.randint(1, levels))
+        else:
+            order = Order(oid, oid, rnd.randint(1, 100), 0, Side.SELL, 'BENCH', OrderType.LIMIT,
+                          1000 + rnd.randint(1, levels))
+        book.handle_order(order)
+    return book, list(range(1, depth + 1))
+
+
+def bench_cancel(depths=(1000, 10000, 100000, 1000000), samples=10000, seed=1):
+    """ Measure EquityBook.cancel_order latency at different book depths
+
+    :param: book depths to measure, number of cancels per depth and random seed
+    :return: List of (depth, mean nanoseconds per cancel) tuples
+    """
+    results = []
+    for depth in depths:
+        book, order_ids = build_book(depth, seed=seed)
+        rnd = random.Random(seed)
+        to_cancel = rnd.sample(order_ids, min(samples, depth))
+        start = time.perf_counter_ns()
+        for oid in to_cancel:
+            book.cancel_order(oid)
+        elapsed = time.perf_counter_ns() - start
+        results.append((depth, elapsed / len(to_cancel)))
+    return results
+
+
+def bench_journal(count=100000, sync_count=2000, commit_every=64, seed=1):
+    """ Measure the mean latency of MatchingEngine.handle_order without a journal and with each journal durability
+    mode. In 'batch' mode the journal is committed every commit_every orders, the way a server commits each batch of
+    requests before answering them.
+
+    :param: number of orders per mode, number of orders in 'sync' mode, orders per group commit and random seed
+    :return: Dictionary of mode mapping to mean nanoseconds per order
+    """
+    results = {}
+    for mode in [None, 'none', 'batch', 'sync']:
+        n = sync_count if mode == 'sync' else count
+        rnd = random.Random(seed)
+        with tempfile.TemporaryDirectory() as tmp:
+            engine = MatchingEngine()
+            journal = None
+            if mode is not None:
+                journal = Journal(os.path.join(tmp, 'journal'), mode)
+                engine.recover(journal)
+            orders = [engine.create_order(rnd.randint(1, 10000), rnd.randint(1, 100), Side(rnd.randint(1, 2)),
+                                          'BENCH', OrderType.LIMIT, rnd.randint(990, 1010)) for i in range(n)]
+            start = time.perf_counter_ns()
+            for i, order in enumerate(orders):
+                engine.handle_order(order)
+                if journal is not None and i % commit_every == commit_every - 1:
+                    journal.commit()
+            if journal is not None:
+                journal.close()
+            results['no journal' if mode is None else mode] = (time.perf_counter_ns() - start) / n
+    return results
+
+
+def bench_recovery(count=200000, tail=0.1, seed=1):
+    """ Measure the restart time of an engine replaying its whole journal and loading a snapshot then replaying the
+    journal tail after it, and how long taking the snapshot stops matching
+
+    :param: number of journaled orders, share of the orders journaled after the snapshot and random seed
+    :return: Dictionary of measure mapping to seconds
+    """
+    rnd = random.Random(seed)
+    results = {}
+    with tempfile.TemporaryDirectory() as tmp:
+        journal_path = os.path.join(tmp, 'journal')
+        snapshots = Snapshot(os.path.join(tmp, 'snapshots'))
+        engine = MatchingEngine()
+        engine.recover(Journal(journal_path, 'none'))
+        for i in range(count):
+            if i == int(count * (1 - tail)):
+                start = time.perf_counter()
+                snapshots.take(engine)
+                results['snapshot pause'] = time.perf_counter() - start
+            engine.handle_order(engine.create_order(rnd.randint(1, 10000), rnd.randint(1, 100),
+                                                    Side(rnd.randint(1, 2)), 'T%d' % rnd.randint(1, 100),
+                                                    OrderType.LIMIT, rnd.randint(990, 1010)))
+        snapshots.wait()
+        engine.journal.close()
+        del engine
+
+        start = time.perf_counter()
+        MatchingEngine().recover(Journal(journal_path))
+        results['full journal replay'] = time.perf_counter() - start
+        start = time.perf_counter()
+        MatchingEngine().recover(Journal(journal_path), snapshots)
+        results['snapshot and tail'] = time.perf_counter() - start
+    return results
+
+
+def current_rss():
+    """ Get the resident memory of this process in bytes
+    """
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * resource.getpagesize()
+    except OSError:
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def bench_memory(counts=(1000000, 10000000), traders=1000, seed=1):
+    """ Measure the resident memory per order of orders created the way ExchangeServer creates them and either kept in
+    an order history dictionary, or handled by an engine where they trade or rest until their trader sends its next
+    order, with the terminal orders kept in the engine or moved to an OrderStore
+
+    :param: numbers of orders to create, number of traders sending them and random seed
+    :return: Dictionary of mode mapping to a list of (number of orders, bytes per order) tuples
+    """
+    results = {}
+    tickers = ['FB', 'GOOG', 'AAPL']
+    for mode in ['created', 'engine', 'engine with OrderStore']:
+        results[mode] = []
+        for count in counts:
+            rnd = random.Random(seed)
+            engine = MatchingEngine()
+            if mode == 'engine with OrderStore':
+                engine.archive_orders(OrderStore())
+            gc.collect()
+            before = current_rss()
+            history = {}
+            for i in range(count):
+                trader_id = rnd.randint(1, traders)
+                order = engine.create_order(trader_id, rnd.randint(1, 100), Side(rnd.randint(1, 2)), tickers[i % 3],
+                                            OrderType.LIMIT, str(rnd.randint(990, 1010)))
+                if mode == 'created':
+                    history[order.order_id] = order
+                    continue
+                # A trader cancels its order still resting before sending the next one
+                active = engine.trader_orders.get(trader_id)
+                if active is not None:
+                    engine.cancel_order(active)
+                engine.handle_order(order)
+            gc.collect()
+            results[mode].append((count, (current_rss() - before) / count))
+            del history, engine
+    return results
+
+
+def bench_soak(count=2000000, rounds=10, traders=10000, seed=1):
+    """ Measure the resident memory of an engine handling a long stream of orders and cancels, without and with an
+    OrderArchive of its terminal orders
+
+    :param: number of commands, number of measures and traders, and random seed
+    :return: Dictionary of mode mapping to a list of (commands handled, resident MiB, orders in order_history)
+    """
+    results = {}
+    for mode in ['no archive', 'archive']:
+        rnd = random.Random(seed)
+        samples = []
+        with tempfile.TemporaryDirectory() as tmp, open(os.devnull, 'w') as devnull, \
+                contextlib.redirect_stdout(devnull):
+            engine = MatchingEngine()
+            archive = None
+            if mode == 'archive':
+                archive = OrderArchive(tmp)
+                engine.archive_orders(archive)
+            gc.collect()
+            for i in range(1, count + 1):
+                trader_id = rnd.randint(1, traders)
+                active = engine.trader_orders.get(trader_id)
+                if active is None:
+                    engine.handle_order(engine.create_order(trader_id, rnd.randint(1, 100), Side(rnd.randint(1, 2)),
+                                                            'BENCH', OrderType.LIMIT, rnd.randint(990, 1010)))
+                elif rnd.random() < 0.5:
+                    engine.cancel_order(active)
+                if i % (count // rounds) == 0:
+                    gc.collect()
+                    samples.append((i, current_rss() / (1 << 20), len(engine.order_history)))
+            if archive is not None:
+                archive.close()
+        results[mode] = samples
+        del engine
+    return results
+
+
+@contextlib.contextmanager
+def running_server(server_class=ExchangeServer, **kwargs):
+    """ Run an exchange server on a free local port for the duration of a benchmark, discarding its console output
+
+    :param: server class and keyword arguments of the server
+    :return: The port of the server
+    """
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+        server = server_class(port=0, **kwargs)
+        thread = threading.Thread(target=server.serve_forever, daemon=True)
+        thread.start()
+        try:
+            yield server.server_address[1]
+        finally:
+            server.shutdown()
+            server.server_close()
+
+
+def bench_round_trips(count=5000, window=32):
+    """ Measure GET round trips per second over the TCP path, opening a connection per request the way the client used
+    to, reusing one session, and keeping several requests in flight on one session
+
+    :param: number of requests per mode and number of requests kept in flight by the pipelined mode
+    :return: Dictionary of mode mapping to round trips per second
+    """
+    results = {}
+    with running_server() as port:
+        with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+            client = ExchangeClient(1, server_port=port)
+            oid = client.submit_order(OrderType.LIMIT, Side.BUY, 'BENCH', 10, 10)
+
+            start = time.perf_counter()
+            for i in range(count):
+                with ExchangeClient(1, server_port=port) as per_request:
+                    per_request.get_order(oid)
+            results['connection per request'] = count / (time.perf_counter() - start)
+
+            start = time.perf_counter()
+            for i in range(count):
+                client.get_order(oid)
+            results['persistent session'] = count / (time.perf_counter() - start)
+
+            start = time.perf_counter()
+            in_flight = []
+            for i in range(count):
+                in_flight.append(client.send_request(ExchangeRequest(ExchangeRequestType.GET, 1, order_id=oid)))
+                if len(in_flight) >= window:
+                    in_flight.pop(0).result()
+            for future in in_flight:
+                future.result()
+            results['pipelined session'] = count / (time.perf_counter() - start)
+            client.close()
+    return results
+
+
+def bench_instrumentation(count=5000, window=32):
+    """ Measure pipelined SUBMIT and CANCEL requests per second on both servers with and without latency statistics
+
+    :param: number of orders per mode and number of requests kept in flight
+    :return: Dictionary of mode mapping to requests per second, and the statistics of the last instrumented server
+    """
+    results = {}
+    stats = None
+    for server_class in (ExchangeServer, AsyncExchangeServer):
+        for instrument in (False, True):
+            with running_server(server_class, instrument=instrument) as port:
+                with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+                    with ExchangeClient(1, server_port=port) as client:
+                        start = time.perf_counter()
+                        in_flight = []
+                        for i in range(count):
+                            future = client.send_request(ExchangeRequest(
+                                ExchangeRequestType.SUBMIT, 1, order_type=OrderType.LIMIT, order_side=Side.BUY,
+                                ticker='BENCH', quantity=1, price=10))
+                            # The trader cancels its order as soon as it is acknowledged, to submit the next one
+                            in_flight.append(client.send_request(ExchangeRequest(
+                                ExchangeRequestType.CANCEL, 1, order_id=future.result().order.order_id)))
+                            if len(in_flight) >= window:
+                                in_flight.pop(0).result()
+                        for future in in_flight:
+                            future.result()
+                        mode = '%s%s' % (server_class.__name__, ' stats' if instrument else '')
+                        results[mode] = 2 * count / (time.perf_counter() - start)
+                        if instrument:
+                            stats = client.get_stats()
+    return results, stats
+
+
+def bench_batches(count=20000, batch_size=256):
+    """ Measure orders per second sent one request per order and in SUBMIT_BATCH requests. Every order fills against
+    one large resting order, so that the trader can always submit the next one.
+
+    :param: number of orders per mode and number of orders per batch
+    :return: Dictionary of mode mapping to orders per second
+    """
+    results = {}
+    with running_server(AsyncExchangeServer) as port:
+        with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+            with ExchangeClient(1, server_port=port) as seller, ExchangeClient(2, server_port=port) as buyer:
+                seller.submit_order(OrderType.LIMIT, Side.SELL, 'BENCH', 2 * count, 10)
+
+                start = time.perf_counter()
+                for i in range(count):
+                    buyer.submit_order(OrderType.LIMIT, Side.BUY, 'BENCH', 1, 10)
+                results['request per order'] = count / (time.perf_counter() - start)
+
+                start = time.perf_counter()
+                command = (CommandType.NEW, OrderType.LIMIT, Side.BUY, 'BENCH', 1, 10)
+                for i in range(0, count, batch_size):
+                    buyer.submit_batch([command] * min(batch_size, count - i))
+                results['batches of %d' % batch_size] = count / (time.perf_counter() - start)
+    return results
+
+
+def bench_sessions(sessions=1000, rounds=5):
+    """ Measure request throughput with many trader sessions open at once, against the thread per session server and
+    the asyncio server
+
+    :param: number of concurrent sessions and number of requests each session sends
+    :return: Dictionary of server mapping to requests per second
+    """
+    results = {}
+    for name, server_class in [('threaded', ExchangeServer), ('asyncio', AsyncExchangeServer)]:
+        with running_server(server_class) as port:
+            with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+                clients = [ExchangeClient(trader_id, server_port=port) for trader_id in range(1, sessions + 1)]
+                oids = [client.submit_order(OrderType.LIMIT, Side.BUY, 'BENCH', 10, 10) for client in clients]
+                start = time.perf_counter()
+                futures = [client.send_request(ExchangeRequest(ExchangeRequestType.GET, trader_id, order_id=oid))
+                           for i in range(rounds)
+                           for trader_id, client, oid in zip(range(1, sessions + 1), clients, oids)]
+                for future in futures:
+                    future.result()
+                results[name] = len(futures) / (time.perf_counter() - start)
+                for client in clients:
+                    client.close()
+    return results
+
+
+def bench_shards(shard_counts=(1, 2, 4), count=200000, tickers=1000, seed=1):
+    """ Measure order throughput of the in-process engine and of the sharded engine with different numbers of workers,
+    on orders spread over many tickers
+
+    :param: numbers of worker processes, number of orders, number of tickers and random seed
+    :return: Dictionary of engine mapping to orders per second
+    """
+    rnd = random.Random(seed)
+    names = ['T%04d' % i for i in range(tickers)]
+    specs = [(rnd.randint(1, 10000), rnd.randint(1, 100), Side(rnd.randint(1, 2)), rnd.choice(names), OrderType.LIMIT,
+              rnd.randint(990, 1010)) for i in range(count)]
+    results = {}
+    engine = MatchingEngine()
+    orders = [engine.create_order(*spec) for spec in specs]
+    start = time.perf_counter()
+    for order in orders:
+        engine.handle_order(order)
+    results['in-process'] = count / (time.perf_counter() - start)
+    for shards in shard_counts:
+        with ShardedMatchingEngine(shards) as sharded:
+            orders = [sharded.create_order(*spec) for spec in specs]
+            start = time.perf_counter()
+            sharded.handle_orders([(CommandType.NEW, order) for order in orders])
+            results['%d shards' % shards] = count / (time.perf_counter() - start)
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmarks for the MatchingEngine hot paths")
+    parser.add_argument('benchmark', choices=['cancel', 'memory', 'journal', 'recovery', 'roundtrip', 'batch',
+                                              'sessions', 'shards', 'soak',
+                                              'stats'])
+    parser.add_argument('--depths', type=int, nargs='+', default=[1000, 10000, 100000, 1000000])
+    parser.add_argument('--orders', type=int, nargs='+', default=[1000000, 10000000])
+    parser.add_argument('--requests', type=int, default=5000)
+    parser.add_argument('--sessions', type=int, default=1000)
+    parser.add_argument('--shards', type=int, nargs='+', default=[1, 2, 4])
+    parser.add_argument('--commands', type=int, default=2000000)
+    args = parser.parse_args()
+    # Keep the session messages of the servers out of the result tables
+    log.level = LogLevel.WARNING
+
+    if args.benchmark == 'cancel':
+        print("%12s %16s" % ("depth", "ns/cancel"))
+        for depth, ns in bench_cancel(args.depths):
+            print("%12d %16.0f" % (depth, ns))
+
+    elif args.benchmark == 'journal':
+        print("%24s %16s" % ("durability", "ns/order"))
+        for mode, ns in bench_journal().items():
+            print("%24s %16.0f" % (mode, ns))
+
+    elif args.benchmark == 'recovery':
+        print("%24s %16s" % ("measure", "seconds"))
+        for measure, seconds in bench_recovery().items():
+            print("%24s %16.3f" % (measure, seconds))
+
+    elif args.benchmark == 'memory':
+        print("%24s %12s %16s" % ("mode", "orders", "bytes/order"))
+        for mode, samples in bench_memory(args.orders).items():
+            for count, per_order in samples:
+                print("%24s %12d %16.0f" % (mode, count, per_order))
+        print("Only terminal orders are compacted: resting orders stay Order objects in the engine and their book, at "
+              "about twice the bytes of a created order.")
+
+    elif args.benchmark == 'roundtrip':
+        print("%24s %16s" % ("mode", "round trips/s"))
+        for mode, rate in bench_round_trips(args.requests).items():
+            print("%24s %16.0f" % (mode, rate))
+
+    elif args.benchmark == 'batch':
+        print("%24s %16s" % ("mode", "orders/s"))
+        for mode, rate in bench_batches(args.requests).items():
+            print("%24s %16.0f" % (mode, rate))
+
+    elif args.benchmark == 'sessions':
+        print("%24s %16s" % ("server", "requests/s"))
+        for server, rate in bench_sessions(args.sessions).items():
+            print("%24s %16.0f" % (server, rate))
+
+    elif args.benchmark == 'shards':
+        print("%24s %16s" % ("engine", "orders/s"))
+        for engine, rate in bench_shards(args.shards).items():
+            print("%24s %16.0f" % (engine, rate))
+
+    elif args.benchmark == 'soak':
+        print("%24s %12s %12s %12s" % ("mode", "commands", "RSS MiB", "orders"))
+        for mode, samples in bench_soak(args.commands).items():
+            for commands, rss, orders in samples:
+                print("%24s %12d %12.1f %12d" % (mode, commands, rss, orders))
+
+    elif args.benchmark == 'stats':
+        rates, stats = bench_instrumentation(args.requests)
+        print("%24s %16s" % ("server", "requests/s"))
+        for server, rate in rates.items():
+            print("%24s %16.0f" % (server, rate))
+        print("%24s %10s %10s %10s %10s" % ("stage", "count", "p50 ns", "p99 ns", "p999 ns"))
+        for (stage, request_type), summary in stats['latency'].items():
+            print("%24s %10d %10d %10d %10d" % (stage + ' ' + request_type.name, summary['count'], summary['p50'],
+                                                 summary['p99'], summary['p999']))
@@ -0,0 +1,291 @@
+import argparse
+import gc
+import json
+import platform
+import random
+import sys
+import time
+import tracemalloc
+from functools import partial
+
+from AsyncExchangeServer import AsyncExchangeServer
+from Benchmark import build_book, running_server
+from EquityBook import EquityBook
+from EventLog import LogLevel, log
+from ExchangeClient import ExchangeClient
+from ExchangeRequest import ExchangeRequest, ExchangeRequestType
+from LatencyStats import LatencyHistogram
+from MatchingEngine import MatchingEngine
+from Order import Order
+from OrderType import OrderType
+from RiskGate import RiskGate, RiskLimits
+from Side import Side
+
+
+# Each scenario builds its book or engine and the operations to measure from a seeded random generator, so two runs
+# with the same count and seed measure the same work. It returns the list of (function, arguments) operations.
+
+def scenario_deep_book(count, rnd):
+    """ Passive LIMIT orders building a deep book of 200 levels through EquityBook.handle_order
+    """
+    book = EquityBook('BENCH')
+    operations = []
+    for oid in range(1, count + 1):
+        if oid % 2:
+            order = Order(oid, oid, rnd.randint(1, 100), 0, Side.BUY, 'BENCH', OrderType.LIMIT,
+                          1000 - rnd.randint(1, 100))
+        else:
+            order = Order(oid, oid, rnd.randint(1, 100), 0, Side.SELL, 'BENCH', OrderType.LIMIT,
+                          1000 + rnd.randint(1, 100))
+        operations.append((book.handle_order, (order,)))
+    return operations
+
+
+def scenario_sweep(count, rnd):
+    """ Aggressive BUY orders through EquityBook.handle_order, each sweeping many offer levels of one order
+    """
+    book = EquityBook('BENCH')
+    for oid in range(1, count + 1):
+        book.handle_order(Order(oid, oid, rnd.randint(1, 10), 0, Side.SELL, 'BENCH', OrderType.LIMIT, 1000 + oid))
+    operations = []
+    # The sweeps take about 4 of the 5.5 shares of each level on average, so the book never runs out
+    for oid in range(count + 1, count + 1 + count // 25):
+        order = Order(oid, oid, 100, 0, Side.BUY, 'BENCH', OrderType.LIMIT, 1000 + 2 * count)
+        operations.append((book.handle_order, (order,)))
+    return operations
+
+
+def scenario_cancel(count, rnd):
+    """ EquityBook.cancel_order of every order of a deep book, in random order
+    """
+    book, order_ids = build_book(count, seed=rnd.randint(1, 1 << 30))
+    rnd.shuffle(order_ids)
+    return [(book.cancel_order, (oid,)) for oid in order_ids]
+
+
+def scenario_amend(count, rnd):
+    """ EquityBook.amend_order halving the quantity of every order of a deep book, in random order. Orders of one share
+    cannot be reduced and are left out.
+    """
+    book, order_ids = build_book(count, seed=rnd.randint(1, 1 << 30))
+    rnd.shuffle(order_ids)
+    return [(book.amend_order, (oid, book.orders[oid].quantity // 2)) for oid in order_ids
+            if book.orders[oid].quantity > 1]
+
+
+def scenario_ioc_market(count, rnd):
+    """ IOC and MARKET orders of both sides through EquityBook.handle_order, against a deep book of large orders
+    """
+    book = EquityBook('BENCH')
+    levels = 1000
+    for oid in range(1, 2 * levels + 1):
+        side = Side.BUY if oid % 2 else Side.SELL
+        price = 1000 - (oid + 1) // 2 if side is Side.BUY else 1000 + oid // 2
+        book.handle_order(Order(oid, oid, 1000 * count, 0, side, 'BENCH', OrderType.LIMIT, price))
+    operations = []
+    for oid in range(2 * levels + 1, 2 * levels + 1 + count):
+        side = Side(rnd.randint(1, 2))
+        if rnd.random() < 0.5:
+            order = Order(oid, oid, rnd.randint(1, 100), 0, side, 'BENCH', OrderType.MARKET)
+        else:
+            price = 1000 + levels if side is Side.BUY else 1000 - levels
+            order = Order(oid, oid, rnd.randint(1, 100), 0, side, 'BENCH', OrderType.IOC, price)
+        operations.append((book.handle_order, (order,)))
+    return operations
+
+
+def scenario_many_tickers(count, rnd):
+    """ Crossing LIMIT orders spread over 1000 tickers through MatchingEngine.handle_order
+    """
+    engine = MatchingEngine()
+    tickers = ['T%04d' % i for i in range(1000)]
+    operations = []
+    for oid in range(1, count + 1):
+        order = Order(oid, oid, rnd.randint(1, 100), 0, Side(rnd.randint(1, 2)), rnd.choice(tickers),
+                      OrderType.LIMIT, rnd.randint(990, 1010))
+        operations.append((engine.handle_order, (order,)))
+    return operations
+
+
+def scenario_risk_gate(count, rnd):
+    """ The orders of many_tickers through a RiskGate checking every limit, which none of the orders breaks
+    """
+    gate = RiskGate(MatchingEngine(), RiskLimits(max_quantity=100, max_notional=1 << 40, max_open_orders=1,
+                                                 max_position=1000, price_collar=100))
+    tickers = ['T%04d' % i for i in range(1000)]
+    operations = []
+    for oid in range(1, count + 1):
+        order = Order(oid, oid, rnd.randint(1, 100), 0, Side(rnd.randint(1, 2)), rnd.choice(tickers),
+                      OrderType.LIMIT, rnd.randint(990, 1010))
+        operations.append((gate.handle_order, (order,)))
+    return operations
+
+
+SCENARIOS = {
+    'deep_book': scenario_deep_book,
+    'sweep': scenario_sweep,
+    'cancel': scenario_cancel,
+    'amend': scenario_amend,
+    'ioc_market': scenario_ioc_market,
+    'many_tickers': scenario_many_tickers,
+    'risk_gate': scenario_risk_gate,
+}
+
+
+def measure(operations):
+    """ Run operations one by one, timing each of them
+
+    :param: list of (function, arguments) operations
+    :return: Seconds taken by all the operations and the LatencyHistogram of their latencies
+    """
+    histogram = LatencyHistogram()
+    record = histogram.record
+    clock = time.perf_counter_ns
+    # Collections would land on random operations, so they run before the measure
+    gc.collect()
+    collecting = gc.isenabled()
+    gc.disable()
+    try:
+        start = clock()
+        for function, args in operations:
+            before = clock()
+            function(*args)
+            record(clock() - before)
+        elapsed = clock() - start
+    finally:
+        if collecting:
+            gc.enable()
+    return elapsed / 1e9, histogram
+
+
+def peak_memory(scenario, count, seed):
+    """ Measure the peak memory allocated by building and running a scenario. It runs apart from the timed run, as
+    tracing allocations slows every operation down.
+
+    :return: Peak allocated bytes
+    """
+    gc.collect()
+    tracemalloc.start()
+    try:
+        for function, args in scenario(count, random.Random(seed)):
+            function(*args)
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+
+def run_scenario(name, count, seed=1):
+    """ Measure a scenario
+
+    :param: name of the scenario in SCENARIOS, number of operations and random seed
+    :return: Dictionary of the operations, ops_per_sec, p50, p99, p999 and max latencies in nanoseconds and
+             peak_bytes
+    """
+    scenario = SCENARIOS[name]
+    operations = scenario(count, random.Random(seed))
+    seconds, histogram = measure(operations)
+    del operations
+    result = summarize(histogram.count, seconds, histogram)
+    result['peak_bytes'] = peak_memory(scenario, count, seed)
+    return result
+
+
+def run_tcp(count, seed=1):
+    """ Measure SUBMIT round trips end to end over the TCP path, through an AsyncExchangeServer on a local port.
+    Every order has its own trader, as traders have one active order at a time. Starting and stopping the server and
+    the client is not timed. The peak memory is measured by a second run on a new server, and covers the round trips
+    in the client and the server.
+
+    :param: number of orders and random seed
+    :return: Dictionary of the same measures as run_scenario
+    """
+    with running_server(AsyncExchangeServer) as port, ExchangeClient(0, server_port=port) as client:
+        seconds, histogram = measure(scenario_tcp(count, random.Random(seed), client))
+    result = summarize(count, seconds, histogram)
+    with running_server(AsyncExchangeServer) as port, ExchangeClient(0, server_port=port) as client:
+        result['peak_bytes'] = peak_memory(partial(scenario_tcp, client=client), count, seed)
+    return result
+
+
+def scenario_tcp(count, rnd, client):
+    """ SUBMIT requests of LIMIT orders around a price of 1000 on the session of a client of an AsyncExchangeServer
+    """
+    requests = [ExchangeRequest(ExchangeRequestType.SUBMIT, trader_id, order_type=OrderType.LIMIT,
+                                order_side=Side(rnd.randint(1, 2)), ticker='BENCH', quantity=rnd.randint(1, 100),
+                                price=rnd.randint(990, 1010)) for trader_id in range(1, count + 1)]
+
+    def round_trip(request):
+        client.send_request(request).result()
+    return [(round_trip, (request,)) for request in requests]
+
+
+def summarize(operations, seconds, histogram):
+    return {'operations': operations, 'ops_per_sec': operations / seconds if seconds else 0.0,
+            'p50': histogram.percentile(50), 'p99': histogram.percentile(99), 'p999': histogram.percentile(99.9),
+            'max': histogram.max}
+
+
+def compare(results, baseline, tolerance):
+    """ Compare results with a baseline
+
+    :param: dictionaries of scenario mapping to its measures, and the tolerated relative change
+    :return: List of (scenario, measure, baseline value, value, relative change, whether it regressed)
+    """
+    changes = []
+    for name, result in results.items():
+        if name not in baseline:
+            continue
+        # Throughput regresses when it goes down, latencies and memory when they go up
+        for measure_name, higher_is_better in (('ops_per_sec', True), ('p50', False), ('p99', False),
+                                               ('peak_bytes', False)):
+            before, after = baseline[name][measure_name], result[measure_name]
+            change = (after - before) / before if before else 0.0
+            regressed = -change > tolerance if higher_is_better else change > tolerance
+            changes.append((name, measure_name, before, after, change, regressed))
+    return changes
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark suite of the EquityBook and MatchingEngine hot paths")
+    parser.add_argument('scenarios', nargs='*', default=list(SCENARIOS) + ['tcp'],
+                        help="Scenarios to run among %s and tcp, all by default" % ', '.join(SCENARIOS))
+    parser.add_argument('--count', type=int, default=100000, help="Operations per scenario")
+    parser.add_argument('--tcp-count', type=int, default=2000, help="Round trips of the tcp scenario")
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--save', help="Write the results to a baseline JSON file")
+    parser.add_argument('--compare', help="Compare the results with a baseline JSON file")
+    parser.add_argument('--tolerance', type=float, default=0.1, help="Relative change reported as a regression")
+    args = parser.parse_args()
+    log.level = LogLevel.WARNING
+
+    results = {}
+    print("%16s %12s %14s %10s %10s %10s %12s" % ("scenario", "operations", "ops/s", "p50 ns", "p99 ns", "p999 ns",
+                                                   "peak MiB"))
+    for name in args.scenarios:
+        if name == 'tcp':
+            result = run_tcp(args.tcp_count, args.seed)
+        else:
+            result = run_scenario(name, args.count, args.seed)
+        results[name] = result
+        print("%16s %12d %14.0f %10d %10d %10d %12.1f" % (name, result['operations'], result['ops_per_sec'],
+                                                          result['p50'], result['p99'], result['p999'],
+                                                          result['peak_bytes'] / (1 << 20)))
+
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump({'count': args.count, 'tcp_count': args.tcp_count, 'seed': args.seed,
+                       'python': platform.python_version(), 'results': results}, f, indent=2, sort_keys=True)
+
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        if (baseline['count'], baseline['tcp_count'], baseline['seed']) != (args.count, args.tcp_count, args.seed):
+            print("Warning: the baseline was measured with other counts or seed")
+        changes = compare(results, baseline['results'], args.tolerance)
+        print()
+        print("%16s %12s %14s %14s %9s" % ("scenario", "measure", "baseline", "current", "change"))
+        for name, measure_name, before, after, change, regressed in changes:
+            print("%16s %12s %14.0f %14.0f %+8.1f%%%s" % (name, measure_name, before, after, 100 * change,
+                                                           "  REGRESSION" if regressed else ""))
+        if any(regressed for *rest, regressed in changes):
+            sys.exit(1)
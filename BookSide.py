@@ -0,0 +1,336 @@
+from bisect import bisect_left
+
+from PriceLevel import PriceLevel
+from Side import Side
+
+class BookSide:
+    """ Class keeps the price levels of one side of an EquityBook sorted from worst to best price. MARKET orders have
+    no price and rest in their own queue ahead of every price level.
+    """
+    def __init__(self, side, resting=None, traders=None):
+        self.side = side
+        self.resting = resting if resting is not None else {} # Dictionary of order id mapping to the (BookSide, PriceLevel) handle of a resting order
+        self.traders = traders # Dictionary of trader id mapping to the dictionary of ticker to the {order id: order} of
+                               # its resting orders, None if the resting orders are not indexed by trader
+        self.markets = PriceLevel(None) # Queue of resting MARKET orders
+        self.levels = {} # Dictionary of price mapping to its PriceLevel
+        self.keys = [] # Sorted level sort keys. The best price is always the last key
+        self.queue = [] # PriceLevels in the same order as keys
+        self.count = 0 # Number of orders resting on this side
+        self.changes = None # Set of the prices of the levels changed since the last market data update, None if the
+                            # market data of the book is not published
+        self.prints = None # List of the (price, quantity) of the trades against this side, like changes
+        self.removed = None # List of the orders that left this side since the engine last archived them, None if the
+                            # engine does not archive orders
+        self.trade_log = None # TradeLog the trades against this side are appended to, if any
+
+
+    def __len__(self):
+        return self.count
+
+    def __iter__(self):
+        """ Iterate over the resting orders in execution priority
+        """
+        yield from self.markets
+        for level in reversed(self.queue):
+            yield from level
+
+
+    def __key(self, price):
+        """ Sort key of a price. Bids rank higher prices first and offers rank lower prices first.
+        """
+        if self.side == Side.BUY:
+            return price
+        return -price
+
+
+    def best_price(self):
+        """ Get the best price of the orders with a price
+
+        :return: The best price in ticks. None if there are no priced orders.
+        """
+        if self.queue:
+            return self.queue[-1].price
+        return None
+
+    def best_level(self):
+        """ Get the price level holding the best price
+
+        :return: The best PriceLevel. None if the side is empty.
+        """
+        if self.queue:
+            return self.queue[-1]
+        return None
+
+    def level_at(self, depth):
+        """ Get the price level at a given depth from the best price
+
+        :param: depth, where 0 is the best price level
+        :return: The PriceLevel. None if the side does not have that many levels.
+        """
+        if depth < len(self.queue):
+            return self.queue[-1 - depth]
+        return None
+
+    def depth(self, count):
+        """ Get the best priced levels of this side from the totals the levels keep, without reading their orders
+
+        :param: number of levels
+        :return: List of the (price, open quantity, number of orders) of at most count levels, best price first
+        """
+        return [(level.price, level.quantity, len(level)) for level in self.queue[:-count - 1:-1]]
+
+    def liquidity_up_to(self, price=None, quantity=None):
+        """ Get the open quantity and the number of the orders resting at a price or better, from the totals the
+        levels keep. Resting MARKET orders trade at any price and are always counted. Only the counted levels are read.
+
+        :param: price in ticks, None for every level, and a quantity to stop counting at, None not to stop early
+        :return: Tuple of the open quantity and the number of orders
+        """
+        markets = self.markets
+        total = markets.quantity
+        orders = len(markets)
+        queue = self.queue
+        first = 0 if price is None else bisect_left(self.keys, self.__key(price))
+        for i in range(len(queue) - 1, first - 1, -1):
+            if quantity is not None and total >= quantity:
+                break
+            level = queue[i]
+            total += level.quantity
+            orders += len(level)
+        return total, orders
+
+    def top(self):
+        """ Get the order with the highest priority on this side
+
+        :return: The top order. None if the side is empty.
+        """
+        if self.markets:
+            return self.markets.head()
+        if self.queue:
+            return self.queue[-1].head()
+        return None
+
+
+    def add(self, order):
+        """ Add an order to the level of its price. A new order takes precedence over the orders already resting at
+        the same price.
+
+        :param: order to add
+        """
+        if order.price is None:
+            level = self.markets
+        else:
+            level = self.levels.get(order.price)
+        if level is None:
+            level = PriceLevel(order.price)
+            key = self.__key(order.price)
+            i = bisect_left(self.keys, key)
+            self.keys.insert(i, key)
+            self.queue.insert(i, level)
+            self.levels[order.price] = level
+        level.push_front(order)
+        level.quantity += max(order.quantity - order.filled, 0)
+        self.resting[order.order_id] = (self, level)
+        self.count += 1
+        if self.traders is not None:
+            self.__index(order)
+        if self.changes is not None:
+            self.changes.add(order.price)
+        return level
+
+    def pop_top(self):
+        """ Remove the order with the highest priority on this side
+
+        :return: The removed order. None if the side is empty.
+        """
+        if self.markets:
+            level = self.markets
+        elif self.queue:
+            level = self.queue[-1]
+        else:
+            return None
+        order = level.pop_head()
+        level.quantity -= max(order.quantity - order.filled, 0)
+        del self.resting[order.order_id]
+        self.count -= 1
+        if self.traders is not None:
+            self.__unindex(order)
+        if self.removed is not None:
+            self.removed.append(order)
+        if self.changes is not None:
+            self.changes.add(level.price)
+        if not level and level is not self.markets:
+            self.keys.pop()
+            self.queue.pop()
+            del self.levels[level.price]
+        return order
+
+    def remove(self, orderid):
+        """ Remove an order resting anywhere on this side
+
+        :param: order id to remove
+        :return: The removed order. None if the order is not on this side.
+        """
+        handle = self.resting.get(orderid)
+        if handle is None or handle[0] is not self:
+            return None
+        return self.remove_from_level(handle[1], orderid)
+
+    def remove_from_level(self, level, orderid):
+        """ Remove an order from a known price level of this side, dropping the level once it is empty
+
+        :param: the PriceLevel holding the order and the order id to remove
+        :return: The removed order. None if the order is not in the level.
+        """
+        order = level.remove(orderid)
+        if order is None:
+            return None
+        level.quantity -= max(order.quantity - order.filled, 0)
+        del self.resting[orderid]
+        self.count -= 1
+        if self.traders is not None:
+            self.__unindex(order)
+        if self.removed is not None:
+            self.removed.append(order)
+        if self.changes is not None:
+            self.changes.add(level.price)
+        if not level and level is not self.markets:
+            i = bisect_left(self.keys, self.__key(level.price))
+            del self.keys[i]
+            del self.queue[i]
+            del self.levels[level.price]
+        return order
+
+    def match(self, order, fills):
+        """ Match an incoming order of the other side against this side in one pass over the levels, best price
+        first. A LIMIT or IOC order trades up to its price with the priced levels and at its own price with resting
+        MARKET orders. A MARKET order trades at any price, with resting MARKET orders at the best priced level.
+        Every fill is written to the fills buffer as three consecutive slots: the resting order, the quantity and the
+        trade price in ticks. The buffer grows when a sweep fills more orders than it holds. Filled orders leave this
+        side.
+
+        :param: the incoming order and the fill buffer
+        :return: The number of fills written to the buffer
+        """
+        limit = order.price
+        buy = order.side is Side.BUY
+        markets = self.markets
+        queue = self.queue
+        resting_index = self.resting
+        changes = self.changes
+        prints = self.prints
+        removed = self.removed
+        traders = self.traders
+        trade_log = self.trade_log
+        remaining = order.quantity - order.filled
+        count = 0
+        while remaining > 0:
+            if markets:
+                level = markets
+            elif queue:
+                level = queue[-1]
+            else:
+                break
+            price = level.price
+            if price is None:
+                # Resting MARKET orders trade at the price of the incoming order, or at the best priced level
+                if limit is not None:
+                    price = limit
+                elif queue:
+                    price = queue[-1].price
+                else:
+                    break
+            elif limit is not None and (limit < price if buy else limit > price):
+                break
+
+            # Take the order at the head of the level. It goes back there if it stays on the book.
+            orders = level.orders
+            orderid, resting = orders.popitem(last=False)
+            resting_remaining = resting.quantity - resting.filled
+            if resting_remaining > 0:
+                quantity = remaining if remaining < resting_remaining else resting_remaining
+                order.filled += quantity
+                resting.filled += quantity
+                remaining -= quantity
+                if prints is not None:
+                    prints.append((price, quantity))
+                if trade_log is not None:
+                    trade_log.append(price, quantity, order, resting)
+            else:
+                # Nothing is left to trade, e.g. for an order amended below its filled quantity. It leaves the book
+                # with a fill of 0.
+                quantity = 0
+            if changes is not None:
+                changes.add(level.price)
+
+            i = 3 * count
+            if i == len(fills):
+                fills.extend([None] * (i or 3))
+            fills[i] = resting
+            fills[i + 1] = quantity
+            fills[i + 2] = price
+            count += 1
+
+            if quantity < resting_remaining:
+                # Partially filled, the order keeps its priority
+                orders[orderid] = resting
+                orders.move_to_end(orderid, last=False)
+                level.quantity -= quantity
+            else:
+                level.quantity -= max(resting_remaining, 0)
+                del resting_index[orderid]
+                self.count -= 1
+                if traders is not None:
+                    self.__unindex(resting)
+                if removed is not None:
+                    removed.append(resting)
+                if not orders and level is not markets:
+                    self.keys.pop()
+                    queue.pop()
+                    del self.levels[price]
+        return count
+
+    def fillable(self, order):
+        """ Check whether an incoming order of the other side with a price would be filled completely, from the totals
+        of the levels up to its price, without matching it
+
+        :param: the incoming order
+        :return: True if this side holds enough quantity at the prices the order trades at
+        """
+        needed = order.quantity - order.filled
+        return self.liquidity_up_to(order.price, needed)[0] >= needed
+
+    def resize(self, order, quantity):
+        """ Change the quantity of an order resting on this side, keeping the quantity of its level up to date
+
+        :param: the resting order and its new quantity
+        """
+        level = self.resting[order.order_id][1]
+        remaining = max(order.quantity - order.filled, 0)
+        order.quantity = quantity
+        level.quantity += max(order.quantity - order.filled, 0) - remaining
+        if self.changes is not None:
+            self.changes.add(level.price)
+
+    def __index(self, order):
+        """ Add a resting order to the orders of its trader
+        """
+        tickers = self.traders.get(order.trader_id)
+        if tickers is None:
+            tickers = self.traders[order.trader_id] = {}
+        orders = tickers.get(order.ticker)
+        if orders is None:
+            orders = tickers[order.ticker] = {}
+        orders[order.order_id] = order
+
+    def __unindex(self, order):
+        """ Remove an order leaving this side from the orders of its trader
+        """
+        tickers = self.traders[order.trader_id]
+        orders = tickers[order.ticker]
+        del orders[order.order_id]
+        if not orders:
+            del tickers[order.ticker]
+            if not tickers:
+                del self.traders[order.trader_id]
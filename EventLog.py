@@ -0,0 +1,257 @@
+import atexit
+from collections import deque
+from enum import Enum
+import os
+import struct
+import sys
+import threading
+import time
+
+
+class LogLevel(Enum):
+    """ Enum for the verbosity of logged events
+    """
+    DEBUG = 10
+    INFO = 20
+    WARNING = 30
+    ERROR = 40
+
+    @classmethod
+    def from_str(cls, level):
+        try:
+            return cls[level.upper()]
+        except KeyError:
+            raise ValueError("Invalid log level: " + level)
+
+
+class EventLog:
+    """ Asynchronous structured log. Logging an event only appends (timestamp, level, message, arguments) to an
+    in-memory ring buffer. A background writer drains the buffer every interval and formats the events there, as text
+    lines on a stream, and as binary records in a capture file if one is open. Once the buffer holds capacity events,
+    the oldest ones are dropped and counted in dropped, so logging never blocks the caller.
+    Messages are %-format strings whose arguments should be numbers, strings or booleans, as they are formatted later.
+    The binary format is MAGIC and VERSION, then records of RECORD followed by the fields of the event. The first
+    record of every message defines its id, with level 0 and the text of the message as its payload.
+    """
+    MAGIC = b'MELG'
+    VERSION = 1
+    HEADER = struct.Struct('!4sB') # magic, version
+    RECORD = struct.Struct('!IQBH') # payload length, timestamp in nanoseconds, level, message id
+    FIELD = struct.Struct('!B') # type of a field: NONE, INT, FLOAT, TEXT or BOOL
+    INT = struct.Struct('!q')
+    FLOAT = struct.Struct('!d')
+    LENGTH = struct.Struct('!I') # length of a UTF-8 text field
+    NONE, INT_FIELD, FLOAT_FIELD, TEXT_FIELD, BOOL_FIELD = range(5)
+
+    def __init__(self, level=LogLevel.INFO, stream=None, capacity=1 << 16, interval=0.05, text=True):
+        self.level = level # Least LogLevel of the events kept
+        self.stream = stream # Text stream the events are written to, None for the current sys.stdout
+        self.text = text # Whether the events are written to the stream, e.g. False to only capture them
+        self.capacity = capacity # Most events waiting for the writer
+        self.interval = interval # Seconds between two drains of the buffer
+        self.dropped = 0 # Number of events dropped as the buffer was full
+        self.__buffer = deque(maxlen=capacity)
+        self.__capture = None # Binary capture file, if any
+        self.__messages = {} # Dictionary of message mapping to its id in the capture file
+        self.__closed = False
+        self.__start()
+        atexit.register(self.close)
+        os.register_at_fork(after_in_child=self.__after_fork)
+
+    @property
+    def level(self):
+        return self.__level
+
+    @level.setter
+    def level(self, level):
+        self.__level = level if isinstance(level, LogLevel) else LogLevel.from_str(level)
+        self.threshold = self.__level._value_ # Read on every event, which is faster than the level
+
+    def __start(self):
+        self.__lock = threading.Lock() # Serializes the drains of the writer thread and of flush
+        self.__wake = threading.Event()
+        self.__thread = threading.Thread(target=self.__write_forever, daemon=True)
+        self.__thread.start()
+
+    def __after_fork(self):
+        """ Give a forked child its own writer thread, without the events of the parent
+        """
+        self.__buffer.clear()
+        self.__capture = None
+        self.__messages = {}
+        if not self.__closed:
+            self.__start()
+
+    def log(self, level, message, *args):
+        """ Log an event if its level is kept
+
+        :param: LogLevel, %-format message and its arguments
+        """
+        if level._value_ >= self.threshold:
+            buffer = self.__buffer
+            if len(buffer) >= self.capacity:
+                self.dropped += 1
+            buffer.append((time.time_ns(), level, message, args))
+
+    def debug(self, message, *args):
+        if self.threshold <= LogLevel.DEBUG._value_:
+            self.log(LogLevel.DEBUG, message, *args)
+
+    def info(self, message, *args):
+        if self.threshold <= LogLevel.INFO._value_:
+            self.log(LogLevel.INFO, message, *args)
+
+    def warning(self, message, *args):
+        if self.threshold <= LogLevel.WARNING._value_:
+            self.log(LogLevel.WARNING, message, *args)
+
+    def error(self, message, *args):
+        self.log(LogLevel.ERROR, message, *args)
+
+    def capture(self, path):
+        """ Also write the events to a binary capture file from now on, replacing the current one
+
+        :param: path of the capture file, None to stop capturing
+        """
+        with self.__lock:
+            self.__drain()
+            if self.__capture is not None:
+                self.__capture.close()
+                self.__capture = None
+            self.__messages = {}
+            if path is not None:
+                self.__capture = open(path, 'wb')
+                self.__capture.write(self.HEADER.pack(self.MAGIC, self.VERSION))
+
+    def flush(self):
+        """ Write the buffered events now
+        """
+        with self.__lock:
+            self.__drain()
+
+    def close(self):
+        """ Write the buffered events and stop the writer
+        """
+        if not self.__closed:
+            self.__closed = True
+            self.__wake.set()
+            self.capture(None)
+
+    def __write_forever(self):
+        while not self.__closed:
+            self.__wake.wait(self.interval)
+            with self.__lock:
+                self.__drain()
+
+    def __drain(self):
+        """ Format and write the buffered events
+        """
+        buffer = self.__buffer
+        events = []
+        try:
+            while True:
+                events.append(buffer.popleft())
+        except IndexError:
+            pass
+        if not events:
+            return
+        stream = self.stream if self.stream is not None else sys.stdout
+        if self.text and stream is not None:
+            lines = []
+            for timestamp, level, message, args in events:
+                seconds, nanoseconds = divmod(timestamp, 1000000000)
+                lines.append("%s.%06d %-7s %s\n" % (time.strftime('%H:%M:%S', time.localtime(seconds)),
+                                                     nanoseconds // 1000, level.name, self.__format(message, args)))
+            try:
+                stream.write(''.join(lines))
+                stream.flush()
+            except (OSError, ValueError):
+                pass # The stream was closed
+        if self.__capture is not None:
+            self.__capture.write(b''.join([self.__encode(event) for event in events]))
+            self.__capture.flush()
+
+    @staticmethod
+    def __format(message, args):
+        if not args:
+            return message
+        try:
+            return message % args
+        except (TypeError, ValueError):
+            return message + ' ' + ' '.join(map(str, args))
+
+    def __encode(self, event):
+        """ Serialize an event to binary records, with the record defining its message the first time
+        """
+        timestamp, level, message, args = event
+        record = b''
+        message_id = self.__messages.get(message)
+        if message_id is None:
+            message_id = self.__messages[message] = len(self.__messages) + 1
+            text = message.encode('utf-8')
+            record = self.RECORD.pack(len(text), timestamp, 0, message_id) + text
+        fields = []
+        for arg in args:
+            if arg is None:
+                fields.append(self.FIELD.pack(self.NONE))
+            elif isinstance(arg, bool):
+                fields.append(self.FIELD.pack(self.BOOL_FIELD) + self.FIELD.pack(arg))
+            elif isinstance(arg, int) and -(1 << 63) <= arg < 1 << 63:
+                fields.append(self.FIELD.pack(self.INT_FIELD) + self.INT.pack(arg))
+            elif isinstance(arg, float):
+                fields.append(self.FIELD.pack(self.FLOAT_FIELD) + self.FLOAT.pack(arg))
+            else:
+                text = str(arg).encode('utf-8')
+                fields.append(self.FIELD.pack(self.TEXT_FIELD) + self.LENGTH.pack(len(text)) + text)
+        payload = b''.join(fields)
+        return record + self.RECORD.pack(len(payload), timestamp, level._value_, message_id) + payload
+
+    @classmethod
+    def read_capture(cls, path):
+        """ Read the events of a binary capture file, stopping at a truncated record
+
+        :param: path of the capture file
+        :return: Generator of (timestamp in nanoseconds, LogLevel, message, arguments tuple)
+        """
+        with open(path, 'rb') as f:
+            data = memoryview(f.read())
+        if len(data) < cls.HEADER.size or cls.HEADER.unpack_from(data) != (cls.MAGIC, cls.VERSION):
+            raise ValueError("Not an event capture: " + path)
+        messages = {}
+        offset = cls.HEADER.size
+        while offset + cls.RECORD.size <= len(data):
+            length, timestamp, level, message_id = cls.RECORD.unpack_from(data, offset)
+            offset += cls.RECORD.size
+            if offset + length > len(data):
+                break
+            payload = data[offset:offset + length]
+            offset += length
+            if not level:
+                messages[message_id] = str(payload, 'utf-8')
+                continue
+            args = []
+            position = 0
+            while position < length:
+                (field,) = cls.FIELD.unpack_from(payload, position)
+                position += cls.FIELD.size
+                if field == cls.INT_FIELD:
+                    args.append(cls.INT.unpack_from(payload, position)[0])
+                    position += cls.INT.size
+                elif field == cls.FLOAT_FIELD:
+                    args.append(cls.FLOAT.unpack_from(payload, position)[0])
+                    position += cls.FLOAT.size
+                elif field == cls.BOOL_FIELD:
+                    args.append(bool(payload[position]))
+                    position += cls.FIELD.size
+                elif field == cls.TEXT_FIELD:
+                    (size,) = cls.LENGTH.unpack_from(payload, position)
+                    position += cls.LENGTH.size
+                    args.append(str(payload[position:position + size], 'utf-8'))
+                    position += size
+                else:
+                    args.append(None)
+            yield timestamp, LogLevel(level), messages[message_id], tuple(args)
+
+
+# Log shared by every module of the exchange
+log = EventLog()
@@ -1,71 +1,229 @@
-from datetime import datetime
+from concurrent.futures import Future
+import itertools
+import queue
 import socket
-from MatchingEngine import MatchingEngine
+import threading
+from CommandType import CommandType
+from EventLog import log
+from ExchangeProtocol import ExchangeProtocol
 from ExchangeRequest import ExchangeRequest, ExchangeRequestType
 from ExchangeResponse import ExchangeResponse
 from Order import Order
 from OrderType import OrderType
 from Side import Side
+from TickTable import TickTable
+from WireCodec import BinaryCodec, WireCodec
 
 
 class ExchangeClient:
-    __slots__ = ['__server_host', '__server_port', '__trader_id']
+    """ Client keeping one long-lived session with the ExchangeServer. Requests are framed and correlated with their
+    responses by request id, so several threads can have requests in flight on the same session.
+    The server pushes the execution reports of the orders of the trader on the session, and the client hands them to
+    its report listeners, so there is no need to poll get_order.
+    """
+    __slots__ = ['__server_host', '__server_port', '__trader_id', '__tick_table', '__sock', '__send_lock',
+                 '__pending', '__request_ids', '__codecs', '__codec', '__listeners']
 
-    def __init__(self, trader_id, server_host='localhost', server_port=9999):
+    def __init__(self, trader_id, server_host='localhost', server_port=9999, tick_table=None,
+                 codecs=(BinaryCodec.CODEC_ID,)):
         self.__trader_id = trader_id
         self.__server_host = server_host
         self.__server_port = server_port
+        self.__tick_table = tick_table if tick_table is not None else TickTable() # Converts decimal prices to ticks
+        self.__sock = None # Session socket, opened by the first request
+        self.__send_lock = threading.Lock() # Serializes writes of whole frames on the session
+        self.__pending = {} # Dictionary of request id mapping to the Future waiting for its response
+        self.__request_ids = itertools.count(1)
+        self.__codecs = codecs # Ids of the wire codecs offered to the server, in order of preference
+        self.__codec = None # Codec agreed with the server for the current session
+        self.__listeners = [] # Functions called with the report type and the ExecutionReport of every pushed report
 
-    def __transmit(self, exchange_request):
-        """ Transmit an ExchangeRequest and return the server's ExchangeResponse
-        """
-        # connect to server
-        with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as sock:
-            sock.connect((self.__server_host, self.__server_port))
+    def __enter__(self):
+        self.connect()
+        return self
 
-            # Transmit request
-            sock.sendall(bytes(exchange_request.dump() + "\n", 'ascii'))
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+    def connect(self):
+        """ Open the session with the server if it is not open yet
+        """
+        with self.__send_lock:
+            if self.__sock is None:
+                sock = socket.create_connection((self.__server_host, self.__server_port))
+                sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+                # Agree on the codec of the session before sending any request
+                try:
+                    ExchangeProtocol.send_frame(sock, WireCodec.dump_hello(self.__codecs))
+                    chosen = WireCodec.load_hello(ExchangeProtocol.recv_frame(sock) or b'')
+                    if not chosen:
+                        raise ConnectionError("No wire codec in common with the server")
+                except Exception:
+                    sock.close()
+                    raise
+                self.__codec = WireCodec.get(chosen[0])
+                self.__sock = sock
+                threading.Thread(target=self.__read_responses, args=(sock,), daemon=True).start()
 
-            # Recieve response
-            data = str(sock.recv(4096), 'ascii').strip()
-            response = None
+    def close(self):
+        """ Close the session. Requests still waiting for a response fail with a ConnectionError.
+        """
+        with self.__send_lock:
+            sock, self.__sock = self.__sock, None
+        if sock is not None:
             try:
-                response = ExchangeResponse.load(data)
-                return response
-            except Exception:
-                return response
+                sock.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+            sock.close()
+
+    def __read_responses(self, sock):
+        """ Deliver every response read from the session to the request waiting for it
+        """
+        try:
+            while True:
+                data = ExchangeProtocol.recv_frame(sock)
+                if data is None:
+                    break
+                response = self.__codec.decode_response(data)
+                if response.report_type is not None:
+                    for listener in list(self.__listeners):
+                        listener(response.report_type, response.order)
+                    continue
+                future = self.__pending.pop(response.request_id, None)
+                if future is not None:
+                    future.set_result(response)
+        except (OSError, ValueError):
+            pass
+        finally:
+            with self.__send_lock:
+                if self.__sock is sock:
+                    self.__sock = None
+            sock.close()
+            for request_id in list(self.__pending):
+                future = self.__pending.pop(request_id, None)
+                if future is not None:
+                    future.set_exception(ConnectionError("Session with the server closed"))
+            for listener in list(self.__listeners):
+                listener(None, None)
+
+    def add_report_listener(self, listener):
+        """ Call a function with the report type and the ExecutionReport of every execution report pushed by the server.
+        It runs on the thread reading the session, and is called with (None, None) when the session closes.
+        """
+        self.__listeners.append(listener)
+
+    def remove_report_listener(self, listener):
+        self.__listeners.remove(listener)
+
+    def reports(self):
+        """ Follow the execution reports pushed from now on
+
+        :return: A ReportFeed iterating over (ReportType, ExecutionReport) tuples until the session closes
+        """
+        return ReportFeed(self)
+
+    def send_request(self, exchange_request):
+        """ Send an ExchangeRequest without waiting for the response
+
+        :param: an ExchangeRequest
+        :return: A Future resolving to the server's ExchangeResponse
+        """
+        self.connect()
+        future = Future()
+        exchange_request.request_id = next(self.__request_ids)
+        self.__pending[exchange_request.request_id] = future
+        try:
+            with self.__send_lock:
+                if self.__sock is None:
+                    raise ConnectionError("Session with the server closed")
+                ExchangeProtocol.send_frame(self.__sock, self.__codec.encode_request(exchange_request))
+        except OSError:
+            self.__pending.pop(exchange_request.request_id, None)
+            raise
+        return future
+
+    def __transmit(self, exchange_request):
+        """ Transmit an ExchangeRequest and return the server's ExchangeResponse
+        """
+        try:
+            return self.send_request(exchange_request).result()
+        except Exception:
+            return None
 
     def submit_order(self, order_type, order_side, ticker, quantity, price=None):
-        """ Submit and order, return the order_id
+        """ Submit and order, return the order_id, or None if the order was rejected or the request failed. The price is
+        a decimal price of the ticker.
         """
         req = ExchangeRequest(ExchangeRequestType.SUBMIT, self.__trader_id, order_type=order_type,
-                              order_side=order_side, ticker=ticker, quantity=quantity, price=price)
+                              order_side=order_side, ticker=ticker, quantity=quantity,
+                              price=self.__tick_table.to_ticks(ticker, price))
         resp = self.__transmit(req)
-        if resp:
-            self.print_repsonse(resp)
+        # The success of a submitted order is whether it was filled. A rejected or failed request has no order.
+        if resp and resp.order is not None:
+            log.debug("SUBMIT order %d of trader %d: %s, %d of %d filled", resp.order.order_id, self.__trader_id,
+                      resp.success, resp.order.filled, resp.order.quantity)
             return resp.order.order_id
         else:
-            print("Failed to deserialize!!!")
+            log.error("SUBMIT request of trader %d failed", self.__trader_id)
             return None
 
 
+    def submit_batch(self, commands):
+        """ Submit a batch of commands handled by the engine in one pass, in order. The commands are
+        (CommandType.NEW, order_type, order_side, ticker, quantity, price), (CommandType.AMEND, order_id, new_quantity)
+        and (CommandType.CANCEL, order_id) tuples, with decimal prices of the tickers.
+        Return the list of (success, order_id) of each command, with no order id for a rejected order, or None if the
+        batch failed
+        """
+        requests = []
+        for command in commands:
+            if command[0] is CommandType.NEW:
+                order_type, order_side, ticker, quantity, price = command[1:]
+                requests.append(ExchangeRequest(ExchangeRequestType.SUBMIT, self.__trader_id, order_type=order_type,
+                                                order_side=order_side, ticker=ticker, quantity=quantity,
+                                                price=self.__tick_table.to_ticks(ticker, price)))
+            elif command[0] is CommandType.AMEND:
+                requests.append(ExchangeRequest(ExchangeRequestType.AMEND, self.__trader_id, order_id=command[1],
+                                                quantity=command[2]))
+            elif command[0] is CommandType.CANCEL:
+                requests.append(ExchangeRequest(ExchangeRequestType.CANCEL, self.__trader_id, order_id=command[1]))
+            else:
+                raise ValueError("Bad command type: " + str(command[0]))
+        resp = self.__transmit(ExchangeRequest(ExchangeRequestType.SUBMIT_BATCH, self.__trader_id,
+                                               commands=requests))
+        if resp and resp.success:
+            return resp.results
+        return None
+
     def amend_order(self, order_id, new_quantity=None, new_price=None):
         """ Amend a previously submitted order, return true on success, else return false
         """
         req = ExchangeRequest(ExchangeRequestType.AMEND, self.__trader_id,
                               order_id=order_id, quantity=new_quantity, price=new_price)
         resp = self.__transmit(req)
-        return resp.success
+        return bool(resp and resp.success)
 
     def cancel_order(self, order_id):
         """ Cancel a previously submitted order, return true on success, else return false
         """
         req = ExchangeRequest(ExchangeRequestType.CANCEL, self.__trader_id, order_id=order_id)
         resp = self.__transmit(req)
-        return resp.success
+        return bool(resp and resp.success)
+
+    def cancel_all(self, ticker=None):
+        """ Cancel every resting order of the trader, or only its orders on one ticker, in one request.
+        Return the list of the cancelled order ids, or None if the request failed
+        """
+        req = ExchangeRequest(ExchangeRequestType.CANCEL_ALL, self.__trader_id, ticker=ticker)
+        resp = self.__transmit(req)
+        if resp and resp.success:
+            return [order_id for success, order_id in resp.results]
+        return None
 
     def get_order(self, order_id):
-        """ Get a previously submitted order, return the order object
+        """ Get a previously submitted order, return its ExecutionReport
         """
         req = ExchangeRequest(ExchangeRequestType.GET, self.__trader_id, order_id=order_id)
         resp = self.__transmit(req)
@@ -74,19 +232,57 @@ class ExchangeClient:
         else:
             return None
 
-    def print_repsonse(self, resp):
-        """ Print the returned order from the response
-        """
-        print("Response: (result=%s)" % "SUCCESS" if resp.success else "FAIL")
-        if resp.order:
-            o = resp.order
-            print("\torder_id:  %s" % o.order_id)
-            print("\ttrader_id: %s" % o.trader_id)
-            print("\tquantity:  %d" % o.quantity)
-            print("\ttimestamp: %s" % str(o.timestamp))
-            print("\tside:      %s" % str(o.side))
-            print("\tordertype: %s" % str(o.ordertype))
-            print("\tticker:    %s" % o.ticker)
-            print("\tfilled:    %d" % o.filled)
-            print("\tis_executed: %s" % str(o.is_executed))
+    def get_stats(self):
+        """ Get the latency and throughput statistics of the server, see LatencyStats.report(). Return None if the
+        server does not keep them.
+        """
+        req = ExchangeRequest(ExchangeRequestType.STATS, self.__trader_id)
+        resp = self.__transmit(req)
+        if resp and resp.success:
+            return resp.stats
+        return None
+
 
+class ReportFeed:
+    """ Queue of the execution reports pushed to an ExchangeClient, iterated over as (ReportType, ExecutionReport)
+    tuples until the session closes
+    """
+    def __init__(self, client):
+        self.__client = client
+        self.__reports = queue.SimpleQueue()
+        self.__closed = False
+        client.add_report_listener(self.__put)
+
+    def __put(self, report_type, report):
+        self.__reports.put((report_type, report))
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        report = self.get()
+        if report is None:
+            raise StopIteration
+        return report
+
+    def get(self, timeout=None):
+        """ Wait for the next report
+
+        :param: most seconds to wait, None to wait forever
+        :return: The next (ReportType, ExecutionReport), or None once the session is closed. It raises queue.Empty if
+                 no report arrives in time.
+        """
+        if self.__closed:
+            return None
+        report_type, report = self.__reports.get(timeout=timeout)
+        if report_type is None:
+            self.close()
+            return None
+        return report_type, report
+
+    def close(self):
+        """ Stop following the reports
+        """
+        if not self.__closed:
+            self.__closed = True
+            self.__client.remove_report_listener(self.__put)
@@ -0,0 +1,83 @@
+import asyncio
+import struct
+
+class ExchangeProtocol:
+    """ Length-prefixed framing shared by ExchangeServer and ExchangeClient. Every message on a session is a 4-byte
+    big-endian payload length followed by the payload.
+    """
+    HEADER = struct.Struct('!I')
+    MAX_FRAME = 16 * 1024 * 1024 # Largest accepted payload in bytes
+
+    @classmethod
+    def send_frame(cls, sock, payload):
+        """ Send one framed payload on a socket
+
+        :param: connected socket and payload bytes
+        """
+        sock.sendall(cls.frame(payload))
+
+    @classmethod
+    def frame(cls, payload):
+        """ Prefix a payload with its length
+
+        :param: payload bytes
+        :return: The bytes of the frame
+        """
+        if len(payload) > cls.MAX_FRAME:
+            raise ValueError("Frame of %d bytes exceeds the maximum frame size" % len(payload))
+        return cls.HEADER.pack(len(payload)) + payload
+
+    @classmethod
+    def recv_frame(cls, sock):
+        """ Receive one framed payload from a socket
+
+        :param: connected socket
+        :return: The payload bytes, or None if the peer closed the session
+        """
+        header = cls.__recv_exactly(sock, cls.HEADER.size)
+        if header is None:
+            return None
+        (length,) = cls.HEADER.unpack(header)
+        if length > cls.MAX_FRAME:
+            raise ValueError("Frame of %d bytes exceeds the maximum frame size" % length)
+        payload = cls.__recv_exactly(sock, length)
+        if payload is None:
+            raise ConnectionError("Session closed in the middle of a frame")
+        return payload
+
+    @classmethod
+    async def read_frame(cls, reader):
+        """ Receive one framed payload from an asyncio stream
+
+        :param: asyncio.StreamReader of the session
+        :return: The payload bytes, or None if the peer closed the session
+        """
+        try:
+            header = await reader.readexactly(cls.HEADER.size)
+        except asyncio.IncompleteReadError as e:
+            if not e.partial:
+                return None
+            raise ConnectionError("Session closed in the middle of a frame")
+        (length,) = cls.HEADER.unpack(header)
+        if length > cls.MAX_FRAME:
+            raise ValueError("Frame of %d bytes exceeds the maximum frame size" % length)
+        try:
+            return await reader.readexactly(length)
+        except asyncio.IncompleteReadError:
+            raise ConnectionError("Session closed in the middle of a frame")
+
+    @staticmethod
+    def __recv_exactly(sock, size):
+        """ Read exactly size bytes from a socket, None if the peer closed the session before sending any byte
+        """
+        buf = bytearray(size)
+        view = memoryview(buf)
+        received = 0
+        while received < size:
+            n = sock.recv_into(view[received:])
+            if n == 0:
+                if received == 0:
+                    return None
+                raise ConnectionError("Session closed in the middle of a frame")
+            received += n
+        return bytes(buf)
@@ -11,13 +11,17 @@ class ExchangeRequestType(Enum):
     AMEND = 2
     CANCEL = 3
     GET = 4
+    SUBMIT_BATCH = 5
+    STATS = 6
+    CANCEL_ALL = 7
 
 class ExchangeRequest():
     __slots__ = ["request_type", "trader_id", "order_id", "symbol", "order_type",
-                 "order_side", "ticker", "quantity", "price"]
+                 "order_side", "ticker", "quantity", "price", "request_id", "commands"]
 
     def __init__(self, request_type, trader_id, order_id=None, order_type=None,
-                 order_side=None, ticker=None, quantity=None, price=None):
+                 order_side=None, ticker=None, quantity=None, price=None, request_id=None, commands=None):
+        self.request_id = request_id # Id correlating the request with its response on a session
         self.request_type = request_type
         self.trader_id = trader_id
         self.order_id = order_id
@@ -25,17 +29,17 @@ class ExchangeRequest():
         self.order_side = order_side
         self.ticker = ticker
         self.quantity = quantity
-        self.price = price
+        self.price = price # Price in integer ticks of the ticker
+        self.commands = commands # SUBMIT, AMEND and CANCEL requests of a SUBMIT_BATCH request, in sequence order
 
     def dump(self):
-        """ Serialize this ExchangeRequest to a string
+        """ Serialize this ExchangeRequest to bytes
         """
-        data = base64.b64encode(pickle.dumps(self)).decode('ascii')
-        return data
+        return base64.b64encode(pickle.dumps(self))
 
     @classmethod
     def load(cls, data):
-        """ Deserialize an ExchangeRequest from a string
+        """ Deserialize an ExchangeRequest from bytes
         """
         req = pickle.loads(base64.b64decode(data))
 
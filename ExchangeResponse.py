@@ -6,21 +6,25 @@ from Order import Order
 class ExchangeResponse():
     """ Wrapper class for submitted data
     """
-    __slots__ = ["success", "order"]
+    __slots__ = ["success", "order", "request_id", "results", "report_type", "stats"]
 
-    def __init__(self, success:bool, order:Order):
+    def __init__(self, success:bool, order:Order, request_id=None, results=None, report_type=None, stats=None):
         self.success = success
         self.order = order
+        self.request_id = request_id # Id of the request this response answers
+        self.results = results # List of (success, order id) of each command of a SUBMIT_BATCH request, or of each
+                               # order a CANCEL_ALL request cancelled
+        self.report_type = report_type # ReportType of an execution report pushed without a request, else None
+        self.stats = stats # LatencyStats.report() of a STATS request
 
     def dump(self):
-        """ Serialize this ExchangeResponse to a BASE64 string
+        """ Serialize this ExchangeResponse to BASE64 bytes
         """
-        data = base64.b64encode(pickle.dumps(self)).decode('ascii')
-        return data
+        return base64.b64encode(pickle.dumps(self))
 
     @classmethod
     def load(cls, data):
-        """ Deserialize an ExchangeResponse from a BASE64 string
+        """ Deserialize an ExchangeResponse from BASE64 bytes
         """
         req = pickle.loads(base64.b64decode(data))
 
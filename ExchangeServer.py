@@ -1,78 +1,178 @@
-from datetime import datetime
+import queue
+import socket
 import socketserver
 import threading
+import time
 import pprint
-from uuid import uuid4
 
-from ExchangeRequest import ExchangeRequest, ExchangeRequestType
+from EventLog import log
+from ExchangeProtocol import ExchangeProtocol
 from ExchangeResponse import ExchangeResponse
-from MatchingEngine import MatchingEngine
-from Order import Order
+from ExchangeService import ExchangeService
+from LatencyStats import LatencyStats
+from WireCodec import BinaryCodec, WireCodec
 
 
 class ExchangeHandler(socketserver.BaseRequestHandler):
-    """ Server class that handles different submission requests from traders
+    """ Server class that serves the requests of one trader session until the trader disconnects.
+    Its responses and the execution reports pushed to it are sent by a writer thread of the session from a bounded
+    queue, so a trader that does not read only holds up its own session. A session whose queue fills up with pushed
+    reports has fallen too far behind and is disconnected.
      """
+    def setup(self):
+        self.codec = None # Codec agreed with the trader
+        self.closed = False # Whether the session stopped taking reports
+        self.outbox = queue.Queue(self.server.outbox_size) # Encoded messages waiting for the writer thread, None to
+                                                           # stop it
+        self.writer = None # Writer thread of the session
+        # Send every frame at once, as a response written right after a pushed report would otherwise wait for the
+        # delayed acknowledgement of the report
+        self.request.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+    def push(self, response, request_type=None):
+        """ Queue a response of the session, waiting while the queue is full
+
+        :param: the ExchangeResponse, and the ExchangeRequestType of the request it answers to time its encoding and
+                its handing over to the writer
+        """
+        stats = self.server.stats
+        if stats is None or request_type is None:
+            self.outbox.put(self.codec.encode_response(response))
+            return
+        start = time.perf_counter_ns()
+        data = self.codec.encode_response(response)
+        encoded = time.perf_counter_ns()
+        self.outbox.put(data)
+        stats.record('encode', request_type, encoded - start)
+        stats.record('send', request_type, time.perf_counter_ns() - encoded)
+
+    def push_report(self, report):
+        """ Queue an execution report without waiting, as the engine lock is held, disconnecting the session if its
+        queue is full
+
+        :param: the ExchangeResponse of the report
+        """
+        if self.closed:
+            return
+        try:
+            self.outbox.put_nowait(self.codec.encode_response(report))
+        except queue.Full:
+            log.warning("Disconnecting a session %d frames behind", self.outbox.maxsize)
+            self.abort()
+
+    def abort(self):
+        """ Shut the connection down, which also stops the reads of the session
+        """
+        self.closed = True
+        try:
+            self.request.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+
+    def write_forever(self):
+        """ Send the queued frames of the session until it stops
+        """
+        outbox = self.outbox
+        try:
+            while True:
+                data = outbox.get()
+                if data is None:
+                    return
+                ExchangeProtocol.send_frame(self.request, data)
+        except OSError:
+            self.abort()
+        # Keep taking the frames nobody will get, so that the session never waits on a full queue
+        while outbox.get() is not None:
+            pass
+
     def handle(self: socketserver.BaseRequestHandler):
-        print("Handling incoming request... ", end='')
-
-        # Parse incoming request
-        data = self.request.recv(4096).strip()
-        request = ExchangeRequest.load(data)
-
-        # Create the matching engine
-        matching_engine = self.server.get_matching_engine()
-
-        # Handle request
-        if request.request_type is ExchangeRequestType.SUBMIT:
-            # Submit order and send the response
-            new_order = Order(request.trader_id, str(uuid4()), request.quantity,
-                              datetime.now(), request.order_side, request.ticker,
-                              request.order_type, request.price)
-            print("SUBMIT %s" % new_order.order_id)
-
-            response = matching_engine.handle_order(new_order)
-            print("RESPONSE OF HANDLE ORDER", response)
-            resp = ExchangeResponse(response, new_order).dump()
-            self.request.sendall(bytes(resp + "\n", 'ascii'))
-
-        elif request.request_type is ExchangeRequestType.AMEND:
-            # Amend order and send the response
-            print("AMEND %s" % request.order_id)
-            result = matching_engine.amend_order(request.order_id, request.quantity)
-            resp = ExchangeResponse(result, None).dump()
-            self.request.sendall(bytes(resp + "\n", 'ascii'))
-
-        elif request.request_type is ExchangeRequestType.CANCEL:
-            # Cancel order and send the response
-            print("CANCEL %s" % request.order_id)
-            result = matching_engine.cancel_order(request.order_id)
-            resp = ExchangeResponse(result, None).dump()
-            self.request.sendall(bytes(resp + "\n", 'ascii'))
-
-        elif request.request_type is ExchangeRequestType.GET:
-            # Get order and send the response
-            result = matching_engine.get_order(request.order_id)
-            if result:
-                resp = ExchangeResponse(True, result).dump()
-                self.request.sendall(bytes(resp + "\n", 'ascii'))
-            else:
-                resp = ExchangeResponse(False, None).dump()
-                self.request.sendall(bytes(resp + "\n", 'ascii'))
+        log.info("Opening session from %s", self.client_address[0])
+        try:
+            # Agree on the codec of the session, closing it if there is none in common
+            codec_id = WireCodec.choose(WireCodec.load_hello(ExchangeProtocol.recv_frame(self.request) or b''),
+                                        self.server.codecs)
+            ExchangeProtocol.send_frame(self.request, WireCodec.dump_hello([codec_id] if codec_id else []))
+            if codec_id is None:
+                return
+            self.codec = WireCodec.get(codec_id)
+            self.writer = threading.Thread(target=self.write_forever, daemon=True)
+            self.writer.start()
+
+            while True:
+                # Parse incoming request
+                data = ExchangeProtocol.recv_frame(self.request)
+                if data is None:
+                    break
+                stats = self.server.stats
+                if stats is None:
+                    request = self.codec.decode_request(data)
+                else:
+                    start = time.perf_counter_ns()
+                    request = self.codec.decode_request(data)
+                    stats.record('decode', request.request_type, time.perf_counter_ns() - start)
+
+                # Handle request and send the response with the id of the request
+                response = self.server.execute_request(request, self)
+                response.request_id = request.request_id
+                self.push(response, request.request_type)
+        except (ConnectionError, ValueError, OSError):
+            pass
+        finally:
+            self.server.close_session(self)
+            if self.writer is not None:
+                # The writer sends the responses still queued first
+                self.outbox.put(None)
+                self.writer.join()
 
 
 class ThreadedTCPServer(socketserver.ThreadingMixIn, socketserver.TCPServer):
-    pass
+    daemon_threads = True # Open trader sessions do not keep the process alive
+    allow_reuse_address = True
 
 
 class ExchangeServer(ThreadedTCPServer):
-    __slots__ = ['__matching_engine']
+    __slots__ = ['__service', '__engine_lock', 'codecs', 'outbox_size', 'stats']
 
-    def __init__(self, host="localhost", port=9999):
+    def __init__(self, host="localhost", port=9999, codecs=(BinaryCodec.CODEC_ID,), matching_engine=None,
+                 instrument=False, outbox_size=4096):
         super().__init__((host, port), ExchangeHandler)
-        self.__matching_engine = MatchingEngine()
-        print("Starting ExchangeServer...")
+        self.stats = LatencyStats() if instrument else None # Latency and throughput statistics, served to STATS requests
+        self.__service = ExchangeService(matching_engine, self.stats)
+        self.__engine_lock = threading.Lock()
+        self.codecs = codecs # Ids of the wire codecs sessions may use. The pickle codec is only safe with trusted peers.
+        self.outbox_size = outbox_size # Most frames waiting to be sent on a session before it is disconnected
+        log.info("Starting ExchangeServer on port %d", self.server_address[1])
 
     def get_matching_engine(self):
-        return self.__matching_engine
-
+        return self.__service.get_matching_engine()
+
+    def execute_request(self, request, session=None):
+        """ Run a request against the matching engine. Session threads take turns, as the engine is not thread-safe.
+        The execution reports of the request are queued on their sessions before the next request runs, so they keep
+        the engine order, and the writers of the sessions send them once the lock is released.
+
+        :param: an ExchangeRequest and the ExchangeHandler of the session sending it
+        :return: The ExchangeResponse to send back
+        """
+        # Sessions queue for the engine lock
+        queued = time.perf_counter_ns() if self.stats is not None else 0
+        with self.__engine_lock:
+            if self.stats is not None:
+                self.stats.record('queue', request.request_type, time.perf_counter_ns() - queued)
+            if session is not None:
+                self.__service.subscribe(request.trader_id, session)
+            try:
+                response = self.__service.execute_request(request)
+            except Exception as e:
+                log.error("Failed %s request: %s", request.request_type.name, e)
+                response = ExchangeResponse(False, None)
+            self.__service.commit()
+            for report_session, report in self.__service.take_reports():
+                report_session.push_report(report)
+            return response
+
+    def close_session(self, session):
+        """ Stop pushing execution reports to a closed session
+        """
+        with self.__engine_lock:
+            self.__service.unsubscribe(session)
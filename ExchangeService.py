@@ -0,0 +1,172 @@
+import time
+
+from CommandType import CommandType
+from EventLog import log
+from ExchangeRequest import ExchangeRequestType
+from ExchangeResponse import ExchangeResponse
+from MatchingEngine import MatchingEngine
+
+
+class ExchangeService:
+    """ Class runs decoded exchange requests against a matching engine. It is shared by the server front ends.
+    It also routes the execution reports of the engine to the sessions of the traders owning the orders. A session is
+    any object of the server front end, subscribed with the trader id of each request it sends.
+    With a LatencyStats, it times every request against the engine and counts the requests of each ticker.
+    """
+    def __init__(self, matching_engine=None, stats=None):
+        self.__matching_engine = matching_engine if matching_engine is not None else MatchingEngine()
+        self.stats = stats # LatencyStats of the server, None not to keep statistics
+        self.__matching_engine.reports = [] # Collect the execution reports of every command
+        self.__sessions = {} # Dictionary of trader id mapping to the list of its sessions
+        self.__session_traders = {} # Dictionary of session mapping to the set of trader ids it is subscribed to
+
+    def get_matching_engine(self):
+        return self.__matching_engine
+
+    def commit(self):
+        """ Make the journaled commands durable. Servers call it before sending the responses of the requests.
+        """
+        journal = getattr(self.__matching_engine, 'journal', None)
+        if journal is not None:
+            journal.commit()
+
+    def subscribe(self, trader_id, session):
+        """ Send the execution reports of the orders of a trader to a session
+        """
+        traders = self.__session_traders.setdefault(session, set())
+        if trader_id not in traders:
+            traders.add(trader_id)
+            self.__sessions.setdefault(trader_id, []).append(session)
+
+    def unsubscribe(self, session):
+        """ Stop sending execution reports to a closed session
+        """
+        for trader_id in self.__session_traders.pop(session, ()):
+            sessions = self.__sessions[trader_id]
+            sessions.remove(session)
+            if not sessions:
+                del self.__sessions[trader_id]
+
+    def take_reports(self):
+        """ Take the execution reports of the requests run since the last call
+
+        :return: List of (session, ExchangeResponse) of every report to push, in the order the engine generated them
+        """
+        reports = self.__matching_engine.reports
+        if not reports:
+            return []
+        pushes = []
+        for report_type, report in reports:
+            for session in self.__sessions.get(report.trader_id, ()):
+                pushes.append((session, ExchangeResponse(True, report, 0, report_type=report_type)))
+        reports.clear()
+        return pushes
+
+    def execute_request(self, request):
+        """ Run a request against the matching engine
+
+        :param: an ExchangeRequest
+        :return: The ExchangeResponse to send back
+        """
+        stats = self.stats
+        if stats is None:
+            return self.__execute(request)
+        # Tickers are looked up first, as cancelled orders leave order_tickers
+        tickers = self.__tickers(request)
+        start = time.perf_counter_ns()
+        response = self.__execute(request)
+        stats.record('match', request.request_type, time.perf_counter_ns() - start)
+        for ticker in tickers:
+            stats.count(ticker)
+        return response
+
+    def __tickers(self, request):
+        """ Get the tickers of the orders of a request
+        """
+        request_type = request.request_type
+        if request_type is ExchangeRequestType.SUBMIT:
+            return [request.ticker]
+        elif request_type is ExchangeRequestType.AMEND or request_type is ExchangeRequestType.CANCEL:
+            ticker = self.__matching_engine.order_tickers.get(request.order_id)
+            return [ticker] if ticker is not None else []
+        elif request_type is ExchangeRequestType.SUBMIT_BATCH:
+            return [ticker for command in request.commands for ticker in self.__tickers(command)]
+        elif request_type is ExchangeRequestType.CANCEL_ALL:
+            return [request.ticker] if request.ticker is not None else []
+        return []
+
+    def __execute(self, request):
+        """ Run a request against the matching engine
+        """
+        # Get the matching engine
+        matching_engine = self.get_matching_engine()
+
+        if request.request_type is ExchangeRequestType.SUBMIT:
+            # Submit order and send the response
+            new_order = matching_engine.create_order(request.trader_id, request.quantity, request.order_side,
+                                                     request.ticker, request.order_type, request.price)
+            response = matching_engine.handle_order(new_order)
+            log.debug("SUBMIT order %d: %s", new_order.order_id, response)
+            if response is None:
+                # The order was rejected before reaching the engine, e.g. by a RiskGate
+                return ExchangeResponse(False, None)
+            return ExchangeResponse(response, new_order)
+
+        elif request.request_type is ExchangeRequestType.AMEND:
+            # Amend order and send the response
+            result = matching_engine.amend_order(request.order_id, request.quantity)
+            log.debug("AMEND order %d: %s", request.order_id, result)
+            return ExchangeResponse(result, None)
+
+        elif request.request_type is ExchangeRequestType.CANCEL:
+            # Cancel order and send the response
+            result = matching_engine.cancel_order(request.order_id)
+            log.debug("CANCEL order %d: %s", request.order_id, result)
+            return ExchangeResponse(result, None)
+
+        elif request.request_type is ExchangeRequestType.GET:
+            # Get order and send the response
+            result = matching_engine.get_order(request.order_id)
+            if result:
+                return ExchangeResponse(True, result)
+            else:
+                return ExchangeResponse(False, None)
+
+        elif request.request_type is ExchangeRequestType.SUBMIT_BATCH:
+            # Run all the commands of the batch in one engine pass and send back the result of each one
+            log.debug("SUBMIT_BATCH of %d commands", len(request.commands))
+            commands = []
+            order_ids = []
+            for command in request.commands:
+                if command.request_type is ExchangeRequestType.SUBMIT:
+                    new_order = matching_engine.create_order(command.trader_id, command.quantity, command.order_side,
+                                                             command.ticker, command.order_type, command.price)
+                    commands.append((CommandType.NEW, new_order))
+                    order_ids.append(new_order.order_id)
+                elif command.request_type is ExchangeRequestType.AMEND:
+                    commands.append((CommandType.AMEND, command.order_id, command.quantity))
+                    order_ids.append(command.order_id)
+                elif command.request_type is ExchangeRequestType.CANCEL:
+                    commands.append((CommandType.CANCEL, command.order_id))
+                    order_ids.append(command.order_id)
+                else:
+                    return ExchangeResponse(False, None)
+            results = matching_engine.handle_orders(commands)
+            # A rejected order has no order id
+            return ExchangeResponse(True, None, results=[(result, order_id if result is not None else None)
+                                                         for result, order_id in zip(results, order_ids)])
+
+        elif request.request_type is ExchangeRequestType.CANCEL_ALL:
+            # Cancel the resting orders of the trader, on one ticker or on all of them, and send back their ids
+            orderids = matching_engine.cancel_all(request.trader_id, request.ticker)
+            log.debug("CANCEL_ALL of trader %d: %d orders", request.trader_id, len(orderids))
+            return ExchangeResponse(True, None, results=[(True, orderid) for orderid in orderids])
+
+        elif request.request_type is ExchangeRequestType.STATS:
+            # Send back the latency and throughput statistics, if the server keeps them
+            if self.stats is None:
+                return ExchangeResponse(False, None)
+            return ExchangeResponse(True, None, stats=self.stats.report())
+
+        return ExchangeResponse(False, None)
+
@@ -1,7 +1,7 @@
 from collections import deque
 from uuid import uuid4 as id
+import queue
 import threading
-import time
 import numpy as np
 from Side import Side
 from OrderType import OrderType
@@ -9,16 +9,18 @@ from Order import Order
 from datetime import datetime
 from CommandType import CommandType
 from MatchingEngine import MatchingEngine
-from ExchangeServer import ExchangeServer
+from AsyncExchangeServer import AsyncExchangeServer
 from ExchangeClient import ExchangeClient
+from EventLog import LogLevel, log
+from ExecutionReport import ReportType
+from TickTable import TickTable
 
 # Set constants for the order generation
 price_limit = 1000
 quantity_limit = 100
 traded_tickers = ['FB', 'GOOG', 'AAPL']
 traders_limit = 100
-
-lock = threading.Lock()
+tick_table = TickTable()
 
 class Trader (threading.Thread):
     """ Class to save Trader attributes
@@ -26,7 +28,7 @@ class Trader (threading.Thread):
     def __init__(self, trader_id):
         threading.Thread.__init__(self)
         self.trader_id = trader_id
-        self.balance_history = [1000000] # List of pnl changes after each request
+        self.balance_history = [tick_table.to_units(1000000)] # List of pnl changes after each request, in the smallest currency unit
         self.total_balance = self.balance_history[0]
         self.current_outstanding_order = None
 
@@ -37,85 +39,66 @@ class Trader (threading.Thread):
         return self.total_balance
 
     def run(self):
-        print("Starting trader id#: " + str(self.trader_id))
-        # Create an ExchangeClient for the trader
-        client = ExchangeClient(trader_id=self.trader_id)
+        log.info("Starting trader id#: %d", self.trader_id)
+        # Create an ExchangeClient for the trader. Every request of the trader reuses its session.
+        client = ExchangeClient(trader_id=self.trader_id, tick_table=tick_table)
+        reports = client.reports()
 
         while self.total_balance > 0:
             # Create a trader command
             command = CommandType(np.random.randint(1, 4))
             if command == CommandType.NEW:
                 # Create an order
-                order_type = OrderType(np.random.randint(1, 4))
+                order_type = OrderType(np.random.randint(1, 5))
                 side_type = Side(np.random.randint(1, 3))
                 ticker = traded_tickers[np.random.randint(0, len(traded_tickers))]
                 quantity = np.random.randint(1, quantity_limit)
                 price = np.random.randint(1, price_limit)
                 # Submit the order
-                lock.acquire()
                 oid = client.submit_order(order_type, side_type, ticker, quantity, price)
                 if oid is None:
                     # Start a new order if the current order cannot be submitted
                     break
-                # Receive order from order id
-                resp_order = client.get_order(oid)
-                lock.release()
-                time.sleep(5)
-                if resp_order is None:
-                    # Cancel Order if the order cannot be retrieved
-                    response = client.cancel_order(oid)
-                    print("Trader id#: " + str(self.trader_id))
-                    print("Response from CANCEL order: ", response)
-                    if response:
-                        break
-                else:
-                    # If the order is fulfilled or executed if it is IOC, update the total pnl
-                    if resp_order.is_fulfilled() or resp_order.ordertype == OrderType.IOC and resp_order.is_executed:
-                        for cp, order_pnl in resp_order.trades:
-                            self.total_balance += order_pnl
-                    self.balance_history = [self.total_balance] + self.balance_history
-                    print("Trader id#: " + str(self.trader_id))
-                    print("PNL is ", self.balance_history)
-                    print("Getting order", oid)
-                    print("Response is:", resp_order.is_fulfilled())
-
-                    # Wait for the order to be fulfilled
-                    while not resp_order.is_fulfilled() or resp_order.ordertype == OrderType.IOC and resp_order.is_executed:
-                        time.sleep(5)
-                        resp_order = client.get_order(oid)
-                        print("Trader id#: " + str(self.trader_id))
-                        print("Order quantity is:", resp_order.quantity)
-                        print("Order price is:", price)
-                        print("Order side is:", side_type)
-                        print("Order type is:", order_type)
-                        print("Order fufilled? ", resp_order.is_fulfilled())
-
+                # Follow the order through the execution reports the server pushes on the session
+                while True:
+                    try:
+                        report_type, report = reports.get(timeout=5) or (None, None)
+                    except queue.Empty:
                         # While waiting for order to be fulfilled, there is a 20% chance the waiting order is either amended or canceled
                         command = (np.random.randint(1, 6))
 
                         if command == 2:
                             new_quantity = np.random.randint(1, quantity_limit)
-                            lock.acquire()
                             response = client.amend_order(oid, new_quantity)
-                            lock.release()
-                            if response:
-                                resp_order = client.get_order(oid)
-                            print("Trader id#: " + str(self.trader_id))
-                            print("Response from AMEND order: ", resp_order)
-                            print("New amend order quantity is: ", resp_order.quantity)
+                            log.debug("Trader id#: %d AMEND order %d: %s", self.trader_id, oid, response)
                         if command == 3:
-                            lock.acquire()
                             response = client.cancel_order(oid)
-                            lock.release()
-                            print("Trader id#: " + str(self.trader_id))
-                            print("Response from CANCEL order: ", response)
-                            if response:
-                                break
+                            log.debug("Trader id#: %d CANCEL order %d: %s", self.trader_id, oid, response)
+                        continue
+                    if report is None:
+                        # The session closed
+                        break
+                    if report.order_id != oid:
+                        continue
+                    log.debug("Trader id#: %d report for order %d is %s with %d of %d filled", self.trader_id, oid,
+                              report_type.name, report.filled, report.quantity)
+
+                    # If the order is fulfilled, cancelled or expired, update the total pnl
+                    if report_type in (ReportType.FILL, ReportType.CANCEL_ACK, ReportType.EXPIRED):
+                        self.total_balance += report.pnl
+                        self.balance_history = [self.total_balance] + self.balance_history
+                        log.info("Trader id#: %d PNL is %d, balance %d", self.trader_id, report.pnl, self.total_balance)
+                        break
+                if report is None:
+                    break
+        client.close()
         self.exit()
 
 
 
 if __name__ == "__main__":
+    # Set to LogLevel.DEBUG to follow every request and execution report of the traders
+    log.level = LogLevel.INFO
     threads = []
     # Create new trader threads
     for trader_id in range(1, traders_limit+1):
@@ -123,7 +106,7 @@ if __name__ == "__main__":
        threads.append(thread)
 
     # Start the server thread
-    exchange_thread = threading.Thread(target=ExchangeServer().serve_forever)
+    exchange_thread = threading.Thread(target=AsyncExchangeServer().serve_forever)
     exchange_thread.setDaemon(True)
     exchange_thread.start()
 
@@ -0,0 +1,45 @@
+from enum import Enum
+
+class ReportType(Enum):
+    """ Enum for the execution reports pushed to the trader of an order
+    """
+    PARTIAL_FILL = 1
+    FILL = 2
+    CANCEL_ACK = 3
+    AMEND_ACK = 4
+    EXPIRED = 5 # An IOC or FOK order whose remaining quantity was cancelled without resting
+
+class ExecutionReport:
+    """ Compact state of an order as seen by a trader. It replaces the full Order, and its growing list of trades, in
+    responses sent over the wire.
+    """
+    __slots__ = ['order_id', 'trader_id', 'ticker', 'side', 'ordertype', 'quantity', 'filled', 'price',
+                 'is_executed', 'timestamp', 'pnl', 'trade_count']
+
+    def __init__(self, order_id, trader_id, ticker, side, ordertype, quantity, filled, price, is_executed,
+                 timestamp, pnl, trade_count):
+        self.order_id = order_id
+        self.trader_id = trader_id
+        self.ticker = ticker
+        self.side = side
+        self.ordertype = ordertype
+        self.quantity = quantity
+        self.filled = filled # Quantity filled
+        self.price = price # Price in ticks, None for MARKET orders
+        self.is_executed = is_executed # Attribute for IOC orders
+        self.timestamp = timestamp
+        self.pnl = pnl # Total P&L of the trades of the order, in the smallest currency unit
+        self.trade_count = trade_count # Number of trades executed with the order
+
+    @classmethod
+    def from_order(cls, order):
+        """ Build the report of an order
+        """
+        return cls(order.order_id, order.trader_id, order.ticker, order.side, order.ordertype, order.quantity,
+                   order.filled, order.price, order.is_executed, order.timestamp,
+                   sum(pnl for cp, pnl in order.trades), len(order.trades))
+
+    def is_fulfilled(self):
+        """ Check if all the order quantity is filled
+        """
+        return self.filled >= self.quantity
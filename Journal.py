@@ -0,0 +1,172 @@
+import os
+import struct
+import zlib
+
+from CommandType import CommandType
+from Order import Order
+from OrderType import OrderType
+from Side import Side
+
+
+class Journal:
+    """ Append-only write-ahead journal of the commands of a MatchingEngine.
+    Every record holds one command with a sequence number and a checksum. Records are packed into a memory buffer and
+    reach the file according to the durability mode:
+        'none'  - written to the file by commit() or when the buffer is large, never fsynced
+        'batch' - group commit: written and fsynced by commit() or every batch_size records
+        'sync'  - written and fsynced with every record
+    A record torn by a crash is detected by its checksum and cut off before new records are appended.
+    """
+    RECORD = struct.Struct('!IIQB') # payload length, CRC-32 of the payload, sequence number, command type
+    NEW = struct.Struct('!qqqqBBqB') # trader id, order id, quantity, timestamp, side, order type, price, has price
+    AMEND = struct.Struct('!qqB') # order id, quantity, has quantity
+    CANCEL = struct.Struct('!q') # order id
+    TEXT = struct.Struct('!B') # length of the UTF-8 ticker
+    DURABILITY = ('none', 'batch', 'sync')
+    BUFFER_SIZE = 1 << 16 # Bytes buffered before they are written to the file in 'none' mode
+
+    def __init__(self, path, durability='batch', batch_size=256):
+        if durability not in self.DURABILITY:
+            raise ValueError("Bad durability mode: " + str(durability))
+        self.path = path # Journal file
+        self.durability = durability # One of DURABILITY
+        self.batch_size = batch_size # Most records waiting for an fsync in 'batch' mode
+        self.sequence = 0 # Sequence number of the last record
+        self.__end = None # Size of the valid part of the file, known once it was read
+        self.__file = None
+        self.__buffer = bytearray() # Records not written to the file yet
+        self.__pending = 0 # Records not fsynced yet
+        self.__texts = {} # Dictionary of ticker mapping to its serialized form
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def replay(self, after=0):
+        """ Read the commands of the journal in sequence order, stopping at the first torn or corrupt record
+
+        :param: sequence number after which to start
+        :return: Generator of (sequence number, command) tuples, where the commands are the ones of
+                 MatchingEngine.handle_orders
+        """
+        sequence = 0
+        end = 0
+        if os.path.exists(self.path):
+            with open(self.path, 'rb', buffering=1 << 20) as f:
+                while True:
+                    head = f.read(self.RECORD.size)
+                    if len(head) < self.RECORD.size:
+                        break
+                    length, crc, record_sequence, command_type = self.RECORD.unpack(head)
+                    payload = f.read(length)
+                    # Sequence numbers are contiguous, from any first number after the journal was restarted
+                    if (len(payload) < length or zlib.crc32(payload) != crc or command_type not in (1, 2, 3) or
+                            (sequence and record_sequence != sequence + 1)):
+                        break
+                    sequence = record_sequence
+                    end += self.RECORD.size + length
+                    if sequence > after:
+                        yield sequence, self.__decode(CommandType(command_type), payload)
+        self.sequence = sequence
+        self.__end = end
+
+    def append(self, command):
+        """ Add a command to the journal
+
+        :param: a command of MatchingEngine.handle_orders
+        :return: The sequence number of the record
+        """
+        if self.__file is None:
+            self.__open()
+        command_type = command[0]
+        if command_type is CommandType.NEW:
+            order = command[1]
+            price = order.price
+            text = self.__texts.get(order.ticker)
+            if text is None:
+                ticker = order.ticker.encode('utf-8')
+                text = self.__texts[order.ticker] = self.TEXT.pack(len(ticker)) + ticker
+            # _value_ is the raw value of an Enum member, it is much faster to read than the value property
+            payload = self.NEW.pack(order.trader_id, order.order_id, order.quantity, order.timestamp,
+                                    order.side._value_, order.ordertype._value_, price if price is not None else 0,
+                                    price is not None) + text
+        elif command_type is CommandType.AMEND:
+            quantity = command[2]
+            payload = self.AMEND.pack(command[1], quantity or 0, quantity is not None)
+        else:
+            payload = self.CANCEL.pack(command[1])
+        self.sequence += 1
+        record = self.RECORD.pack(len(payload), zlib.crc32(payload), self.sequence, command_type._value_)
+        self.__buffer += record + payload
+        self.__pending += 1
+        if self.durability == 'sync':
+            self.commit()
+        elif self.durability == 'batch':
+            if self.__pending >= self.batch_size:
+                self.commit()
+        elif len(self.__buffer) >= self.BUFFER_SIZE:
+            self.__write()
+        return self.sequence
+
+    def restart(self, sequence):
+        """ Drop every record and number the next record after a sequence number, e.g. the one of a snapshot holding
+        the state of all the records
+
+        :param: sequence number of the last record the journal is considered to hold
+        """
+        if self.__file is None:
+            self.__open()
+        self.__buffer.clear()
+        self.__file.truncate(0)
+        self.__file.seek(0)
+        self.sequence = sequence
+        self.__pending = 1 # Make the next commit fsync the truncation
+
+    def commit(self):
+        """ Write the buffered records to the file and, unless the durability mode is 'none', fsync them
+        """
+        if self.__buffer:
+            self.__write()
+        if self.__pending and self.durability != 'none':
+            os.fdatasync(self.__file.fileno())
+        self.__pending = 0
+
+    def close(self):
+        """ Commit the buffered records and close the file
+        """
+        if self.__file is not None:
+            self.commit()
+            self.__file.close()
+            self.__file = None
+
+    def __open(self):
+        """ Open the file for appending after its last valid record
+        """
+        if self.__end is None:
+            for record in self.replay():
+                pass
+        self.__file = open(self.path, 'r+b' if os.path.exists(self.path) else 'w+b')
+        self.__file.truncate(self.__end)
+        self.__file.seek(self.__end)
+
+    def __write(self):
+        self.__file.write(self.__buffer)
+        self.__file.flush()
+        self.__buffer.clear()
+
+    def __decode(self, command_type, payload):
+        """ Deserialize the command of a record
+        """
+        if command_type is CommandType.NEW:
+            trader_id, order_id, quantity, timestamp, side, order_type, price, has_price = self.NEW.unpack_from(payload)
+            (length,) = self.TEXT.unpack_from(payload, self.NEW.size)
+            offset = self.NEW.size + self.TEXT.size
+            ticker = str(payload[offset:offset + length], 'utf-8')
+            return command_type, Order(trader_id, order_id, quantity, timestamp, Side(side), ticker,
+                                       OrderType(order_type), price if has_price else None)
+        elif command_type is CommandType.AMEND:
+            order_id, quantity, has_quantity = self.AMEND.unpack(payload)
+            return command_type, order_id, quantity if has_quantity else None
+        return command_type, self.CANCEL.unpack(payload)[0]
@@ -0,0 +1,148 @@
+import threading
+import time
+
+
+class LatencyHistogram:
+    """ HDR-style histogram of latencies in nanoseconds.
+    Values below 2 ** (precision + 1) are counted exactly. Larger values share buckets of 2 ** precision per power of
+    two, so a recorded value is off by less than 1 / 2 ** precision of itself, whatever its magnitude, and recording
+    is a couple of integer operations on a list.
+    """
+    __slots__ = ['precision', 'counts', 'count', 'total', 'min', 'max']
+
+    def __init__(self, precision=7):
+        self.precision = precision # Bits of the values kept in every bucket index
+        self.counts = [] # Number of values of each bucket
+        self.count = 0 # Number of values
+        self.total = 0 # Sum of the values
+        self.min = None # Smallest value
+        self.max = 0 # Largest value
+
+    def record(self, value):
+        """ Count a latency
+
+        :param: latency in nanoseconds
+        """
+        if value < 0:
+            value = 0
+        shift = value.bit_length() - self.precision - 1
+        index = value if shift <= 0 else (shift << self.precision) + (value >> shift)
+        counts = self.counts
+        if index >= len(counts):
+            counts.extend([0] * (index + 1 - len(counts)))
+        counts[index] += 1
+        self.count += 1
+        self.total += value
+        if value > self.max:
+            self.max = value
+        if self.min is None or value < self.min:
+            self.min = value
+
+    def highest_value(self, index):
+        """ Get the largest value counted by a bucket
+        """
+        if index < 2 << self.precision:
+            return index
+        shift = (index >> self.precision) - 1
+        mantissa = index - (shift << self.precision)
+        return ((mantissa + 1) << shift) - 1
+
+    def percentile(self, percent):
+        """ Get the latency below which a percentage of the values are
+
+        :param: percentage, e.g. 99.9
+        :return: The latency in nanoseconds, 0 if there are no values
+        """
+        if not self.count:
+            return 0
+        # Rank of the value in integer arithmetic, with the percentage in thousandths
+        rank = max(1, -(-self.count * round(percent * 1000) // 100000))
+        seen = 0
+        for index, count in enumerate(self.counts):
+            seen += count
+            if seen >= rank:
+                return min(self.highest_value(index), self.max)
+        return self.max
+
+    def merge(self, other):
+        """ Add the values of another histogram of the same precision
+        """
+        if other.precision != self.precision:
+            raise ValueError("Histograms of different precisions")
+        if len(other.counts) > len(self.counts):
+            self.counts.extend([0] * (len(other.counts) - len(self.counts)))
+        for index, count in enumerate(other.counts):
+            self.counts[index] += count
+        self.count += other.count
+        self.total += other.total
+        self.max = max(self.max, other.max)
+        if other.min is not None and (self.min is None or other.min < self.min):
+            self.min = other.min
+
+    def summary(self):
+        """ Get the count, mean and percentiles of the values
+
+        :return: Dictionary with count, mean, p50, p99, p999 and max, in nanoseconds
+        """
+        return {'count': self.count, 'mean': self.total / self.count if self.count else 0.0,
+                'p50': self.percentile(50), 'p99': self.percentile(99), 'p999': self.percentile(99.9),
+                'max': self.max}
+
+
+class LatencyStats:
+    """ Latency histograms of every stage of the order path, per request type, and request counters per ticker.
+    The stages of a request are
+        decode - deserializing the request
+        queue  - waiting for the matching engine
+        match  - running the request against the matching engine
+        encode - serializing the response
+        send   - handing the response to the socket
+    Servers only keep statistics when they are given a LatencyStats, and otherwise read no clock at all.
+    """
+    STAGES = ('decode', 'queue', 'match', 'encode', 'send')
+
+    def __init__(self, precision=7):
+        self.precision = precision # Precision of the histograms
+        self.started = time.monotonic() # Time the counters started
+        self.histograms = {} # Dictionary of (stage, ExchangeRequestType) mapping to its LatencyHistogram
+        self.tickers = {} # Dictionary of ticker mapping to the number of requests for it
+        self.__lock = threading.Lock() # Sessions of the threaded server record from their own threads
+
+    def record(self, stage, request_type, nanoseconds):
+        """ Count the latency of a stage of a request
+        """
+        key = (stage, request_type)
+        with self.__lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = LatencyHistogram(self.precision)
+            histogram.record(nanoseconds)
+
+    def count(self, ticker, requests=1):
+        """ Count requests for a ticker
+        """
+        with self.__lock:
+            self.tickers[ticker] = self.tickers.get(ticker, 0) + requests
+
+    def reset(self):
+        """ Drop every value and restart the counters
+        """
+        with self.__lock:
+            self.histograms = {}
+            self.tickers = {}
+            self.started = time.monotonic()
+
+    def report(self):
+        """ Get the statistics since the counters started
+
+        :return: Dictionary with
+                 elapsed - seconds since the counters started
+                 latency - dictionary of (stage, ExchangeRequestType) mapping to the summary of its LatencyHistogram
+                 tickers - dictionary of ticker mapping to a dictionary of its requests and requests per second
+        """
+        with self.__lock:
+            elapsed = time.monotonic() - self.started
+            return {'elapsed': elapsed,
+                    'latency': {key: histogram.summary() for key, histogram in self.histograms.items()},
+                    'tickers': {ticker: {'requests': requests, 'per_second': requests / elapsed if elapsed else 0.0}
+                                for ticker, requests in self.tickers.items()}}
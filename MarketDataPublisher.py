@@ -0,0 +1,216 @@
+from bisect import bisect_left
+from enum import Enum
+import queue
+import threading
+
+from EventLog import log
+from Side import Side
+
+
+class MarketDataType(Enum):
+    """ Enum for the market data updates of a ticker
+    """
+    LEVEL = 1
+    TRADE = 2
+    TOP = 3
+    SNAPSHOT = 4
+
+
+class MarketDataPublisher:
+    """ Class publishes the market data of the books of a MatchingEngine: price level updates, trades and top of book
+    changes of each ticker, numbered by a sequence number per ticker, and snapshots of the levels for late joiners.
+    The BookSides keep the quantity and the order count of every level up to date as orders are added, filled, amended
+    and removed, and remember which levels changed. After every command the matching thread only hands those levels and
+    the trades to a queue. A fan-out thread numbers the updates, applies them to its own copy of the levels and calls
+    the subscribers, so subscribers never slow down matching.
+    Updates are (ticker, sequence number, MarketDataType, data) tuples, where data is
+        LEVEL    - (side, price, quantity, number of orders), with a quantity of 0 once the level is gone
+        TRADE    - (price, quantity, side of the aggressor order)
+        TOP      - (best bid price, its quantity, best offer price, its quantity), with None prices for empty sides
+        SNAPSHOT - (bids, offers) lists of (price, quantity, number of orders), best price first
+    A SNAPSHOT has the sequence number of the last update it includes. Resting MARKET orders have no price and are not
+    published.
+    """
+    def __init__(self, engine):
+        self.engine = engine # MatchingEngine publishing its books
+        self.__queue = queue.SimpleQueue() # Changes of the matching thread, and (None, function, arguments) requests
+                                           # run by the fan-out thread between them
+        self.__lock = threading.Lock() # Guards the copy of the levels read by snapshot()
+        self.__tickers = {} # Dictionary of ticker mapping to its TickerLevels
+        self.__subscribers = {} # Dictionary of ticker, or None for every ticker, mapping to the list of subscribers
+        self.__thread = threading.Thread(target=self.__fan_out, daemon=True)
+        self.__thread.start()
+        engine.market_data = self
+        for book in engine.books.values():
+            self.publish(book)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        """ Stop publishing once the queued updates are delivered. The engine must not be handling commands.
+        """
+        if self.engine.market_data is self:
+            self.engine.market_data = None
+            for book in self.engine.books.values():
+                for book_side in (book.bid_side, book.offer_side):
+                    book_side.changes = book_side.prints = None
+        self.__queue.put(None)
+        self.__thread.join()
+
+    def publish(self, book):
+        """ Queue the level changes and the trades of a book since the last call. It runs on the matching thread.
+
+        :param: an EquityBook
+        """
+        bid_side, offer_side = book.bid_side, book.offer_side
+        if bid_side.changes is None:
+            # Start tracking the book with all its levels
+            for book_side in (bid_side, offer_side):
+                book_side.changes = set(book_side.levels)
+                book_side.prints = []
+        if not (bid_side.changes or offer_side.changes):
+            return
+        levels = []
+        trades = []
+        for book_side, aggressor in ((bid_side, Side.SELL), (offer_side, Side.BUY)):
+            for price in book_side.changes:
+                if price is not None:
+                    level = book_side.levels.get(price)
+                    if level is None:
+                        levels.append((book_side.side, price, 0, 0))
+                    else:
+                        levels.append((book_side.side, price, level.quantity, len(level)))
+            book_side.changes.clear()
+            for price, quantity in book_side.prints:
+                trades.append((price, quantity, aggressor))
+            book_side.prints.clear()
+        self.__queue.put((book.ticker, levels, trades))
+
+    def subscribe(self, subscriber, tickers=None):
+        """ Call a function with the updates of some tickers, starting with a SNAPSHOT of each ticker.
+        It runs on the fan-out thread, with the list of the updates of one command at a time.
+
+        :param: function taking a list of updates, and the list of tickers, None for every ticker
+        """
+        self.__queue.put((None, self.__add_subscriber, (subscriber, tickers)))
+
+    def unsubscribe(self, subscriber):
+        """ Stop calling a subscriber
+        """
+        self.__queue.put((None, self.__remove_subscriber, (subscriber,)))
+
+    def flush(self, timeout=None):
+        """ Wait until the updates queued so far are delivered
+
+        :return: True if they were delivered in time
+        """
+        delivered = threading.Event()
+        self.__queue.put((None, delivered.set, ()))
+        return delivered.wait(timeout)
+
+    def snapshot(self, ticker):
+        """ Get a SNAPSHOT update of the levels of a ticker as of its last update
+
+        :param: ticker
+        :return: The SNAPSHOT update
+        """
+        with self.__lock:
+            levels = self.__tickers.get(ticker)
+            if levels is None:
+                return (ticker, 0, MarketDataType.SNAPSHOT, ([], []))
+            return (ticker, levels.sequence, MarketDataType.SNAPSHOT, (levels.bids(), levels.offers()))
+
+    def __fan_out(self):
+        """ Number the queued changes, apply them to the copy of the levels and deliver them to the subscribers
+        """
+        while True:
+            item = self.__queue.get()
+            if item is None:
+                break
+            ticker, levels, trades = item
+            if ticker is None:
+                levels(*trades)
+                continue
+
+            updates = []
+            with self.__lock:
+                state = self.__tickers.get(ticker)
+                if state is None:
+                    state = self.__tickers[ticker] = TickerLevels()
+                for trade in trades:
+                    state.sequence += 1
+                    updates.append((ticker, state.sequence, MarketDataType.TRADE, trade))
+                for level in levels:
+                    state.apply(*level)
+                    state.sequence += 1
+                    updates.append((ticker, state.sequence, MarketDataType.LEVEL, level))
+                top = state.top()
+                if top != state.last_top:
+                    state.last_top = top
+                    state.sequence += 1
+                    updates.append((ticker, state.sequence, MarketDataType.TOP, top))
+            for subscriber in self.__subscribers.get(ticker, []) + self.__subscribers.get(None, []):
+                self.__deliver(subscriber, updates)
+
+    def __add_subscriber(self, subscriber, tickers):
+        for ticker in (tickers if tickers is not None else list(self.__tickers)):
+            self.__deliver(subscriber, [self.snapshot(ticker)])
+        for ticker in (tickers if tickers is not None else [None]):
+            self.__subscribers.setdefault(ticker, []).append(subscriber)
+
+    def __remove_subscriber(self, subscriber):
+        for subscribers in self.__subscribers.values():
+            if subscriber in subscribers:
+                subscribers.remove(subscriber)
+
+    @staticmethod
+    def __deliver(subscriber, updates):
+        try:
+            subscriber(updates)
+        except Exception as e:
+            log.error("Market data subscriber failed: %s", e)
+
+
+class TickerLevels:
+    """ Copy of the price levels of a ticker kept by the fan-out thread of a MarketDataPublisher
+    """
+    __slots__ = ['sequence', 'levels', 'keys', 'last_top']
+
+    def __init__(self):
+        self.sequence = 0 # Sequence number of the last update
+        self.levels = {Side.BUY: {}, Side.SELL: {}} # Dictionary of price mapping to (quantity, number of orders)
+        self.keys = {Side.BUY: [], Side.SELL: []} # Sorted prices of the levels of each side
+        self.last_top = (None, 0, None, 0) # Last published top of book
+
+    def apply(self, side, price, quantity, count):
+        """ Apply a LEVEL update
+        """
+        levels, keys = self.levels[side], self.keys[side]
+        if count:
+            if price not in levels:
+                keys.insert(bisect_left(keys, price), price)
+            levels[price] = (quantity, count)
+        elif price in levels:
+            del levels[price]
+            del keys[bisect_left(keys, price)]
+
+    def bids(self):
+        levels = self.levels[Side.BUY]
+        return [(price, ) + levels[price] for price in reversed(self.keys[Side.BUY])]
+
+    def offers(self):
+        levels = self.levels[Side.SELL]
+        return [(price, ) + levels[price] for price in self.keys[Side.SELL]]
+
+    def top(self):
+        """ Get the best bid and offer prices and quantities
+        """
+        bids, offers = self.keys[Side.BUY], self.keys[Side.SELL]
+        bid = bids[-1] if bids else None
+        offer = offers[0] if offers else None
+        return (bid, self.levels[Side.BUY][bid][0] if bids else 0,
+                offer, self.levels[Side.SELL][offer][0] if offers else 0)
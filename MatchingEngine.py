@@ -1,14 +1,46 @@
+from CommandType import CommandType
 from OrderType import OrderType
 from EquityBook import EquityBook
+from EventLog import log
+from ExecutionReport import ExecutionReport, ReportType
+from Order import Order
+from SequenceGenerator import SequenceGenerator
+from TickTable import TickTable
 
 class MatchingEngine:
     """ Class maps orders to the EquityBook for a particular ticker and tracks all submitted orders
     """
-    def __init__(self):
+    def __init__(self, tick_table=None, sequence=None, multiple_orders=False):
+        self.tick_table = tick_table if tick_table is not None else TickTable() # Tick size of each ticker
+        self.sequence = sequence if sequence is not None else SequenceGenerator() # Order id and timestamp source
         self.books = {} # Dictionary of tickers with a matching EquityBook
         self.order_tickers = {} # Dictionary of ticker with the corresponding order
         self.trader_orders = {} # Check trader can only submit one trade at a time to one EquityBook. One trader corresponds to one active order.
+        self.trader_index = {} if multiple_orders else None # Dictionary of trader id mapping to the dictionary of
+                                                            # ticker to the {order id: order} of its resting orders,
+                                                            # shared by the books. With multiple_orders traders may have
+                                                            # many active orders and trader_orders stays empty.
         self.order_history = {} # Dictionary of order id corresponding to each order that was ever submitted
+        self.journal = None # Journal every command is written to before it is handled, set by recover
+        self.snapshots = None # Snapshot taking a snapshot every snapshot_every journal records, set by recover
+        self.snapshot_every = None
+        self.next_snapshot = None # Journal sequence number after which the next snapshot is taken
+        self.reports = None # List collecting a (ReportType, ExecutionReport) for every order a command fills, cancels,
+                            # amends or expires, None not to collect them
+        self.market_data = None # MarketDataPublisher the books publish their changes to after every command, if any
+        self.archive = None # OrderArchive terminal orders are moved to, set by archive_orders
+        self.trade_logs = None # Dictionary of ticker mapping to the TradeLog of its book, set by log_trades
+        self.__trade_log_size = 4096 # Number of trades of each chunk of the trade logs
+
+
+    def create_order(self, traderid, quantity, side, ticker, ordertype, price=None):
+        """ Create a new order with an engine-assigned order id and timestamp
+
+        :param: the order attributes submitted by the trader, with the price in ticks
+        :return: The new order
+        """
+        return Order(traderid, self.sequence.next_id(), quantity, self.sequence.timestamp(), side, ticker,
+                     ordertype, price)
 
 
     def handle_order(self, order):
@@ -17,38 +49,59 @@ class MatchingEngine:
         :param: a new order to submit
         :return: True if all the order was immediately executed. If part of the order is still outstanding, return False.
         """
-        # If a trader has an order already active then a new order cannot be created
+        if self.journal is not None:
+            self.__journal((CommandType.NEW, order))
 
-        if order.trader_id in self.trader_orders:
-            return False
+        # If a trader has an order already active then a new order cannot be created
 
-        self.trader_orders[order.trader_id] = order.order_id
+        single = self.trader_index is None
+        if single:
+            if order.trader_id in self.trader_orders:
+                return False
+            self.trader_orders[order.trader_id] = order.order_id
         self.order_history[order.order_id] = order
 
         # Check if order can be matched in tickers
         if order.ticker not in self.books:
-            self.books[order.ticker] = EquityBook(order.ticker)
+            self.books[order.ticker] = EquityBook(order.ticker, self.tick_table.tick_value(order.ticker),
+                                                  self.trader_index)
+            if self.archive is not None:
+                self.__track_removals(self.books[order.ticker])
+            if self.trade_logs is not None:
+                self.__log_trades(self.books[order.ticker])
 
         # Record book that this order is submitted to
         self.order_tickers[order.order_id] = order.ticker
 
         # Handle the order from EquityBook and get results
-        result = self.books[order.ticker].handle_order(order)
+        book = self.books[order.ticker]
+        result = book.handle_order(order)
+        if self.market_data is not None:
+            self.market_data.publish(book)
+        if self.reports is not None:
+            if order.trades:
+                self.__report_fills(order, book)
+            # The remaining quantity of an IOC or FOK order is cancelled, which ends it with an EXPIRED report
+            if (order.ordertype == OrderType.IOC or order.ordertype == OrderType.FOK) and len(result) > 1 \
+                    and not order.is_fulfilled():
+                self.reports.append((ReportType.EXPIRED, ExecutionReport.from_order(order)))
         if len(result) > 1:
             trades_out, orders_out, trader_orders_out, order_id_out, pnl_out = result
-            # Delete from trader_order if the order has been fulfilled or executed
-            if order.is_fulfilled():
-                del self.trader_orders[order.trader_id]
-            if order.ordertype == OrderType.IOC and order.is_executed and order.trader_id in self.trader_orders:
-                del self.trader_orders[order.trader_id]
-
-            # Look for other completed orders
-            for oid, pnl in trades_out[order.order_id]:
-                if self.order_history[oid].trader_id in self.trader_orders:
-                    if self.order_history[oid].is_fulfilled():
-                        del self.trader_orders[self.order_history[oid].trader_id]
-                    if self.order_history[oid].ordertype == OrderType.IOC and self.order_history[oid].is_executed and self.order_history[oid].trader_id in self.trader_orders:
-                        del self.trader_orders[self.order_history[oid].trader_id]
+            if single:
+                # Delete from trader_order if the order has been fulfilled, or is an IOC or FOK order, which never
+                # rests
+                if order.order_id not in book.resting:
+                    del self.trader_orders[order.trader_id]
+
+                # Look for other completed orders among the resting orders of the fills
+                fills = book.fills
+                for i in range(0, 3 * book.fill_count, 3):
+                    o = fills[i]
+                    if o.trader_id in self.trader_orders and o.is_fulfilled():
+                        del self.trader_orders[o.trader_id]
+
+            if self.archive is not None:
+                self.__archive_terminal(book, order)
 
             # Output whether the order has been fulfilled or executed
             if order.ordertype == OrderType.IOC:
@@ -56,46 +109,160 @@ class MatchingEngine:
             else:
                 return order.is_fulfilled()
         else:
+            if self.archive is not None:
+                self.__archive_terminal(book, order)
             return False
 
 
+    def handle_orders(self, commands):
+        """ Handle a batch of commands in one pass, in sequence order
+
+        :param: list of (CommandType.NEW, order), (CommandType.AMEND, order id, new quantity) and
+                (CommandType.CANCEL, order id) commands
+        :return: List of the result of each command, as handle_order, amend_order and cancel_order return it
+        """
+        handle_order, amend_order, cancel_order = self.handle_order, self.amend_order, self.cancel_order
+        results = []
+        append = results.append
+        for command in commands:
+            command_type = command[0]
+            if command_type is CommandType.NEW:
+                append(handle_order(command[1]))
+            elif command_type is CommandType.CANCEL:
+                append(cancel_order(command[1]))
+            elif command_type is CommandType.AMEND:
+                append(amend_order(command[1], command[2]))
+            else:
+                raise ValueError("Bad command type: " + str(command_type))
+        return results
+
+
+    def recover(self, journal, snapshots=None, snapshot_every=100000):
+        """ Rebuild the books and the trader state from the latest snapshot and the journal records after it, then
+        journal every new command and take a snapshot every snapshot_every commands
+
+        :param: a Journal, a Snapshot or None to only replay the journal, and the number of commands between snapshots
+        :return: The number of replayed commands
+        """
+        self.journal = None
+        start = snapshots.load(self) if snapshots is not None else 0
+        count = 0
+        for sequence, command in journal.replay(after=start):
+            if command[0] is CommandType.NEW:
+                self.sequence.observe(command[1].order_id)
+            try:
+                self.handle_orders([command])
+            except Exception:
+                pass # A command that failed when it was first handled fails the same way again
+            count += 1
+        if journal.sequence < start:
+            # The journal lost records the snapshot holds, so it restarts after the snapshot
+            journal.restart(start)
+        self.journal = journal
+        self.snapshots = snapshots
+        self.snapshot_every = snapshot_every
+        self.next_snapshot = journal.sequence + snapshot_every
+        return count
+
+
+    def __journal(self, command):
+        """ Write a command to the journal, first taking a snapshot if one is due
+        """
+        if self.snapshots is not None and self.journal.sequence >= self.next_snapshot:
+            self.snapshots.take(self)
+            self.next_snapshot = self.journal.sequence + self.snapshot_every
+        self.journal.append(command)
+
+
+    def __report_fills(self, order, book):
+        """ Report the fills of a new order and of the resting orders it traded with
+        """
+        filled = [order]
+        fills = book.fills
+        for i in range(0, 3 * book.fill_count, 3):
+            if fills[i + 1]:
+                filled.append(fills[i])
+        for o in filled:
+            self.reports.append((ReportType.FILL if o.is_fulfilled() else ReportType.PARTIAL_FILL,
+                                 ExecutionReport.from_order(o)))
+
+
     def cancel_order(self, orderid):
         """ Cancel an order that was previously submitted
 
         :param: Order object to cancel
         :return: A tuple of (True, None) if the order was successfully cancelled, else (False, order)
         """
+        if self.journal is not None:
+            self.__journal((CommandType.CANCEL, orderid))
         if orderid in self.order_tickers:
             book = self.books[self.order_tickers[orderid]]
             result = book.cancel_order(orderid)
             # If cancel successful, delete the order from order_ticker and trader_orders
             if result:
+                if self.market_data is not None:
+                    self.market_data.publish(book)
                 self.order_tickers.pop(orderid, None)
-                del self.trader_orders[self.order_history[orderid].trader_id]
+                if self.trader_index is None:
+                    del self.trader_orders[self.order_history[orderid].trader_id]
+                if self.reports is not None:
+                    self.reports.append((ReportType.CANCEL_ACK,
+                                         ExecutionReport.from_order(self.order_history[orderid])))
+                if self.archive is not None:
+                    self.__archive_terminal(book)
                 return True
             else:
                 return False
         else:
-            print("Cancel order error: Order id not found in existing orders!")
+            log.warning("Cancel order error: order id %d not found in existing orders", orderid)
             return False
 
 
 
+    def cancel_all(self, trader_id, ticker=None):
+        """ Cancel every resting order of a trader, or only its orders on one ticker, as cancel_order cancels each of
+        them. Only the orders of the trader are read.
+
+        :param: trader id and ticker, None for every ticker
+        :return: List of the cancelled order ids
+        """
+        if self.trader_index is None:
+            orderid = self.trader_orders.get(trader_id)
+            if orderid is None or (ticker is not None and self.order_tickers.get(orderid) != ticker):
+                return []
+            orderids = [orderid]
+        else:
+            tickers = self.trader_index.get(trader_id, {})
+            if ticker is None:
+                orderids = [orderid for orders in tickers.values() for orderid in orders]
+            else:
+                orderids = list(tickers.get(ticker, ()))
+        return [orderid for orderid in orderids if self.cancel_order(orderid)]
+
+
     def amend_order(self, orderid, new_quantity=None):
         """ Amend an order that was previously submitted
 
         :param: Order id to be amended
         :return: A tuple of (True, order) if the order was successfully amended, else (False, order)
         """
+        if self.journal is not None:
+            self.__journal((CommandType.AMEND, orderid, new_quantity))
         if orderid in self.order_tickers:
             book = self.books[self.order_tickers[orderid]]
             if new_quantity:
-                return book.amend_order(orderid, new_quantity)
+                result = book.amend_order(orderid, new_quantity)
+                if result and self.market_data is not None:
+                    self.market_data.publish(book)
+                if result and self.reports is not None:
+                    self.reports.append((ReportType.AMEND_ACK,
+                                         ExecutionReport.from_order(self.order_history[orderid])))
+                return result
             else:
-                print("Amend order error: No new quantity inputted!")
+                log.warning("Amend order error: no new quantity for order id %d", orderid)
                 return False
         else:
-            print("Amend order error: Order id not found in existing orders!")
+            log.warning("Amend order error: order id %d not found in existing orders", orderid)
             return False
 
     def get_order(self, orderid):
@@ -106,6 +273,88 @@ class MatchingEngine:
         """
         if orderid in self.order_history:
             return self.order_history[orderid]
+        elif self.archive is not None:
+            return self.archive.get(orderid)
         else:
             return None
 
+
+    def archive_orders(self, archive):
+        """ Move every terminal order, which is a filled, cancelled, IOC or FOK order no longer on its book, to an
+        archive, now and after every command. get_order still finds archived orders.
+
+        :param: an OrderArchive
+        """
+        self.archive = archive
+        for book in self.books.values():
+            self.__track_removals(book)
+        for order in list(self.order_history.values()):
+            book = self.books.get(order.ticker)
+            if book is None or order.order_id not in book.resting:
+                self.__archive(book, order)
+
+
+    def log_trades(self, chunk_size=4096):
+        """ Append every trade from now on to a columnar TradeLog of its book, for vectorized P&L, VWAP and volume
+        queries. It needs NumPy.
+
+        :param: number of trades of each chunk of the logs
+        :return: Dictionary of ticker mapping to its TradeLog
+        """
+        if self.trade_logs is None:
+            self.trade_logs = {}
+            self.__trade_log_size = chunk_size
+            for book in self.books.values():
+                self.__log_trades(book)
+        return self.trade_logs
+
+
+    def trader_pnl(self, trader_id):
+        """ Get the P&L of a trader from the trade logs of every book
+
+        :param: trader id
+        :return: The P&L in the smallest currency unit
+        """
+        return sum(trade_log.pnl(trader_id) for trade_log in self.trade_logs.values())
+
+
+    def __log_trades(self, book):
+        """ Give a book a TradeLog its sides append their trades to
+        """
+        # NumPy is only needed by engines keeping trade logs
+        from TradeLog import TradeLog
+        trade_log = self.trade_logs[book.ticker] = TradeLog(book.ticker, book.tick_value, self.__trade_log_size,
+                                                             self.sequence.timestamp)
+        book.bid_side.trade_log = book.offer_side.trade_log = trade_log
+
+    @staticmethod
+    def __track_removals(book):
+        """ Make the sides of a book record the orders leaving them
+        """
+        for book_side in (book.bid_side, book.offer_side):
+            if book_side.removed is None:
+                book_side.removed = []
+
+    def __archive_terminal(self, book, order=None):
+        """ Archive the orders that left a book during a command, and the order of the command if it does not rest
+        """
+        for book_side in (book.bid_side, book.offer_side):
+            if book_side.removed:
+                for removed in book_side.removed:
+                    self.__archive(book, removed)
+                book_side.removed.clear()
+        if order is not None and order.order_id not in book.resting:
+            self.__archive(book, order)
+
+    def __archive(self, book, order):
+        """ Move an order out of the engine and its book to the archive
+        """
+        oid = order.order_id
+        if self.order_history.pop(oid, None) is None:
+            return
+        self.archive.add(order)
+        self.order_tickers.pop(oid, None)
+        if book is not None:
+            book.orders.pop(oid, None)
+            book.trades.pop(oid, None)
+
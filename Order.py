@@ -1,18 +1,23 @@
+import sys
+
 from OrderType import OrderType
 from Side import Side
 
 class Order:
-    """ Class defining order attributes
+    """ Class defining order attributes. Prices are integer ticks of the order ticker.
     """
+    __slots__ = ['trader_id', 'quantity', 'timestamp', 'ticker', 'order_id', 'filled', 'is_executed', 'trades',
+                 'side', 'ordertype', 'price']
+
     def __init__(self, traderid, orderid, quantity, timestamp, side, ticker, ordertype, price=None):
         self.trader_id = traderid # Trader who submitted the order
         self.quantity = int(quantity) # Order quantity
         self.timestamp = timestamp # Time order is submitted
-        self.ticker = str(ticker) # Order ticker
+        self.ticker = sys.intern(str(ticker)) # Order ticker, shared by every order of the ticker
         self.order_id = orderid # Order id
         self.filled = 0 # Quantity filled
-        self.is_executed = False # Attribute for IOC orders
-        self.trades = [] # Trades executed with the order
+        self.is_executed = False # Attribute for IOC and FOK orders, True once they traded
+        self.trades = [] # Trades executed with the order, adopted by the EquityBook the order is submitted to
 
         # Side of the order
         if side == Side.BUY or side == Side.SELL:
@@ -24,29 +29,38 @@ class Order:
         else:
             raise ValueError("Invalid side: " + side)
 
-        # Check order type. If the order type is MARKET, set the price as None. Otherwise, set the price.
+        # Check order type. If the order type is MARKET, set the price as None. Otherwise, set the price in ticks.
         if ordertype == OrderType.MARKET:
             self.ordertype = ordertype
             self.price = None
-        elif ordertype == OrderType.LIMIT or ordertype == OrderType.IOC:
+        elif ordertype == OrderType.LIMIT or ordertype == OrderType.IOC or ordertype == OrderType.FOK:
             self.ordertype = ordertype
             if price is None:
-                raise ValueError("LIMIT and IOC orders must have a price!")
+                raise ValueError("LIMIT, IOC and FOK orders must have a price!")
             else:
-                self.price = float(price)
+                self.price = self.__ticks(price)
         elif OrderType.from_str(ordertype) == OrderType.MARKET:
             self.ordertype = OrderType.MARKET
             self.price = None
-        elif OrderType.from_str(ordertype) == OrderType.LIMIT or OrderType.from_str(ordertype) == OrderType.IOC:
-            self.ordertype = OrderType.LIMIT
+        elif OrderType.from_str(ordertype) in (OrderType.LIMIT, OrderType.IOC, OrderType.FOK):
+            self.ordertype = OrderType.from_str(ordertype)
             if price is None:
-                raise ValueError("LIMIT and IOC orders must have a price!")
+                raise ValueError("LIMIT, IOC and FOK orders must have a price!")
             else:
-                self.price = float(price)
+                self.price = self.__ticks(price)
         else:
             raise ValueError("Invalid type: " + ordertype)
 
 
+    @staticmethod
+    def __ticks(price):
+        """ Convert a price to integer ticks, refusing to truncate a price between two ticks, like 100.7
+        """
+        ticks = int(price)
+        if ticks != price and not isinstance(price, str):
+            raise ValueError("Price is not a whole number of ticks: " + str(price))
+        return ticks
+
     def fill_order(self, qty):
         """ Fill the order with new quantity
         """
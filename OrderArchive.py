@@ -0,0 +1,192 @@
+from collections import OrderedDict
+import os
+import struct
+
+from Order import Order
+from OrderType import OrderType
+from Side import Side
+
+
+class OrderArchive:
+    """ Append-only on-disk store of terminal orders (filled, cancelled, IOC or FOK orders), with their trades.
+    Orders are appended to segment files of about segment_size bytes. A sparse index file holds the segment, offset and
+    length of each order at the position of its order id, so looking up an order costs one read of the index and one
+    read of the order, whatever the number of archived orders. The most recently used orders are kept in an LRU cache.
+    An order is looked up by its id, or read back with all the others by orders(): deleting old segment files
+    forgets their orders.
+    """
+    ORDER = struct.Struct('!qqqqBBqBqBI') # trader id, order id, quantity, timestamp, side, order type, price,
+                                          # has price, filled, is executed, number of trades
+    TEXT = struct.Struct('!B') # length of the UTF-8 ticker
+    TRADE = struct.Struct('!qq') # contra order id, P&L
+    INDEX = struct.Struct('!IQI') # segment number, offset, length of the order record. A length of 0 is no order.
+    BUFFER_SIZE = 1 << 16 # Bytes of orders buffered before they are written
+
+    def __init__(self, directory, segment_size=64 << 20, cache_size=1024):
+        self.directory = directory # Directory holding the segment and index files
+        self.segment_size = segment_size # Size after which a new segment file is started
+        self.cache_size = cache_size # Most orders kept in the LRU cache
+        self.count = 0 # Number of orders archived by this instance
+        self.__cache = OrderedDict() # Dictionary of order id mapping to the order, least recently used first
+        self.__buffer = bytearray() # Records not written to the current segment yet
+        self.__pending = {} # Dictionary of order id mapping to the buffered orders
+        self.__entries = [] # (order id, index entry) of the buffered orders
+        os.makedirs(directory, exist_ok=True)
+        segments = self.segments()
+        self.__segment = segments[-1] if segments else 0 # Number of the segment written to
+        self.__file = open(self.__path(self.__segment), 'ab')
+        self.__size = self.__file.tell() # Size of the segment written to, including the buffered records
+        index_path = os.path.join(directory, 'index.bin')
+        self.__index = os.open(index_path, os.O_RDWR | os.O_CREAT, 0o644)
+        self.__readers = {} # Dictionary of segment number mapping to its file descriptor open for reading
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def __path(self, segment):
+        return os.path.join(self.directory, 'segment-%010d.bin' % segment)
+
+    def segments(self):
+        """ Get the numbers of the segment files on disk, oldest first
+        """
+        segments = []
+        for name in os.listdir(self.directory):
+            if name.startswith('segment-') and name.endswith('.bin'):
+                segments.append(int(name[len('segment-'):-len('.bin')]))
+        return sorted(segments)
+
+    def add(self, order):
+        """ Archive a terminal order. Archiving an order again replaces it.
+
+        :param: the order, which does not change anymore
+        """
+        price = order.price
+        text = order.ticker.encode('utf-8')
+        trades = order.trades
+        record = (self.ORDER.pack(order.trader_id, order.order_id, order.quantity, order.timestamp, order.side._value_,
+                                  order.ordertype._value_, price if price is not None else 0, price is not None,
+                                  order.filled, order.is_executed, len(trades)) +
+                  self.TEXT.pack(len(text)) + text +
+                  b''.join([self.TRADE.pack(oid, pnl) for oid, pnl in trades]))
+        if self.__size >= self.segment_size:
+            self.flush()
+            self.__file.close()
+            self.__segment += 1
+            self.__file = open(self.__path(self.__segment), 'ab')
+            self.__size = 0
+        self.__entries.append((order.order_id, self.INDEX.pack(self.__segment, self.__size, len(record))))
+        self.__buffer += record
+        self.__size += len(record)
+        self.__pending[order.order_id] = order
+        self.__cache.pop(order.order_id, None)
+        self.count += 1
+        if len(self.__buffer) >= self.BUFFER_SIZE:
+            self.flush()
+
+    def get(self, orderid):
+        """ Get an archived order
+
+        :param: order id
+        :return: The order. None if it is not archived.
+        """
+        order = self.__pending.get(orderid)
+        if order is not None:
+            return order
+        cache = self.__cache
+        order = cache.get(orderid)
+        if order is not None:
+            cache.move_to_end(orderid)
+            return order
+        if orderid < 0:
+            return None
+        entry = os.pread(self.__index, self.INDEX.size, orderid * self.INDEX.size)
+        if len(entry) < self.INDEX.size:
+            return None
+        segment, offset, length = self.INDEX.unpack(entry)
+        if not length:
+            return None
+        record = self.__read(segment, offset, length)
+        if record is None:
+            return None
+        order = self.__decode(record)
+        cache[orderid] = order
+        if len(cache) > self.cache_size:
+            cache.popitem(last=False)
+        return order
+
+    def orders(self):
+        """ Iterate over the archived orders by order id, reading every order from the index and segment files. Orders
+        of deleted segment files are skipped.
+
+        :return: Generator of the archived orders
+        """
+        self.flush()
+        size = self.INDEX.size
+        orderid = 0
+        while True:
+            chunk = os.pread(self.__index, 4096 * size, orderid * size)
+            if len(chunk) < size:
+                return
+            for segment, offset, length in self.INDEX.iter_unpack(chunk[:len(chunk) - len(chunk) % size]):
+                if length:
+                    record = self.__read(segment, offset, length)
+                    if record is not None:
+                        yield self.__decode(record)
+                orderid += 1
+
+    def flush(self):
+        """ Write the buffered orders to their segment and index files
+        """
+        if self.__buffer:
+            self.__file.write(self.__buffer)
+            self.__file.flush()
+            self.__buffer.clear()
+        for orderid, entry in self.__entries:
+            os.pwrite(self.__index, entry, orderid * self.INDEX.size)
+        self.__entries.clear()
+        self.__pending.clear()
+
+    def close(self):
+        """ Write the buffered orders and close the files
+        """
+        if self.__file is not None:
+            self.flush()
+            self.__file.close()
+            self.__file = None
+            os.close(self.__index)
+            for reader in self.__readers.values():
+                os.close(reader)
+            self.__readers.clear()
+
+    def __read(self, segment, offset, length):
+        """ Read an order record from its segment file
+
+        :return: The record. None if the segment file was deleted.
+        """
+        reader = self.__readers.get(segment)
+        if reader is None:
+            try:
+                reader = self.__readers[segment] = os.open(self.__path(segment), os.O_RDONLY)
+            except FileNotFoundError:
+                return None
+        return os.pread(reader, length, offset)
+
+    def __decode(self, record):
+        """ Deserialize an order record
+        """
+        (trader_id, order_id, quantity, timestamp, side, order_type, price, has_price, filled, is_executed,
+         trade_count) = self.ORDER.unpack_from(record)
+        offset = self.ORDER.size
+        (length,) = self.TEXT.unpack_from(record, offset)
+        offset += self.TEXT.size
+        ticker = str(record[offset:offset + length], 'utf-8')
+        offset += length
+        order = Order(trader_id, order_id, quantity, timestamp, Side(side), ticker, OrderType(order_type),
+                      price if has_price else None)
+        order.filled = filled
+        order.is_executed = bool(is_executed)
+        order.trades = [self.TRADE.unpack_from(record, offset + i * self.TRADE.size) for i in range(trade_count)]
+        return order
@@ -0,0 +1,186 @@
+import argparse
+import csv
+import gc
+import itertools
+import os
+import random
+import time
+
+from CommandType import CommandType
+from EventLog import LogLevel, log
+from MatchingEngine import MatchingEngine
+from Order import Order
+from OrderType import OrderType
+from Side import Side
+
+
+class OrderFlowReplay:
+    """ Class feeds recorded order flow from a CSV file straight into a MatchingEngine, without sockets or sleeps.
+    Each row is one command with the columns of FIELDS. NEW rows keep their recorded order id and timestamp, so a replay
+    is deterministic. Commands are read and handled in chunks, and the trades and order events of each chunk are
+    written out before the next chunk is read.
+    """
+    FIELDS = ['timestamp', 'command', 'order_id', 'trader_id', 'ticker', 'side', 'order_type', 'quantity', 'price']
+    TRADE_FIELDS = ['sequence', 'ticker', 'order_id', 'contra_order_id', 'pnl']
+    EVENT_FIELDS = ['sequence', 'command', 'order_id', 'result', 'filled', 'remaining']
+
+    def __init__(self, engine=None, tick_table=None, chunk_size=10000):
+        self.engine = engine if engine is not None else MatchingEngine(tick_table) # Engine the flow is replayed into
+        self.tick_table = self.engine.tick_table # Converts the recorded decimal prices to ticks
+        self.chunk_size = chunk_size # Number of commands read and handled at a time
+        self.commands = 0 # Number of commands replayed
+        self.trades = 0 # Number of trades written
+        self.elapsed = 0.0 # Seconds spent replaying
+
+    def read(self, path):
+        """ Stream the commands of a recorded flow file in chunks
+
+        :param: path of the CSV file
+        :return: Generator of lists of MatchingEngine.handle_orders commands
+        """
+        to_ticks = self.tick_table.to_ticks
+        # Enum members and prices are looked up by their recorded text, which repeats throughout a flow
+        command_types = {member.name: member for member in CommandType}
+        sides = {member.name: member for member in Side}
+        order_types = {member.name: member for member in OrderType}
+        ticks = {}
+        NEW, AMEND, MARKET = CommandType.NEW, CommandType.AMEND, OrderType.MARKET
+        with open(path, newline='') as f:
+            reader = csv.reader(f)
+            header = next(reader, None)
+            if header != self.FIELDS:
+                raise ValueError("Unexpected columns in %s: %s" % (path, header))
+            while True:
+                rows = list(itertools.islice(reader, self.chunk_size))
+                if not rows:
+                    break
+                commands = []
+                append = commands.append
+                for timestamp, command, order_id, trader_id, ticker, side, order_type, quantity, price in rows:
+                    command_type = command_types.get(command) or CommandType.from_str(command)
+                    if command_type is NEW:
+                        order_type = order_types.get(order_type) or OrderType.from_str(order_type)
+                        if order_type is MARKET:
+                            price = None
+                        else:
+                            key = (ticker, price)
+                            price = ticks.get(key)
+                            if price is None:
+                                price = ticks[key] = to_ticks(ticker, key[1])
+                        append((command_type, Order(int(trader_id), int(order_id), int(quantity), int(timestamp),
+                                                    sides.get(side) or Side.from_str(side), ticker, order_type,
+                                                    price)))
+                    elif command_type is AMEND:
+                        append((command_type, int(order_id), int(quantity)))
+                    else:
+                        append((command_type, int(order_id)))
+                yield commands
+
+    def run(self, path, trades_path=None, events_path=None, quiet=True):
+        """ Replay a recorded flow file, writing its trades and order events
+
+        :param: path of the CSV flow file, paths of the trades and events CSV files to write, None to skip them, and
+                whether to drop the warnings the engine logs for rejected commands
+        :return: Commands replayed per second
+        """
+        level = log.level
+        if quiet:
+            log.level = LogLevel.ERROR
+        with open(trades_path or os.devnull, 'w', newline='') as trades_file, \
+                open(events_path or os.devnull, 'w', newline='') as events_file:
+            trades = csv.writer(trades_file) if trades_path else None
+            events = csv.writer(events_file) if events_path else None
+            if trades:
+                trades.writerow(self.TRADE_FIELDS)
+            if events:
+                events.writerow(self.EVENT_FIELDS)
+            # Orders hold no reference cycles, and collecting while millions of them are alive dominates the replay
+            collecting = gc.isenabled()
+            gc.disable()
+            start = time.perf_counter()
+            try:
+                for commands in self.read(path):
+                    if trades or events:
+                        self.__handle(commands, trades, events)
+                    else:
+                        self.engine.handle_orders(commands)
+                        self.commands += len(commands)
+            finally:
+                self.elapsed += time.perf_counter() - start
+                log.level = level
+                if collecting:
+                    gc.enable()
+        return self.commands / self.elapsed if self.elapsed else 0.0
+
+    def __handle(self, commands, trades, events):
+        """ Handle a chunk of commands one by one, writing the trades and the state of each order as it is handled,
+        since later commands go on filling the orders that rest
+        """
+        engine = self.engine
+        trade_rows = []
+        event_rows = []
+        sequence = self.commands
+        for command in commands:
+            sequence += 1
+            command_type = command[0]
+            if command_type is CommandType.NEW:
+                order = command[1]
+                result = engine.handle_order(order)
+                # A new order only trades as the aggressor, so each trade is written once
+                for contra_order_id, pnl in order.trades:
+                    trade_rows.append((sequence, order.ticker, order.order_id, contra_order_id, pnl))
+                event_rows.append((sequence, command_type.name, order.order_id, result, order.filled,
+                                   order.quantity - order.filled))
+            else:
+                result = engine.handle_orders([command])[0]
+                event_rows.append((sequence, command_type.name, command[1], result, '', ''))
+        if trades:
+            trades.writerows(trade_rows)
+        if events:
+            events.writerows(event_rows)
+        self.commands = sequence
+        self.trades += len(trade_rows)
+
+    @classmethod
+    def generate(cls, path, count, tickers=100, traders=10000, seed=1):
+        """ Write a random flow file, mostly LIMIT orders around a price of 100 with some MARKET and IOC orders,
+        amends and cancels
+
+        :param: path of the CSV file, number of commands, number of tickers and traders, and random seed
+        """
+        rnd = random.Random(seed)
+        names = ['T%04d' % i for i in range(tickers)]
+        with open(path, 'w', newline='') as f:
+            writer = csv.writer(f)
+            writer.writerow(cls.FIELDS)
+            order_id = 0
+            for i in range(count):
+                draw = rnd.random()
+                if draw < 0.8 or order_id == 0:
+                    order_id += 1
+                    order_type = 'MARKET' if draw < 0.04 else 'IOC' if draw < 0.12 else 'LIMIT'
+                    writer.writerow((i, 'NEW', order_id, rnd.randint(1, traders), rnd.choice(names),
+                                     rnd.choice(('BUY', 'SELL')), order_type, rnd.randint(1, 100),
+                                     '' if order_type == 'MARKET' else '%d.%02d' % (rnd.randint(95, 104),
+                                                                                    rnd.randint(0, 99))))
+                elif draw < 0.9:
+                    writer.writerow((i, 'CANCEL', rnd.randint(1, order_id), '', '', '', '', '', ''))
+                else:
+                    writer.writerow((i, 'AMEND', rnd.randint(1, order_id), '', '', '', '', rnd.randint(1, 100), ''))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Replay recorded order flow through the MatchingEngine")
+    parser.add_argument('flow', help="CSV file of commands to replay")
+    parser.add_argument('--trades', help="CSV file to write the trades to")
+    parser.add_argument('--events', help="CSV file to write the order events to")
+    parser.add_argument('--chunk', type=int, default=10000, help="Number of commands handled at a time")
+    parser.add_argument('--generate', type=int, metavar='COUNT', help="First write a random flow of COUNT commands")
+    args = parser.parse_args()
+
+    if args.generate:
+        OrderFlowReplay.generate(args.flow, args.generate)
+    replay = OrderFlowReplay(chunk_size=args.chunk)
+    rate = replay.run(args.flow, args.trades, args.events)
+    print("Replayed %d commands and %d trades in %.2f s: %.0f commands/s" %
+          (replay.commands, replay.trades, replay.elapsed, rate))
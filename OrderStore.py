@@ -0,0 +1,113 @@
+from array import array
+
+from Order import Order
+from OrderType import OrderType
+from Side import Side
+
+
+class OrderStore:
+    """ In-memory store of terminal orders (filled, cancelled, IOC or FOK orders), with their trades, kept in columns of
+    typed arrays rather than as Order objects. It takes the place of an OrderArchive, with
+    `engine.archive_orders(OrderStore())`, when terminal orders should stay in memory: an order then costs about 70
+    bytes, plus 16 per trade, instead of an Order object with its trades list and integers and its entries in the
+    dictionaries of the engine and of its book.
+    The row of an order is found at the position of its order id, so order ids are expected to be dense, as the
+    SequenceGenerator hands them out. get builds a new Order from the columns of its row.
+    """
+    FAR = 1 << 16 # Order ids further than this past the last position of the row index are kept in a dictionary
+
+    def __init__(self):
+        self.count = 0 # Number of orders stored
+        self.__tickers = [] # Tickers of the stored orders, by ticker index
+        self.__ticker_index = {} # Dictionary of ticker mapping to its ticker index
+        self.__rows = array('q') # Row of each order id plus 1, at the position of the order id. 0 is no order.
+        self.__far_rows = {} # Dictionary of order id mapping to the row of orders too far past the row index
+        self.__trader_ids = array('q')
+        self.__quantities = array('q')
+        self.__timestamps = array('q')
+        self.__prices = array('q') # Price in ticks, 0 for MARKET orders
+        self.__filled = array('q')
+        self.__kinds = array('B') # Side << 4 | order type << 1 | is executed, of each order
+        self.__ticker_ids = array('I') # Ticker index of each order
+        self.__trade_ends = array('q') # Position of the end of the trades of each order in the trade columns
+        self.__contra_ids = array('q') # Contra order id of every trade
+        self.__pnls = array('q') # P&L of every trade
+
+    def __len__(self):
+        return self.count
+
+    def add(self, order):
+        """ Store a terminal order. Storing an order again replaces it.
+
+        :param: the order, which does not change anymore
+        """
+        row = len(self.__trader_ids)
+        oid = order.order_id
+        rows = self.__rows
+        if 0 <= oid < len(rows) + self.FAR:
+            if oid >= len(rows):
+                # Grow the row index geometrically, with zeros for the ids in between
+                rows.frombytes(bytes(8 * max(oid + 1 - len(rows), len(rows))))
+            if not rows[oid]:
+                self.count += 1
+            rows[oid] = row + 1
+        else:
+            if oid not in self.__far_rows:
+                self.count += 1
+            self.__far_rows[oid] = row
+
+        ticker_id = self.__ticker_index.get(order.ticker)
+        if ticker_id is None:
+            ticker_id = self.__ticker_index[order.ticker] = len(self.__tickers)
+            self.__tickers.append(order.ticker)
+        price = order.price
+        self.__trader_ids.append(order.trader_id)
+        self.__quantities.append(order.quantity)
+        self.__timestamps.append(order.timestamp)
+        self.__prices.append(price if price is not None else 0)
+        self.__filled.append(order.filled)
+        self.__kinds.append(order.side._value_ << 4 | order.ordertype._value_ << 1 | bool(order.is_executed))
+        self.__ticker_ids.append(ticker_id)
+        for contra_id, pnl in order.trades:
+            self.__contra_ids.append(contra_id)
+            self.__pnls.append(pnl)
+        self.__trade_ends.append(len(self.__contra_ids))
+
+    def get(self, orderid):
+        """ Get a stored order
+
+        :param: order id
+        :return: A new Order with the state of the stored one. None if it is not stored.
+        """
+        rows = self.__rows
+        if 0 <= orderid < len(rows):
+            row = rows[orderid] - 1
+            if row < 0:
+                return None
+        else:
+            row = self.__far_rows.get(orderid)
+            if row is None:
+                return None
+        kind = self.__kinds[row]
+        ordertype = OrderType(kind >> 1 & 7)
+        order = Order(self.__trader_ids[row], orderid, self.__quantities[row], self.__timestamps[row], Side(kind >> 4),
+                      self.__tickers[self.__ticker_ids[row]], ordertype,
+                      self.__prices[row] if ordertype is not OrderType.MARKET else None)
+        order.filled = self.__filled[row]
+        order.is_executed = bool(kind & 1)
+        start = self.__trade_ends[row - 1] if row else 0
+        end = self.__trade_ends[row]
+        order.trades = list(zip(self.__contra_ids[start:end], self.__pnls[start:end]))
+        return order
+
+    def orders(self):
+        """ Iterate over the stored orders, by order id for the ids of the row index and then the others
+
+        :return: Generator of new Orders with the state of the stored ones
+        """
+        rows = self.__rows
+        for orderid in range(len(rows)):
+            if rows[orderid]:
+                yield self.get(orderid)
+        for orderid in sorted(self.__far_rows):
+            yield self.get(orderid)
@@ -1,11 +1,12 @@
 from enum import Enum
 
 class OrderType(Enum):
-    """ Enum class of 3 different types of order types
+    """ Enum class of 4 different types of order types
     """
     MARKET = 1
     LIMIT = 2
-    IOC = 3
+    IOC = 3 # Immediate or cancel: trades what it can up to its price at once, and the rest is cancelled
+    FOK = 4 # Fill or kill: trades all its quantity up to its price at once, or nothing
 
     @classmethod
     def from_str(self, value):
@@ -16,4 +17,6 @@ class OrderType(Enum):
             return OrderType.LIMIT
         elif val == 'IOC':
             return OrderType.IOC
+        elif val == 'FOK':
+            return OrderType.FOK
         raise ValueError("Bad order type: " + val)
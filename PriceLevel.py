@@ -0,0 +1,57 @@
+from collections import OrderedDict
+
+class PriceLevel:
+    """ Class holding the queue of resting orders at a single price of an EquityBook side
+    """
+    __slots__ = ['price', 'orders', 'quantity']
+
+    def __init__(self, price):
+        self.price = price # Price shared by every order in the level
+        self.orders = OrderedDict() # Dictionary of order id mapping to the order, kept in execution priority
+        self.quantity = 0 # Total remaining quantity of the orders, kept up to date by the BookSide
+
+
+    def __len__(self):
+        return len(self.orders)
+
+    def __iter__(self):
+        return iter(self.orders.values())
+
+    def __contains__(self, orderid):
+        return orderid in self.orders
+
+
+    def head(self):
+        """ Get the order with the highest priority in the level
+
+        :return: The first order of the queue. None if the level is empty.
+        """
+        for order in self.orders.values():
+            return order
+        return None
+
+    def push_front(self, order):
+        """ Add an order ahead of the orders already resting at this price
+
+        :param: order to add
+        """
+        self.orders[order.order_id] = order
+        self.orders.move_to_end(order.order_id, last=False)
+
+    def pop_head(self):
+        """ Remove the order with the highest priority in the level
+
+        :return: The removed order. None if the level is empty.
+        """
+        try:
+            return self.orders.popitem(last=False)[1]
+        except KeyError:
+            return None
+
+    def remove(self, orderid):
+        """ Remove an order from anywhere in the queue
+
+        :param: order id to remove
+        :return: The removed order. None if the order is not in the level.
+        """
+        return self.orders.pop(orderid, None)
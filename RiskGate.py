@@ -0,0 +1,353 @@
+from itertools import chain
+
+from CommandType import CommandType
+from EventLog import log
+from MatchingEngine import MatchingEngine
+from Side import Side
+
+
+class RiskLimits:
+    """ Pre-trade limits of a trader. A limit of None is not checked.
+    """
+    __slots__ = ['max_quantity', 'max_notional', 'max_open_orders', 'max_position', 'price_collar']
+
+    def __init__(self, max_quantity=None, max_notional=None, max_open_orders=None, max_position=None,
+                 price_collar=None):
+        self.max_quantity = max_quantity # Largest quantity of one order
+        self.max_notional = max_notional # Largest quantity * price of one order in the smallest currency unit
+        self.max_open_orders = max_open_orders # Most orders of the trader resting on the books
+        self.max_position = max_position # Largest absolute position in a ticker, counting the resting orders of the
+                                         # trader on the side of the new order as if they were filled
+        self.price_collar = price_collar # Most ticks the price of an order may be away from the last trade price of
+                                         # its ticker
+
+
+class Exposure:
+    """ Running exposure of a trader in a ticker
+    """
+    __slots__ = ['position', 'buying', 'selling']
+
+    def __init__(self):
+        self.position = 0 # Net filled quantity, bought minus sold
+        self.buying = 0 # Open quantity of the resting BUY orders
+        self.selling = 0 # Open quantity of the resting SELL orders
+
+
+class RiskGate:
+    """ Pre-trade risk checks in front of a MatchingEngine, with the same interface, so it can be given to the servers
+    with `matching_engine=RiskGate(MatchingEngine(), limits)`. A new order is rejected, without reaching the engine,
+    if it breaks the limits of its trader, and handle_order then returns None, which the servers answer with a failed
+    response without an order.
+    The exposures are updated from the fill buffer of the book after every command, so a check only reads a few
+    counters whatever the number of orders and trades. Only the traders with limits are tracked, so the flow of the
+    others costs a check for their limits and nothing else. The gate only sees the flow going through it, and MARKET
+    orders are checked against the last trade price of their ticker, if any.
+    """
+    def __init__(self, matching_engine=None, limits=None):
+        self.engine = matching_engine if matching_engine is not None else MatchingEngine()
+        self.limits = limits # RiskLimits of the traders without their own, None not to check them. Call rebuild after
+                             # changing it from or to None.
+        self.trader_limits = {} # Dictionary of trader id mapping to its own RiskLimits
+        self.exposures = {} # Dictionary of (trader id, ticker) mapping to the Exposure of the trader in the ticker,
+                            # only for the traders with limits
+        self.open_orders = {} # Dictionary of trader id mapping to its number of resting orders
+        self.last_prices = {} # Dictionary of ticker mapping to its last trade price in ticks
+        self.rejected = {} # Dictionary of the name of a failed check mapping to the number of orders it rejected
+        self.__tick_values = {} # Dictionary of ticker mapping to its tick value
+        self.__handle = self.engine.handle_order
+        self.__books = self.engine.books # Rebound by rebuild, as loading a snapshot replaces the books
+
+
+    def __getattr__(self, name):
+        # Everything the gate does not check is the engine's
+        return getattr(self.engine, name)
+
+    @property
+    def reports(self):
+        return self.engine.reports
+
+    @reports.setter
+    def reports(self, reports):
+        self.engine.reports = reports
+
+
+    def set_limits(self, trader_id, limits):
+        """ Set the limits of a trader. The exposures are rebuilt when the trader starts or stops being tracked.
+
+        :param: trader id and its RiskLimits, None to apply the default limits again
+        """
+        tracked = self.limits is not None or trader_id in self.trader_limits
+        if limits is None:
+            self.trader_limits.pop(trader_id, None)
+        else:
+            self.trader_limits[trader_id] = limits
+        if tracked != (self.limits is not None or trader_id in self.trader_limits):
+            self.rebuild()
+
+    def position(self, trader_id, ticker):
+        """ Get the net filled quantity of a trader with limits in a ticker, bought minus sold
+        """
+        exposure = self.exposures.get((trader_id, ticker))
+        return exposure.position if exposure is not None else 0
+
+
+    def check(self, order):
+        """ Run the pre-trade checks of a new order against the limits of its trader
+
+        :param: a new order
+        :return: None if the order passes, else the name of the failed check
+        """
+        limits = self.trader_limits.get(order.trader_id, self.limits)
+        return self.__check(order, limits) if limits is not None else None
+
+
+    def create_order(self, traderid, quantity, side, ticker, ordertype, price=None):
+        """ Create a new order with an engine-assigned order id and timestamp
+        """
+        return self.engine.create_order(traderid, quantity, side, ticker, ordertype, price)
+
+
+    def handle_order(self, order):
+        """ Check a new order and handle it on the engine if it passes
+
+        :param: a new order to submit
+        :return: None if the order is rejected, else the result of MatchingEngine.handle_order
+        """
+        limits = self.trader_limits.get(order.trader_id, self.limits)
+        if limits is not None:
+            failed = self.__check(order, limits)
+            if failed is not None:
+                self.rejected[failed] = self.rejected.get(failed, 0) + 1
+                log.warning("Risk check error: order id %d of trader %d fails the %s limit", order.order_id,
+                            order.trader_id, failed)
+                return None
+
+        ticker = order.ticker
+        book = self.__books.get(ticker)
+        if book is not None:
+            # An order the engine rejects does not reach the book, which then shows no fills
+            book.fill_count = 0
+        result = self.__handle(order)
+        if book is None:
+            book = self.__books.get(ticker)
+            if book is None:
+                return result
+
+        traded = 0
+        last = None
+        count = book.fill_count
+        if count:
+            exposures = self.exposures
+            resting_index = book.resting
+            fills = book.fills
+            for i in range(0, 3 * count, 3):
+                resting, quantity = fills[i], fills[i + 1]
+                exposure = exposures.get((resting.trader_id, ticker))
+                if exposure is not None:
+                    if resting.side is Side.BUY:
+                        exposure.position += quantity
+                        exposure.buying -= quantity
+                    else:
+                        exposure.position -= quantity
+                        exposure.selling -= quantity
+                    if resting.order_id not in resting_index:
+                        self.__close(resting.trader_id)
+                if quantity:
+                    traded += quantity
+                    last = fills[i + 2]
+            if traded:
+                self.last_prices[ticker] = last
+        if limits is None:
+            return result
+
+        rests = order.order_id in book.resting
+        if traded or rests:
+            key = (order.trader_id, ticker)
+            exposure = self.exposures.get(key)
+            if exposure is None:
+                exposure = self.exposures[key] = Exposure()
+            buy = order.side is Side.BUY
+            if traded:
+                exposure.position += traded if buy else -traded
+            if rests:
+                if buy:
+                    exposure.buying += order.quantity - order.filled
+                else:
+                    exposure.selling += order.quantity - order.filled
+                self.open_orders[order.trader_id] = self.open_orders.get(order.trader_id, 0) + 1
+        return result
+
+
+    def handle_orders(self, commands):
+        """ Handle a batch of commands in sequence order, checking every new order
+
+        :param: list of commands, as MatchingEngine.handle_orders takes them
+        :return: List of the result of each command
+        """
+        results = []
+        for command in commands:
+            command_type = command[0]
+            if command_type is CommandType.NEW:
+                results.append(self.handle_order(command[1]))
+            elif command_type is CommandType.CANCEL:
+                results.append(self.cancel_order(command[1]))
+            elif command_type is CommandType.AMEND:
+                results.append(self.amend_order(command[1], command[2]))
+            else:
+                raise ValueError("Bad command type: " + str(command_type))
+        return results
+
+
+    def cancel_order(self, orderid):
+        """ Cancel an order that was previously submitted
+
+        :param: order id to cancel
+        :return: True if the order was cancelled, else False
+        """
+        order = self.engine.order_history.get(orderid)
+        result = self.engine.cancel_order(orderid)
+        if result:
+            self.__release(order)
+        return result
+
+
+    def cancel_all(self, trader_id, ticker=None):
+        """ Cancel every resting order of a trader, or only its orders on one ticker
+
+        :param: trader id and ticker, None for every ticker
+        :return: List of the cancelled order ids
+        """
+        orderids = self.engine.cancel_all(trader_id, ticker)
+        for orderid in orderids:
+            # Cancelled orders may already be archived
+            self.__release(self.engine.get_order(orderid))
+        return orderids
+
+
+    def amend_order(self, orderid, new_quantity=None):
+        """ Amend an order that was previously submitted. Amends only reduce orders, so they are not checked.
+
+        :param: order id to amend and its new quantity
+        :return: True if the order was amended, else False
+        """
+        order = self.engine.order_history.get(orderid)
+        before = self.__remaining(order) if order is not None else 0
+        result = self.engine.amend_order(orderid, new_quantity)
+        if result:
+            exposure = self.exposures.get((order.trader_id, order.ticker))
+            if exposure is not None:
+                if order.side is Side.BUY:
+                    exposure.buying += self.__remaining(order) - before
+                else:
+                    exposure.selling += self.__remaining(order) - before
+        return result
+
+
+    def recover(self, journal, snapshots=None, snapshot_every=100000):
+        """ Recover the engine from its snapshot and journal, as MatchingEngine.recover does, then rebuild the exposures
+        from the recovered orders
+
+        :param: a Journal, a Snapshot or None to only replay the journal, and the number of commands between snapshots
+        :return: The number of replayed commands
+        """
+        count = self.engine.recover(journal, snapshots, snapshot_every)
+        self.rebuild()
+        return count
+
+    def rebuild(self):
+        """ Recompute the exposures and the resting orders of the traders with limits from the orders and books of the
+        engine and from its archive, which holds the filled orders that left the engine. The last trade prices of the
+        collar come back with the next trades.
+        """
+        self.exposures = {}
+        self.open_orders = {}
+        self.__books = books = self.engine.books
+        trader_limits = self.trader_limits
+        everyone = self.limits is not None
+        history = self.engine.order_history
+        orders = history.values()
+        if self.engine.archive is not None:
+            # An order replayed back into the engine since it was archived is counted from the engine
+            orders = chain(orders, (order for order in self.engine.archive.orders() if order.order_id not in history))
+        for order in orders:
+            if not everyone and order.trader_id not in trader_limits:
+                continue
+            book = books.get(order.ticker)
+            rests = book is not None and order.order_id in book.resting
+            if not order.filled and not rests:
+                continue
+            exposure = self.__exposure(order.trader_id, order.ticker)
+            buy = order.side is Side.BUY
+            exposure.position += order.filled if buy else -order.filled
+            if rests:
+                if buy:
+                    exposure.buying += self.__remaining(order)
+                else:
+                    exposure.selling += self.__remaining(order)
+                self.open_orders[order.trader_id] = self.open_orders.get(order.trader_id, 0) + 1
+
+
+    def __check(self, order, limits):
+        """ Run the pre-trade checks of a new order against the given limits
+        """
+        quantity = order.quantity
+        if limits.max_quantity is not None and quantity > limits.max_quantity:
+            return 'order size'
+        ticker = order.ticker
+        price = order.price
+        last = self.last_prices.get(ticker)
+        if price is None:
+            price = last
+        elif limits.price_collar is not None and last is not None and abs(price - last) > limits.price_collar:
+            return 'price collar'
+        if limits.max_notional is not None and price is not None:
+            tick_value = self.__tick_values.get(ticker)
+            if tick_value is None:
+                tick_value = self.__tick_values[ticker] = self.engine.tick_table.tick_value(ticker)
+            if quantity * (price * tick_value) > limits.max_notional:
+                return 'notional'
+        if limits.max_open_orders is not None and self.open_orders.get(order.trader_id, 0) >= limits.max_open_orders:
+            return 'open orders'
+        if limits.max_position is not None:
+            exposure = self.exposures.get((order.trader_id, ticker))
+            if exposure is None:
+                worst = quantity
+            elif order.side is Side.BUY:
+                worst = exposure.position + exposure.buying + quantity
+            else:
+                worst = exposure.selling + quantity - exposure.position
+            if worst > limits.max_position:
+                return 'position'
+        return None
+
+
+    def __exposure(self, trader_id, ticker):
+        exposure = self.exposures.get((trader_id, ticker))
+        if exposure is None:
+            exposure = self.exposures[(trader_id, ticker)] = Exposure()
+        return exposure
+
+    @staticmethod
+    def __remaining(order):
+        # An order amended below its filled quantity has nothing open, and stays on its book until a match removes it
+        remaining = order.quantity - order.filled
+        return remaining if remaining > 0 else 0
+
+    def __release(self, order):
+        """ Take an order that left its book without trading out of the open quantity of its trader, if tracked
+        """
+        exposure = self.exposures.get((order.trader_id, order.ticker))
+        if exposure is None:
+            return
+        if order.side is Side.BUY:
+            exposure.buying -= self.__remaining(order)
+        else:
+            exposure.selling -= self.__remaining(order)
+        self.__close(order.trader_id)
+
+    def __close(self, trader_id):
+        count = self.open_orders[trader_id] - 1
+        if count:
+            self.open_orders[trader_id] = count
+        else:
+            del self.open_orders[trader_id]
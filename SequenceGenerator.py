@@ -0,0 +1,79 @@
+import itertools
+import os
+import threading
+import time
+
+class SequenceGenerator:
+    """ Class hands out strictly increasing 64-bit order ids and nanosecond timestamps for the engine.
+    Ids are reserved in blocks and the end of the reserved block is persisted as a high-water mark, so a restarted
+    generator never hands out an id that was used before.
+    """
+    MAX_ID = 2 ** 63 - 1
+
+    def __init__(self, start=1, path=None, block=4096):
+        self.path = path # File holding the persisted high-water mark, None to keep ids in memory only
+        self.block = block # Number of ids reserved with each write of the high-water mark
+        self.__lock = threading.Lock()
+        if path is not None and os.path.exists(path):
+            with open(path) as f:
+                start = max(start, int(f.read().strip() or 0))
+        self.limit = start # First id that is not reserved yet
+        self.__counter = itertools.count(start)
+        self.__reserve(start)
+
+
+    def __reserve(self, oid):
+        """ Reserve the next block of ids, persisting the high-water mark first
+        """
+        with self.__lock:
+            if oid < self.limit:
+                return
+            limit = oid + self.block
+            if limit > self.MAX_ID:
+                raise OverflowError("Order ids exhausted the 64-bit range")
+            if self.path is not None:
+                tmp = self.path + '.tmp'
+                with open(tmp, 'w') as f:
+                    f.write(str(limit))
+                    f.flush()
+                    os.fsync(f.fileno())
+                os.replace(tmp, self.path)
+            self.limit = limit
+
+
+    def next_id(self):
+        """ Get the next order id
+
+        :return: A new integer id, greater than any id handed out before
+        """
+        # observe and peek replace the counter under the lock, which an id taken from the old one would miss
+        with self.__lock:
+            oid = next(self.__counter)
+        if oid >= self.limit:
+            self.__reserve(oid)
+        return oid
+
+    def peek(self):
+        """ Get the id the next call of next_id hands out, without handing it out
+        """
+        with self.__lock:
+            following = next(self.__counter)
+            self.__counter = itertools.count(following)
+        return following
+
+    def observe(self, oid):
+        """ Make sure ids handed out from now on are greater than an id used before, e.g. one replayed from a journal
+
+        :param: an order id
+        """
+        with self.__lock:
+            following = next(self.__counter)
+            self.__counter = itertools.count(max(following, oid + 1))
+        if oid >= self.limit:
+            self.__reserve(oid + 1)
+
+    @staticmethod
+    def timestamp():
+        """ Get a monotonic timestamp in nanoseconds
+        """
+        return time.monotonic_ns()
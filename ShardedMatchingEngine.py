@@ -0,0 +1,304 @@
+import collections
+import functools
+import multiprocessing
+import os
+import zlib
+
+from CommandType import CommandType
+from EventLog import log
+from ExchangeRequest import ExchangeRequestType
+from ExecutionReport import ExecutionReport
+from MatchingEngine import MatchingEngine
+from Order import Order
+from OrderType import OrderType
+from SequenceGenerator import SequenceGenerator
+from Side import Side
+from TickTable import TickTable
+
+# Command codes sent to the workers
+SUBMIT = ExchangeRequestType.SUBMIT.value
+AMEND = ExchangeRequestType.AMEND.value
+CANCEL = ExchangeRequestType.CANCEL.value
+GET = ExchangeRequestType.GET.value
+
+
+class ShardedMatchingEngine:
+    """ Gateway to matching engines running in worker processes. Each worker owns the books of a stable partition of the
+    tickers, so tickers on different shards are matched in parallel.
+    The gateway assigns order ids, routes commands with order_tickers and keeps trader_orders, so that the one active
+    order per trader rule holds across shards. Commands are sent to the workers in batches and several batches can be
+    in flight per worker.
+    """
+    BATCH_SIZE = 256 # Most commands sent to a worker in one message
+    MAX_IN_FLIGHT = 2 # Most batches sent to a worker before waiting for its results. It keeps the pipes from filling up.
+
+    def __init__(self, shards=None, tick_table=None, sequence=None):
+        self.tick_table = tick_table if tick_table is not None else TickTable() # Tick size of each ticker
+        self.sequence = sequence if sequence is not None else SequenceGenerator() # Order id and timestamp source
+        self.shards = shards or os.cpu_count() or 1 # Number of worker processes
+        self.order_tickers = {} # Dictionary of order id with the ticker of the order, for every submitted order
+        self.trader_orders = {} # Dictionary of trader id with its active order id, across all shards
+        self.reports = None # List collecting the (ReportType, ExecutionReport) of the workers, None not to collect them.
+                            # The reports of an order keep their order, the ones of different shards may interleave.
+        self.__connections = []
+        self.__processes = []
+        self.__outbox = [] # Commands of each shard not sent yet
+        self.__callbacks = [] # Result handlers of each shard, in the order the commands were queued
+        self.__in_flight = [] # Sizes of the batches sent to each shard and not answered yet
+        for shard in range(self.shards):
+            connection, worker_connection = multiprocessing.Pipe()
+            process = multiprocessing.Process(target=ShardedMatchingEngine.serve_shard,
+                                              args=(worker_connection, self.tick_table), daemon=True)
+            process.start()
+            worker_connection.close()
+            self.__connections.append(connection)
+            self.__processes.append(process)
+            self.__outbox.append([])
+            self.__callbacks.append(collections.deque())
+            self.__in_flight.append(collections.deque())
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        """ Stop the worker processes
+        """
+        for connection, process in zip(self.__connections, self.__processes):
+            try:
+                connection.send(None)
+            except (BrokenPipeError, OSError):
+                pass
+            process.join()
+            connection.close()
+        self.__connections = []
+        self.__processes = []
+
+    def shard_of(self, ticker):
+        """ Get the shard owning a ticker. The partition only depends on the ticker name, not on the process.
+
+        :param: ticker name
+        :return: Index of the shard
+        """
+        return zlib.crc32(ticker.encode('utf-8')) % self.shards
+
+    def create_order(self, traderid, quantity, side, ticker, ordertype, price=None):
+        """ Create a new order with a gateway-assigned order id and timestamp
+
+        :param: the order attributes submitted by the trader, with the price in ticks
+        :return: The new order
+        """
+        return Order(traderid, self.sequence.next_id(), quantity, self.sequence.timestamp(), side, ticker,
+                     ordertype, price)
+
+    def handle_order(self, order):
+        """ Handle a new order on the shard of its ticker
+
+        :param: a new order to submit
+        :return: True if all the order was immediately executed. If part of the order is still outstanding, return False.
+        """
+        return self.handle_orders([(CommandType.NEW, order)])[0]
+
+    def handle_orders(self, commands):
+        """ Handle a batch of commands in sequence order, keeping commands of different shards in flight at the same
+        time. The result of each command is the one it would give if the commands were handled one after another.
+
+        :param: list of (CommandType.NEW, order), (CommandType.AMEND, order id, new quantity) and
+                (CommandType.CANCEL, order id) commands
+        :return: List of the result of each command, as handle_order, amend_order and cancel_order return it
+        """
+        results = [False] * len(commands)
+        for index, command in enumerate(commands):
+            command_type = command[0]
+            if command_type is CommandType.NEW:
+                order = command[1]
+                trader_id = order.trader_id
+                if trader_id in self.trader_orders:
+                    # The active order may have been completed by a command still in flight on its shard
+                    self.__drain(self.shard_of(self.order_tickers[self.trader_orders[trader_id]]))
+                    if trader_id in self.trader_orders:
+                        continue
+                self.trader_orders[trader_id] = order.order_id
+                self.order_tickers[order.order_id] = order.ticker
+                # Send the order fields rather than the Order, which is much cheaper to pickle
+                self.__queue(self.shard_of(order.ticker),
+                             (SUBMIT, order.trader_id, order.order_id, order.quantity, order.timestamp,
+                              order.side.value, order.ticker, order.ordertype.value, order.price),
+                             functools.partial(self.__on_submit, order, results, index))
+            elif command_type is CommandType.CANCEL or command_type is CommandType.AMEND:
+                orderid = command[1]
+                if orderid not in self.order_tickers:
+                    log.warning("%s order error: order id %d not found in existing orders",
+                                command_type.name.capitalize(), orderid)
+                    continue
+                self.__queue(self.shard_of(self.order_tickers[orderid]),
+                             (CANCEL, orderid) if command_type is CommandType.CANCEL else (AMEND, orderid, command[2]),
+                             functools.partial(results.__setitem__, index))
+            else:
+                raise ValueError("Bad command type: " + str(command_type))
+        for shard in range(self.shards):
+            self.__drain(shard)
+        return results
+
+    def cancel_order(self, orderid):
+        """ Cancel an order that was previously submitted
+
+        :param: Order id to cancel
+        :return: True if the order was successfully cancelled, else False
+        """
+        if orderid not in self.order_tickers:
+            log.warning("Cancel order error: order id %d not found in existing orders", orderid)
+            return False
+        return self.__execute(self.order_tickers[orderid], (CANCEL, orderid))
+
+    def cancel_all(self, trader_id, ticker=None):
+        """ Cancel the active order of a trader, as traders have one active order across the shards
+
+        :param: trader id and ticker, None for every ticker
+        :return: List of the cancelled order ids
+        """
+        orderid = self.trader_orders.get(trader_id)
+        if orderid is None or (ticker is not None and self.order_tickers.get(orderid) != ticker):
+            return []
+        return [orderid] if self.cancel_order(orderid) else []
+
+    def amend_order(self, orderid, new_quantity=None):
+        """ Amend an order that was previously submitted
+
+        :param: Order id to be amended and its new quantity
+        :return: True if the order was successfully amended, else False
+        """
+        if orderid not in self.order_tickers:
+            log.warning("Amend order error: order id %d not found in existing orders", orderid)
+            return False
+        return self.__execute(self.order_tickers[orderid], (AMEND, orderid, new_quantity))
+
+    def get_order(self, orderid):
+        """ Get the state of an order that was previously submitted
+
+        :param: Order id to be retrieved
+        :return: The ExecutionReport of the order if it exists. None if it does not.
+        """
+        if orderid not in self.order_tickers:
+            return None
+        return self.__execute(self.order_tickers[orderid], (GET, orderid))
+
+    def __execute(self, ticker, command):
+        """ Run one command on the shard of a ticker and wait for its result
+        """
+        shard = self.shard_of(ticker)
+        result = []
+        self.__queue(shard, command, result.append)
+        self.__drain(shard)
+        return result[0]
+
+    def __on_submit(self, order, results, index, reply):
+        results[index], order.filled, order.is_executed, order.trades = reply
+
+    def __queue(self, shard, command, callback):
+        outbox = self.__outbox[shard]
+        outbox.append(command)
+        self.__callbacks[shard].append(callback)
+        if len(outbox) >= self.BATCH_SIZE:
+            self.__flush(shard)
+
+    def __flush(self, shard):
+        """ Send the queued commands of a shard, first waiting for results if too many batches are in flight
+        """
+        in_flight = self.__in_flight[shard]
+        while len(in_flight) >= self.MAX_IN_FLIGHT:
+            self.__receive(shard)
+        self.__connections[shard].send((self.reports is not None, self.__outbox[shard]))
+        in_flight.append(len(self.__outbox[shard]))
+        self.__outbox[shard] = []
+
+    def __receive(self, shard):
+        """ Receive the results of the oldest batch in flight on a shard
+        """
+        replies = self.__connections[shard].recv()
+        self.__in_flight[shard].popleft()
+        callbacks = self.__callbacks[shard]
+        error = None
+        for reply, released, reports in replies:
+            # Forget the active orders the shard released, unless the trader already has a newer one
+            for trader_id, order_id in released:
+                if self.trader_orders.get(trader_id) == order_id:
+                    del self.trader_orders[trader_id]
+            if reports and self.reports is not None:
+                self.reports.extend(reports)
+            callback = callbacks.popleft()
+            if isinstance(reply, Exception):
+                error = error or reply
+            else:
+                callback(reply)
+        if error is not None:
+            raise error
+
+    def __drain(self, shard):
+        """ Send the queued commands of a shard and wait until all of them are answered
+        """
+        if self.__outbox[shard]:
+            self.__flush(shard)
+        while self.__in_flight[shard]:
+            self.__receive(shard)
+
+    @staticmethod
+    def serve_shard(connection, tick_table):
+        """ Worker process loop running batches of commands against its own MatchingEngine until it receives None.
+        Each reply carries the active orders the command released, so the gateway can update trader_orders, and the
+        execution reports of the command when the gateway collects them.
+        """
+        engine = MatchingEngine(tick_table)
+        engine.trader_orders = ReleaseLog()
+        while True:
+            try:
+                message = connection.recv()
+            except EOFError:
+                break
+            if message is None:
+                break
+            reporting, commands = message
+            engine.reports = [] if reporting else None
+            replies = []
+            for command in commands:
+                request_type = command[0]
+                try:
+                    if request_type == SUBMIT:
+                        order = Order(command[1], command[2], command[3], command[4], Side(command[5]), command[6],
+                                      OrderType(command[7]), command[8])
+                        reply = (engine.handle_order(order), order.filled, order.is_executed, order.trades)
+                    elif request_type == CANCEL:
+                        reply = engine.cancel_order(command[1])
+                    elif request_type == AMEND:
+                        reply = engine.amend_order(command[1], command[2])
+                    else:
+                        order = engine.get_order(command[1])
+                        reply = ExecutionReport.from_order(order) if order is not None else None
+                except Exception as e:
+                    reply = e
+                reports = engine.reports
+                if reporting:
+                    engine.reports = []
+                replies.append((reply, engine.trader_orders.take_released(), reports))
+            connection.send(replies)
+        connection.close()
+
+
+class ReleaseLog(dict):
+    """ Dictionary of trader id with its active order id that records the entries deleted from it
+    """
+    def __init__(self):
+        super().__init__()
+        self.released = []
+
+    def __delitem__(self, trader_id):
+        self.released.append((trader_id, self[trader_id]))
+        super().__delitem__(trader_id)
+
+    def take_released(self):
+        """ Get the (trader id, order id) entries deleted since the last call
+        """
+        released, self.released = self.released, []
+        return released
@@ -0,0 +1,249 @@
+import os
+import struct
+import zlib
+
+from EquityBook import EquityBook
+from Order import Order
+from OrderType import OrderType
+from Side import Side
+
+
+class Snapshot:
+    """ Class writes and loads point-in-time binary images of the state of a MatchingEngine: every order with its trades,
+    order_tickers, trader_orders and every EquityBook with its resting orders in execution priority.
+    Each snapshot records the sequence number of the last journal record it contains, so recovery loads the latest
+    snapshot and only replays the journal records after it, and the next order id of the engine, so ids of orders it
+    no longer holds, like rejected or archived ones, are not handed out again. take() writes the snapshot from a forked child process,
+    which sees a copy-on-write image of the engine, so matching goes on while the snapshot is written.
+    """
+    MAGIC = b'MESN'
+    VERSION = 2
+    HEADER = struct.Struct('!4sBQQI') # magic, version, journal sequence number, next order id, number of tickers
+    TEXT = struct.Struct('!B') # length of a UTF-8 ticker
+    COUNT = struct.Struct('!Q') # number of entries that follow
+    ORDER = struct.Struct('!qqqqBBqBqBII') # trader id, order id, quantity, timestamp, side, order type, price,
+                                           # has price, filled, is executed, ticker index, number of trades
+    TRADE = struct.Struct('!qq') # contra order id, P&L
+    PAIR = struct.Struct('!qq') # trader id, order id
+    BOOK = struct.Struct('!Iq') # ticker index, tick value
+    CHECKSUM = struct.Struct('!I') # CRC-32 of everything before it
+
+    def __init__(self, directory, keep=2):
+        self.directory = directory # Directory holding the snapshot files
+        self.keep = keep # Number of most recent snapshots kept on disk
+        self.__child = None # Process id of the child writing a snapshot
+        os.makedirs(directory, exist_ok=True)
+
+    def path(self, sequence):
+        return os.path.join(self.directory, 'snapshot-%020d.bin' % sequence)
+
+    def sequences(self):
+        """ Get the sequence numbers of the snapshots on disk, oldest first
+        """
+        sequences = []
+        for name in os.listdir(self.directory):
+            if name.startswith('snapshot-') and name.endswith('.bin'):
+                sequences.append(int(name[len('snapshot-'):-len('.bin')]))
+        return sorted(sequences)
+
+    def take(self, engine):
+        """ Write a snapshot of the engine from a forked child process without waiting for it.
+        The journal of the engine is committed first, so that every record the snapshot contains is on disk.
+
+        :param: a MatchingEngine
+        :return: The sequence number of the snapshot
+        """
+        self.wait()
+        sequence = 0
+        if engine.journal is not None:
+            engine.journal.commit()
+            sequence = engine.journal.sequence
+        pid = os.fork()
+        if pid == 0:
+            # The child only serializes its copy of the engine and leaves without running any cleanup of the parent
+            status = 1
+            try:
+                self.write(engine, sequence)
+                status = 0
+            finally:
+                os._exit(status)
+        self.__child = pid
+        return sequence
+
+    def wait(self):
+        """ Wait for the child writing a snapshot, if any
+
+        :return: True if there was no child or it wrote its snapshot, else False
+        """
+        if self.__child is None:
+            return True
+        pid, status = os.waitpid(self.__child, 0)
+        self.__child = None
+        return os.waitstatus_to_exitcode(status) == 0
+
+    def write(self, engine, sequence):
+        """ Write a snapshot of the engine in the calling process. The file appears atomically once complete.
+
+        :param: a MatchingEngine and the journal sequence number of its state
+        :return: The path of the snapshot
+        """
+        path = self.path(sequence)
+        tmp = path + '.tmp'
+        tickers = {}
+        for order in engine.order_history.values():
+            tickers.setdefault(order.ticker, len(tickers))
+        for ticker in engine.books:
+            tickers.setdefault(ticker, len(tickers))
+
+        with open(tmp, 'wb', buffering=1 << 20) as f:
+            crc = 0
+            chunks = []
+
+            def flush():
+                nonlocal crc, chunks
+                data = b''.join(chunks)
+                crc = zlib.crc32(data, crc)
+                f.write(data)
+                chunks = []
+
+            chunks.append(self.HEADER.pack(self.MAGIC, self.VERSION, sequence, engine.sequence.peek(), len(tickers)))
+            for ticker in tickers:
+                text = ticker.encode('utf-8')
+                chunks.append(self.TEXT.pack(len(text)) + text)
+
+            chunks.append(self.COUNT.pack(len(engine.order_history)))
+            for order in engine.order_history.values():
+                price = order.price
+                trades = order.trades
+                chunks.append(self.ORDER.pack(order.trader_id, order.order_id, order.quantity, order.timestamp,
+                                              order.side.value, order.ordertype.value,
+                                              price if price is not None else 0, price is not None, order.filled,
+                                              order.is_executed, tickers[order.ticker], len(trades)))
+                for oid, pnl in trades:
+                    chunks.append(self.TRADE.pack(oid, pnl))
+                if len(chunks) >= 4096:
+                    flush()
+
+            chunks.append(self.__ids(list(engine.order_tickers)))
+            chunks.append(self.__pairs(engine.trader_orders))
+            chunks.append(self.COUNT.pack(len(engine.books)))
+            for ticker, book in engine.books.items():
+                chunks.append(self.BOOK.pack(tickers[ticker], book.tick_value))
+                chunks.append(self.__ids(list(book.orders)))
+                chunks.append(self.__ids(list(book.trades)))
+                chunks.append(self.__pairs(book.trader_orders))
+                chunks.append(self.__ids([order.order_id for order in book.bid_side]))
+                chunks.append(self.__ids([order.order_id for order in book.offer_side]))
+                flush()
+            flush()
+            f.write(self.CHECKSUM.pack(crc))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, path)
+        self.__prune()
+        return path
+
+    def load(self, engine):
+        """ Load the latest valid snapshot into an empty engine
+
+        :param: a MatchingEngine without orders
+        :return: The journal sequence number of the loaded snapshot, 0 if there is none
+        """
+        for sequence in reversed(self.sequences()):
+            with open(self.path(sequence), 'rb') as f:
+                data = f.read()
+            try:
+                self.__load(engine, memoryview(data))
+                return sequence
+            except (ValueError, struct.error):
+                # Fall back to an older snapshot if this one is incomplete or corrupt
+                engine.books, engine.order_history, engine.order_tickers, engine.trader_orders = {}, {}, {}, {}
+                if engine.trader_index is not None:
+                    engine.trader_index.clear()
+        return 0
+
+    def __load(self, engine, view):
+        size = len(view) - self.CHECKSUM.size
+        if size < self.HEADER.size or zlib.crc32(view[:size]) != self.CHECKSUM.unpack_from(view, size)[0]:
+            raise ValueError("Corrupt snapshot")
+        magic, version, sequence, next_id, ticker_count = self.HEADER.unpack_from(view)
+        if magic != self.MAGIC or version != self.VERSION:
+            raise ValueError("Unsupported snapshot")
+        offset = self.HEADER.size
+        tickers = []
+        for i in range(ticker_count):
+            (length,) = self.TEXT.unpack_from(view, offset)
+            offset += self.TEXT.size
+            tickers.append(str(view[offset:offset + length], 'utf-8'))
+            offset += length
+
+        orders = engine.order_history
+        (count,) = self.COUNT.unpack_from(view, offset)
+        offset += self.COUNT.size
+        for i in range(count):
+            (trader_id, order_id, quantity, timestamp, side, order_type, price, has_price, filled, is_executed,
+             ticker, trade_count) = self.ORDER.unpack_from(view, offset)
+            offset += self.ORDER.size
+            order = Order(trader_id, order_id, quantity, timestamp, Side(side), tickers[ticker],
+                          OrderType(order_type), price if has_price else None)
+            order.filled = filled
+            order.is_executed = bool(is_executed)
+            for j in range(trade_count):
+                order.trades.append(self.TRADE.unpack_from(view, offset))
+                offset += self.TRADE.size
+            orders[order_id] = order
+
+        ids, offset = self.__read_ids(view, offset)
+        engine.order_tickers = {oid: orders[oid].ticker for oid in ids}
+        engine.trader_orders, offset = self.__read_pairs(view, offset)
+        (count,) = self.COUNT.unpack_from(view, offset)
+        offset += self.COUNT.size
+        for i in range(count):
+            ticker, tick_value = self.BOOK.unpack_from(view, offset)
+            offset += self.BOOK.size
+            # Adding the resting orders rebuilds the trader index of the engine, if it keeps one
+            book = EquityBook(tickers[ticker], tick_value, engine.trader_index)
+            ids, offset = self.__read_ids(view, offset)
+            book.orders = {oid: orders[oid] for oid in ids}
+            ids, offset = self.__read_ids(view, offset)
+            book.trades = {oid: orders[oid].trades for oid in ids}
+            book.trader_orders, offset = self.__read_pairs(view, offset)
+            for book_side in (book.bid_side, book.offer_side):
+                ids, offset = self.__read_ids(view, offset)
+                # Orders are added ahead of the ones at their price, so they are added from the lowest priority
+                for oid in reversed(ids):
+                    book_side.add(orders[oid])
+            engine.books[book.ticker] = book
+        # Orders with recorded ids, like replayed ones, may be ahead of the ids the generator handed out
+        engine.sequence.observe(max(next_id - 1, max(orders, default=0)))
+
+    def __ids(self, ids):
+        return self.COUNT.pack(len(ids)) + struct.pack('!%dq' % len(ids), *ids)
+
+    def __read_ids(self, view, offset):
+        (count,) = self.COUNT.unpack_from(view, offset)
+        offset += self.COUNT.size
+        ids = struct.unpack_from('!%dq' % count, view, offset)
+        return ids, offset + 8 * count
+
+    def __pairs(self, pairs):
+        return self.COUNT.pack(len(pairs)) + b''.join(self.PAIR.pack(k, v) for k, v in pairs.items())
+
+    def __read_pairs(self, view, offset):
+        (count,) = self.COUNT.unpack_from(view, offset)
+        offset += self.COUNT.size
+        pairs = {}
+        for i in range(count):
+            key, value = self.PAIR.unpack_from(view, offset)
+            pairs[key] = value
+            offset += self.PAIR.size
+        return pairs, offset
+
+    def __prune(self):
+        """ Delete the snapshots older than the most recent ones to keep
+        """
+        for sequence in self.sequences()[:-self.keep]:
+            try:
+                os.remove(self.path(sequence))
+            except OSError:
+                pass
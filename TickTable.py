@@ -0,0 +1,79 @@
+from decimal import Decimal
+
+class TickTable:
+    """ Class maps tickers to their tick size and converts decimal prices and amounts at the API edge.
+    Inside the engine prices are integer ticks and notional and P&L are integers in the smallest currency unit.
+    """
+    def __init__(self, default_tick_size='0.01', currency_digits=2):
+        self.default_tick_size = Decimal(str(default_tick_size)) # Tick size of tickers without their own setting
+        self.currency_digits = currency_digits # Number of decimal digits of the smallest currency unit
+        self.tick_sizes = {} # Dictionary of ticker mapping to its tick size
+        self.tick_value(None)
+
+
+    def set_tick_size(self, ticker, tick_size):
+        """ Set the tick size of a ticker
+
+        :param: ticker and its decimal tick size
+        """
+        old = self.tick_sizes.get(ticker)
+        self.tick_sizes[ticker] = Decimal(str(tick_size))
+        try:
+            self.tick_value(ticker)
+        except ValueError:
+            if old is None:
+                del self.tick_sizes[ticker]
+            else:
+                self.tick_sizes[ticker] = old
+            raise
+
+    def get_tick_size(self, ticker):
+        """ Get the tick size of a ticker
+        """
+        return self.tick_sizes.get(ticker, self.default_tick_size)
+
+    def tick_value(self, ticker):
+        """ Get the value of one tick in the smallest currency unit
+
+        :param: ticker
+        :return: Integer number of currency units per tick
+        """
+        value = self.get_tick_size(ticker).scaleb(self.currency_digits)
+        if value <= 0 or value != value.to_integral_value():
+            raise ValueError("Tick size must be a positive multiple of the smallest currency unit: " + str(ticker))
+        return int(value)
+
+
+    def to_ticks(self, ticker, price):
+        """ Convert a decimal price to integer ticks
+
+        :param: ticker and decimal price. A MARKET order has no price.
+        :return: Price in ticks, or None if there is no price
+        """
+        if price is None:
+            return None
+        ticks = Decimal(str(price)) / self.get_tick_size(ticker)
+        if ticks != ticks.to_integral_value():
+            raise ValueError("Price %s is not a multiple of the tick size of %s" % (price, ticker))
+        return int(ticks)
+
+    def to_price(self, ticker, ticks):
+        """ Convert integer ticks to a decimal price
+
+        :param: ticker and price in ticks
+        :return: Decimal price, or None if there is no price
+        """
+        if ticks is None:
+            return None
+        return ticks * self.get_tick_size(ticker)
+
+
+    def to_units(self, amount):
+        """ Convert a decimal amount to an integer number of the smallest currency unit
+        """
+        return int(Decimal(str(amount)).scaleb(self.currency_digits).to_integral_value())
+
+    def to_amount(self, units):
+        """ Convert an integer number of the smallest currency unit to a decimal amount
+        """
+        return Decimal(units).scaleb(-self.currency_digits)
@@ -0,0 +1,144 @@
+import numpy as np
+
+from SequenceGenerator import SequenceGenerator
+from Side import Side
+
+
+class TradeLog:
+    """ Append-only columnar store of the trades of one EquityBook, for aggregate queries.
+    Each trade is a row of COLUMNS. The matching thread only appends a tuple to a list of pending rows. Every chunk_size
+    rows the pending rows become one NumPy array per column, so the log grows in chunks and queries run vectorized over
+    the arrays of each chunk. Prices are in ticks of the ticker and P&L in the smallest currency unit, like the trades
+    of the orders: the seller of a trade gets its value and the buyer pays it.
+    """
+    COLUMNS = ('trade_id', 'price', 'quantity', 'aggressor_id', 'passive_id', 'aggressor_trader', 'passive_trader',
+               'aggressor_side', 'timestamp')
+
+    def __init__(self, ticker, tick_value=1, chunk_size=4096, clock=SequenceGenerator.timestamp):
+        self.ticker = ticker # Ticker of the trades
+        self.tick_value = tick_value # Value of one tick in the smallest currency unit
+        self.chunk_size = chunk_size # Number of rows of each chunk of arrays
+        self.clock = clock # Function returning the timestamp of a trade in nanoseconds, by default on the monotonic
+                           # clock of the order timestamps
+        self.count = 0 # Number of trades, which is also the id of the last trade
+        self.__chunks = [] # Full chunks, each a dictionary of column mapping to its array
+        self.__rows = [] # Rows not in a chunk yet
+
+    def __len__(self):
+        return self.count
+
+    def append(self, price, quantity, aggressor, passive):
+        """ Add a trade. It runs on the matching thread.
+
+        :param: trade price in ticks, quantity, and the aggressor and passive orders
+        """
+        self.count += 1
+        self.__rows.append((self.count, price, quantity, aggressor.order_id, passive.order_id, aggressor.trader_id,
+                            passive.trader_id, aggressor.side._value_, self.clock()))
+        if len(self.__rows) >= self.chunk_size:
+            self.__chunks.append(self.__chunk(self.__rows))
+            self.__rows = []
+
+    def chunks(self):
+        """ Get the trades in chunks of column arrays, oldest first, including the trades not in a full chunk yet
+        """
+        if self.__rows:
+            return self.__chunks + [self.__chunk(self.__rows)]
+        return list(self.__chunks)
+
+    def columns(self, start=None, end=None):
+        """ Get every trade as one array per column
+
+        :param: first and last timestamps of the trades, None for no bound
+        :return: Dictionary of column mapping to its array
+        """
+        chunks = self.chunks()
+        if not chunks:
+            return self.__chunk([])
+        columns = {name: np.concatenate([chunk[name] for chunk in chunks]) for name in self.COLUMNS}
+        if start is None and end is None:
+            return columns
+        mask = self.__window(columns['timestamp'], start, end)
+        return {name: column[mask] for name, column in columns.items()}
+
+    def volume(self, start=None, end=None):
+        """ Get the quantity traded
+
+        :param: first and last timestamps of the trades, None for no bound
+        :return: The quantity
+        """
+        volume = 0
+        for chunk in self.chunks():
+            mask = self.__window(chunk['timestamp'], start, end)
+            volume += int(chunk['quantity'][mask].sum())
+        return volume
+
+    def vwap(self, start=None, end=None):
+        """ Get the volume-weighted average price of the trades
+
+        :param: first and last timestamps of the trades, None for no bound
+        :return: The price in ticks. None if nothing traded.
+        """
+        volume = notional = 0
+        for chunk in self.chunks():
+            mask = self.__window(chunk['timestamp'], start, end)
+            quantity = chunk['quantity'][mask]
+            volume += int(quantity.sum())
+            notional += int((chunk['price'][mask] * quantity).sum())
+        if not volume:
+            return None
+        return notional / volume
+
+    def pnl(self, trader_id):
+        """ Get the P&L of a trader from the trades of this book
+
+        :param: trader id
+        :return: The P&L in the smallest currency unit
+        """
+        pnl = 0
+        for chunk in self.chunks():
+            flow = self.__aggressor_flow(chunk)
+            pnl += int(flow[chunk['aggressor_trader'] == trader_id].sum())
+            pnl -= int(flow[chunk['passive_trader'] == trader_id].sum())
+        return pnl
+
+    def pnl_by_trader(self):
+        """ Get the P&L of every trader from the trades of this book
+
+        :return: Dictionary of trader id mapping to its P&L in the smallest currency unit
+        """
+        columns = self.columns()
+        flow = self.__aggressor_flow(columns)
+        traders = np.concatenate([columns['aggressor_trader'], columns['passive_trader']])
+        flows = np.concatenate([flow, -flow])
+        if not len(traders):
+            return {}
+        # Sum the flows of each trader in one pass over the trades sorted by trader
+        order = np.argsort(traders, kind='stable')
+        traders, flows = traders[order], flows[order]
+        starts = np.flatnonzero(np.concatenate([[True], traders[1:] != traders[:-1]]))
+        sums = np.add.reduceat(flows, starts)
+        return dict(zip(traders[starts].tolist(), sums.tolist()))
+
+    def __aggressor_flow(self, chunk):
+        """ Get the P&L of the aggressor of each trade: positive when the aggressor sells
+        """
+        value = chunk['price'] * chunk['quantity'] * self.tick_value
+        return np.where(chunk['aggressor_side'] == Side.SELL.value, value, -value)
+
+    @staticmethod
+    def __window(timestamps, start, end):
+        mask = np.ones(len(timestamps), dtype=bool)
+        if start is not None:
+            mask &= timestamps >= start
+        if end is not None:
+            mask &= timestamps <= end
+        return mask
+
+    def __chunk(self, rows):
+        """ Turn rows into one contiguous array per column
+        """
+        table = np.array(rows, dtype=np.int64).reshape(len(rows), len(self.COLUMNS))
+        chunk = {name: np.ascontiguousarray(table[:, i]) for i, name in enumerate(self.COLUMNS)}
+        chunk['aggressor_side'] = chunk['aggressor_side'].astype(np.int8)
+        return chunk
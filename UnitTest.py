@@ -1,4 +1,12 @@
+import asyncio
+import contextlib
+import io
+import os
+import socket
+import tempfile
+import threading
 import unittest
+from decimal import Decimal
 from CommandType import CommandType
 from OrderType import OrderType
 from Side import Side
@@ -6,6 +14,31 @@ from Order import Order
 from datetime import datetime
 from MatchingEngine import MatchingEngine
 from EquityBook import EquityBook
+from BookSide import BookSide
+from TickTable import TickTable
+from SequenceGenerator import SequenceGenerator
+from Journal import Journal
+from Snapshot import Snapshot
+from OrderFlowReplay import OrderFlowReplay
+from MarketDataPublisher import MarketDataPublisher, MarketDataType
+from OrderArchive import OrderArchive
+from OrderStore import OrderStore
+from ExchangeProtocol import ExchangeProtocol
+from ExchangeRequest import ExchangeRequest, ExchangeRequestType
+from ExchangeResponse import ExchangeResponse
+from WireCodec import BinaryCodec, PickleCodec, WireCodec
+from AsyncExchangeServer import AsyncExchangeServer, SessionOutbox
+from ExchangeServer import ExchangeServer
+from ExchangeClient import ExchangeClient
+from ExecutionReport import ReportType
+from ShardedMatchingEngine import ShardedMatchingEngine
+from RiskGate import RiskGate, RiskLimits
+from LatencyStats import LatencyHistogram, LatencyStats
+from EventLog import EventLog, LogLevel, log
+try:
+    import numpy
+except ImportError:
+    numpy = None
 
 class OrderInputsTest(unittest.TestCase):
     """ Unit Test for all order attributes and functions
@@ -56,7 +89,735 @@ class OrderInputsTest(unittest.TestCase):
         o2 = Order(2, 10, 5, datetime.now(), Side.BUY, 'FB', OrderType.LIMIT, 3)
         self.assertEqual(o2.price, 3)
         self.assertEqual(o2.trades, [])
+        # Prices between two ticks are refused rather than truncated
+        self.assertEqual([Order(2, 10, 5, 0, Side.BUY, 'FB', OrderType.LIMIT, price).price
+                          for price in (100.0, '100', Decimal('100'))], [100, 100, 100])
+        for price in (100.7, '100.7', Decimal('100.5')):
+            with self.assertRaises(ValueError):
+                Order(2, 10, 5, 0, Side.BUY, 'FB', OrderType.LIMIT, price)
+
+
+    def test_TickTable(self):
+        tt = TickTable()
+        tt.set_tick_size('GOOG', '0.05')
+        self.assertEqual(tt.to_ticks('FB', '101.25'), 10125)
+        self.assertEqual(tt.to_ticks('GOOG', 101.25), 2025)
+        self.assertEqual(tt.to_ticks('GOOG', None), None)
+        self.assertEqual(tt.to_price('GOOG', 2025), Decimal('101.25'))
+        self.assertEqual(tt.tick_value('FB'), 1)
+        self.assertEqual(tt.tick_value('GOOG'), 5)
+        self.assertEqual(tt.to_units('12.34'), 1234)
+        self.assertEqual(tt.to_amount(1234), Decimal('12.34'))
+        with self.assertRaises(ValueError):
+            tt.to_ticks('GOOG', '101.26')
+        with self.assertRaises(ValueError):
+            tt.set_tick_size('FB', '0.001')
+        self.assertEqual(tt.get_tick_size('FB'), Decimal('0.01'))
+
+        # P&L is an integer number of the smallest currency unit
+        engine = MatchingEngine(tt)
+        engine.handle_order(Order(1, 1, 10, datetime.now(), Side.BUY, 'GOOG', OrderType.LIMIT, 2025))
+        engine.handle_order(Order(2, 2, 3, datetime.now(), Side.SELL, 'GOOG', OrderType.MARKET))
+        self.assertEqual(engine.get_order(2).trades, [(1, 30375)])
+
+    def test_SequenceGenerator(self):
+        seq = SequenceGenerator(block=4)
+        ids = [seq.next_id() for i in range(10)]
+        self.assertEqual(ids, list(range(1, 11)))
+        self.assertLess(seq.timestamp(), seq.timestamp())
+
+        # Ids handed out by several threads while others observe and peek stay unique
+        handed = []
+        def take():
+            for i in range(2000):
+                handed.append(seq.next_id())
+                seq.observe(seq.peek())
+        threads = [threading.Thread(target=take) for i in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(len(set(handed)), 8000)
+        self.assertGreater(min(handed), 10)
+
+        # A restarted generator continues after the persisted high-water mark
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, 'order_id.hwm')
+            seq = SequenceGenerator(path=path, block=4)
+            last = [seq.next_id() for i in range(6)][-1]
+            restarted = SequenceGenerator(path=path, block=4)
+            self.assertGreater(restarted.next_id(), last)
+
+        # The engine assigns order ids and timestamps
+        engine = MatchingEngine()
+        o1 = engine.create_order(1, 10, Side.BUY, 'FB', OrderType.LIMIT, 100)
+        o2 = engine.create_order(2, 10, 'sell', 'FB', 'limit', 100)
+        self.assertEqual((o1.order_id, o2.order_id), (1, 2))
+        self.assertLess(o1.timestamp, o2.timestamp)
+        engine.handle_order(o1)
+        self.assertEqual(engine.handle_order(o2), True)
+        self.assertEqual(engine.get_order(2).trades, [(1, 1000)])
+
+    def test_Journal(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, 'journal')
+            engine = MatchingEngine()
+            self.assertEqual(engine.recover(Journal(path, 'sync')), 0)
+            o1 = engine.create_order(1, 10, Side.BUY, 'FB', OrderType.LIMIT, 100)
+            o2 = engine.create_order(2, 4, Side.SELL, 'FB', OrderType.MARKET)
+            o3 = engine.create_order(3, 5, Side.SELL, 'GOOG', OrderType.LIMIT, 250)
+            engine.handle_orders([(CommandType.NEW, o1), (CommandType.NEW, o2), (CommandType.NEW, o3),
+                                  (CommandType.AMEND, o1.order_id, 5), (CommandType.CANCEL, o3.order_id)])
+            engine.journal.close()
+
+            # A record torn by a crash is ignored and overwritten by the next record
+            with open(path, 'ab') as f:
+                f.write(b'\x00\x00\x00\x20torn')
+
+            recovered = MatchingEngine()
+            journal = Journal(path)
+            self.assertEqual(recovered.recover(journal), 5)
+            self.assertEqual(journal.sequence, 5)
+            self.assertEqual(recovered.trader_orders, engine.trader_orders)
+            self.assertEqual(recovered.order_tickers, engine.order_tickers)
+            self.assertEqual([(o.order_id, o.quantity, o.filled, o.timestamp, o.trades)
+                              for o in recovered.books['FB'].bids],
+                             [(o1.order_id, 5, 4, o1.timestamp, [(o2.order_id, -400)])])
+            self.assertEqual(recovered.books['GOOG'].offers, [])
+
+            # New orders continue after the replayed ids and are journaled after the valid records
+            o4 = recovered.create_order(4, 1, Side.BUY, 'GOOG', OrderType.LIMIT, 1)
+            self.assertGreater(o4.order_id, o3.order_id)
+            recovered.handle_order(o4)
+            journal.close()
+            self.assertEqual([sequence for sequence, command in Journal(path).replay()], [1, 2, 3, 4, 5, 6])
+            self.assertEqual([command[0] for sequence, command in Journal(path).replay(after=4)],
+                             [CommandType.CANCEL, CommandType.NEW])
+
+    def test_Snapshot(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            engine = MatchingEngine()
+            engine.recover(Journal(os.path.join(tmp, 'journal')), Snapshot(os.path.join(tmp, 'snapshots')), 3)
+            o1 = engine.create_order(1, 10, Side.BUY, 'FB', OrderType.LIMIT, 100)
+            o2 = engine.create_order(2, 4, Side.SELL, 'FB', OrderType.MARKET)
+            o3 = engine.create_order(3, 5, Side.BUY, 'FB', OrderType.LIMIT, 100)
+            o4 = engine.create_order(4, 2, Side.BUY, 'GOOG', OrderType.MARKET)
+            o5 = engine.create_order(5, 1, Side.SELL, 'GOOG', OrderType.LIMIT, 300)
+            engine.handle_orders([(CommandType.NEW, o1), (CommandType.NEW, o2), (CommandType.NEW, o3),
+                                  (CommandType.NEW, o4), (CommandType.NEW, o5)])
+            self.assertTrue(engine.snapshots.wait())
+            engine.journal.close()
+            self.assertEqual(Snapshot(os.path.join(tmp, 'snapshots')).sequences(), [3])
+
+            # Recovery loads the snapshot of the first 3 commands and replays the last 2
+            recovered = MatchingEngine()
+            self.assertEqual(recovered.recover(Journal(os.path.join(tmp, 'journal')),
+                                               Snapshot(os.path.join(tmp, 'snapshots'))), 2)
+            self.assertEqual(recovered.trader_orders, engine.trader_orders)
+            self.assertEqual(recovered.order_tickers, engine.order_tickers)
+            self.assertEqual([(o.order_id, o.filled, o.trades) for o in recovered.books['FB'].bids],
+                             [(o3.order_id, 0, []), (o1.order_id, 4, [(o2.order_id, -400)])])
+            self.assertEqual([(o.order_id, o.filled, o.trades) for o in recovered.order_history.values()],
+                             [(o.order_id, o.filled, o.trades) for o in engine.order_history.values()])
+            self.assertGreater(recovered.create_order(6, 1, Side.BUY, 'FB', OrderType.MARKET).order_id, o5.order_id)
+
+            # The snapshot keeps the next order id, so the ids of orders it does not hold are not handed out again
+            engine = MatchingEngine()
+            engine.handle_order(engine.create_order(1, 10, Side.BUY, 'FB', OrderType.LIMIT, 100))
+            # An order rejected before it reaches the engine, like by the risk checks, keeps its id
+            rejected = engine.create_order(2, 10, Side.SELL, 'FB', OrderType.LIMIT, 100)
+            snapshots = Snapshot(os.path.join(tmp, 'next-id'))
+            snapshots.write(engine, 1)
+            recovered = MatchingEngine()
+            self.assertEqual(snapshots.load(recovered), 1)
+            self.assertGreater(recovered.create_order(3, 1, Side.BUY, 'FB', OrderType.MARKET).order_id,
+                               rejected.order_id)
+
+    def test_OrderFlowReplay(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            flow = os.path.join(tmp, 'flow.csv')
+            with open(flow, 'w') as f:
+                f.write(','.join(OrderFlowReplay.FIELDS) + '\n'
+                        '1,NEW,7,1,FB,BUY,LIMIT,10,1.00\n'
+                        '2,NEW,8,2,FB,SELL,MARKET,4,\n'
+                        '3,AMEND,7,,,,,5,\n'
+                        '4,NEW,9,3,FB,SELL,LIMIT,8,0.99\n'
+                        '5,CANCEL,9,,,,,,\n')
+            replay = OrderFlowReplay(chunk_size=2)
+            replay.run(flow, os.path.join(tmp, 'trades.csv'), os.path.join(tmp, 'events.csv'))
+            self.assertEqual((replay.commands, replay.trades), (5, 2))
+            # Recorded order ids and timestamps are kept, and every row reflects the order when it was handled
+            self.assertEqual(replay.engine.order_history[7].timestamp, 1)
+            with open(os.path.join(tmp, 'trades.csv')) as f:
+                self.assertEqual(f.read().splitlines(), ['sequence,ticker,order_id,contra_order_id,pnl',
+                                                         '2,FB,8,7,400', '4,FB,9,7,100'])
+            with open(os.path.join(tmp, 'events.csv')) as f:
+                self.assertEqual(f.read().splitlines(), ['sequence,command,order_id,result,filled,remaining',
+                                                         '1,NEW,7,False,0,10', '2,NEW,8,True,4,0',
+                                                         '3,AMEND,7,True,,', '4,NEW,9,False,1,7',
+                                                         '5,CANCEL,9,True,,'])
+
+            # Replaying the flow again gives the same books
+            again = OrderFlowReplay()
+            again.run(flow)
+            self.assertEqual(again.engine.trader_orders, replay.engine.trader_orders)
+            self.assertEqual([(o.order_id, o.filled) for o in again.engine.order_history.values()],
+                             [(o.order_id, o.filled) for o in replay.engine.order_history.values()])
+
+    def test_MarketDataPublisher(self):
+        engine = MatchingEngine()
+        o1 = engine.create_order(1, 10, Side.BUY, 'FB', OrderType.LIMIT, 100)
+        engine.handle_order(o1)
+        with MarketDataPublisher(engine) as market_data:
+            updates = []
+            market_data.subscribe(updates.extend)
+            o2 = engine.create_order(2, 5, Side.BUY, 'FB', OrderType.LIMIT, 100)
+            o3 = engine.create_order(3, 4, Side.SELL, 'FB', OrderType.LIMIT, 100)
+            engine.handle_orders([(CommandType.NEW, o2), (CommandType.NEW, o3), (CommandType.AMEND, o1.order_id, 2),
+                                  (CommandType.CANCEL, o2.order_id)])
+            market_data.flush()
+            # Levels are kept up to date in the book as orders are added, filled, amended and removed
+            self.assertEqual((engine.books['FB'].bid_side.levels[100].quantity,
+                              len(engine.books['FB'].bid_side.levels[100])), (2, 1))
+            # A late joiner starts with a snapshot, then gets every update with the next sequence number
+            self.assertEqual(updates, [
+                ('FB', 2, MarketDataType.SNAPSHOT, ([(100, 10, 1)], [])),
+                ('FB', 3, MarketDataType.LEVEL, (Side.BUY, 100, 15, 2)),
+                ('FB', 4, MarketDataType.TOP, (100, 15, None, 0)),
+                ('FB', 5, MarketDataType.TRADE, (100, 4, Side.SELL)),
+                ('FB', 6, MarketDataType.LEVEL, (Side.BUY, 100, 11, 2)),
+                ('FB', 7, MarketDataType.TOP, (100, 11, None, 0)),
+                ('FB', 8, MarketDataType.LEVEL, (Side.BUY, 100, 3, 2)),
+                ('FB', 9, MarketDataType.TOP, (100, 3, None, 0)),
+                ('FB', 10, MarketDataType.LEVEL, (Side.BUY, 100, 2, 1)),
+                ('FB', 11, MarketDataType.TOP, (100, 2, None, 0))])
+            self.assertEqual(market_data.snapshot('FB'), ('FB', 11, MarketDataType.SNAPSHOT, ([(100, 2, 1)], [])))
+        self.assertIsNone(engine.market_data)
+
+    @unittest.skipIf(numpy is None, "TradeLog needs NumPy")
+    def test_TradeLog(self):
+        engine = MatchingEngine()
+        logs = engine.log_trades(chunk_size=1)
+        o1 = engine.create_order(1, 10, Side.BUY, 'FB', OrderType.LIMIT, 100)
+        o2 = engine.create_order(2, 4, Side.SELL, 'FB', OrderType.LIMIT, 100)
+        o3 = engine.create_order(3, 6, Side.SELL, 'FB', OrderType.LIMIT, 101)
+        o4 = engine.create_order(4, 8, Side.BUY, 'FB', OrderType.MARKET)
+        engine.handle_orders([(CommandType.NEW, o1), (CommandType.NEW, o2), (CommandType.NEW, o3),
+                              (CommandType.NEW, o4)])
+        log = logs['FB']
+        columns = log.columns()
+        self.assertEqual(len(log), 2)
+        self.assertEqual(columns['trade_id'].tolist(), [1, 2])
+        self.assertEqual(columns['price'].tolist(), [100, 101])
+        self.assertEqual(columns['quantity'].tolist(), [4, 6])
+        self.assertEqual(columns['aggressor_id'].tolist(), [o2.order_id, o4.order_id])
+        self.assertEqual(columns['passive_id'].tolist(), [o1.order_id, o3.order_id])
+        self.assertEqual(columns['aggressor_side'].tolist(), [Side.SELL.value, Side.BUY.value])
+        self.assertEqual(log.volume(), 10)
+        self.assertEqual(log.vwap(), 100.6)
+        self.assertEqual(log.vwap(start=int(columns['timestamp'][1])), 101)
+        # Trades are stamped on the clock of the orders
+        self.assertTrue(o4.timestamp <= columns['timestamp'][1] <= engine.sequence.timestamp())
+        # The P&L of the log matches the trades of the orders
+        self.assertEqual(log.pnl_by_trader(), {1: -400, 2: 400, 3: 606, 4: -606})
+        self.assertEqual([engine.trader_pnl(order.trader_id) for order in (o1, o2, o3, o4)],
+                         [sum(pnl for oid, pnl in order.trades) for order in (o1, o2, o3, o4)])
+
+    def test_OrderArchive(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            engine = MatchingEngine()
+            o1 = engine.create_order(1, 10, Side.BUY, 'FB', OrderType.LIMIT, 100)
+            o2 = engine.create_order(2, 4, Side.SELL, 'FB', OrderType.LIMIT, 100)
+            o3 = engine.create_order(3, 5, Side.SELL, 'FB', OrderType.LIMIT, 110)
+            engine.handle_orders([(CommandType.NEW, o1), (CommandType.NEW, o2)])
+            # A tiny segment size starts a new segment file for every order
+            archive = OrderArchive(tmp, segment_size=1, cache_size=1)
+            engine.archive_orders(archive)
+            # Filled and cancelled orders leave the engine, resting orders stay
+            self.assertEqual(list(engine.order_history), [o1.order_id])
+            engine.handle_order(o3)
+            self.assertEqual(engine.cancel_order(o1.order_id), True)
+            self.assertEqual(list(engine.order_history), [o3.order_id])
+            self.assertEqual(list(engine.books['FB'].orders), [o3.order_id])
+            self.assertEqual(engine.order_tickers, {o3.order_id: 'FB'})
+            self.assertIs(engine.get_order(o1.order_id), o1)
+            archive.flush()
+            self.assertEqual(len(archive.segments()), 2)
+            # Archived orders are read back from disk, through the LRU cache
+            for order in (o1, o2, o1):
+                archived = engine.get_order(order.order_id)
+                self.assertIsNot(archived, order)
+                self.assertEqual((archived.order_id, archived.trader_id, archived.side, archived.price, archived.filled,
+                                  archived.trades), (order.order_id, order.trader_id, order.side, order.price,
+                                                     order.filled, order.trades))
+            self.assertIsNone(engine.get_order(99))
+            archive.close()
+            with OrderArchive(tmp) as reopened:
+                self.assertEqual(reopened.get(o2.order_id).trades, [(o1.order_id, 400)])
+                self.assertEqual([order.order_id for order in reopened.orders()], [o1.order_id, o2.order_id])
+
+    def test_OrderStore(self):
+        engine = MatchingEngine()
+        store = OrderStore()
+        engine.archive_orders(store)
+        o1 = engine.create_order(1, 10, Side.BUY, 'FB', OrderType.LIMIT, 100)
+        o2 = engine.create_order(2, 4, Side.SELL, 'FB', OrderType.MARKET)
+        o3 = engine.create_order(3, 5, Side.SELL, 'GOOG', OrderType.IOC, 300)
+        engine.handle_orders([(CommandType.NEW, o1), (CommandType.NEW, o2), (CommandType.NEW, o3),
+                              (CommandType.CANCEL, o1.order_id)])
+        self.assertEqual((len(store), engine.order_history), (3, {}))
+        # Stored orders come back as new orders with the same state
+        for order in (o1, o2, o3):
+            stored = engine.get_order(order.order_id)
+            self.assertIsNot(stored, order)
+            self.assertEqual((stored.order_id, stored.trader_id, stored.quantity, stored.timestamp, stored.side,
+                              stored.ticker, stored.ordertype, stored.price, stored.filled, stored.is_executed,
+                              stored.trades),
+                             (order.order_id, order.trader_id, order.quantity, order.timestamp, order.side,
+                              order.ticker, order.ordertype, order.price, order.filled, order.is_executed,
+                              order.trades))
+        self.assertIsNone(engine.get_order(99))
+        # Order ids far from the others are stored too
+        far = Order(4, 1 << 40, 1, 0, Side.BUY, 'FB', OrderType.LIMIT, 100)
+        store.add(far)
+        self.assertEqual((store.get(far.order_id).order_id, store.get(-1), len(store)), (far.order_id, None, 4))
+        self.assertEqual([order.order_id for order in store.orders()],
+                         [o1.order_id, o2.order_id, o3.order_id, far.order_id])
+
+    def test_ExchangeProtocol(self):
+        a, b = socket.socketpair()
+        with a, b:
+            # Frames larger than a single recv are delivered whole and in order
+            big = bytes(range(256)) * 1000
+            req = ExchangeRequest(ExchangeRequestType.CANCEL, 1, order_id=7, request_id=42)
+            sender = threading.Thread(target=lambda: [ExchangeProtocol.send_frame(a, frame)
+                                                      for frame in [big, b'', req.dump()]])
+            sender.start()
+            self.assertEqual(ExchangeProtocol.recv_frame(b), big)
+            self.assertEqual(ExchangeProtocol.recv_frame(b), b'')
+            loaded = ExchangeRequest.load(ExchangeProtocol.recv_frame(b))
+            self.assertEqual((loaded.request_id, loaded.order_id), (42, 7))
+            sender.join()
+            a.close()
+            self.assertEqual(ExchangeProtocol.recv_frame(b), None)
+
+    def test_AsyncExchangeServer(self):
+        with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+            server = AsyncExchangeServer(port=0, window=4)
+            thread = threading.Thread(target=server.serve_forever)
+            thread.start()
+            try:
+                port = server.server_address[1]
+                with ExchangeClient(1, server_port=port) as buyer, ExchangeClient(2, server_port=port) as seller:
+                    reports = buyer.reports()
+                    buy_id = buyer.submit_order(OrderType.LIMIT, Side.BUY, 'FB', 10, 10)
+                    sell_id = seller.submit_order(OrderType.LIMIT, Side.SELL, 'FB', 10, 10)
+                    # The fill of the resting order is pushed to its trader
+                    report_type, report = reports.get(timeout=5)
+                    self.assertEqual((report_type, report.order_id, report.filled), (ReportType.FILL, buy_id, 10))
+                    self.assertTrue(buyer.get_order(buy_id).is_fulfilled())
+                    self.assertEqual(seller.get_order(sell_id).filled, 10)
+                    self.assertEqual(seller.get_order(sell_id).pnl, 10000)
+
+                    # More requests in flight than the session window are all answered, in order
+                    futures = [buyer.send_request(ExchangeRequest(ExchangeRequestType.GET, 1, order_id=buy_id))
+                               for i in range(20)]
+                    self.assertTrue(all(f.result(5).order.order_id == buy_id for f in futures))
+
+                    # A batch runs its commands in order in one request
+                    results = seller.submit_batch([(CommandType.NEW, OrderType.LIMIT, Side.SELL, 'FB', 5, '10.50'),
+                                                   (CommandType.AMEND, sell_id + 1, 3),
+                                                   (CommandType.CANCEL, sell_id + 1),
+                                                   (CommandType.CANCEL, sell_id + 1)])
+                    self.assertEqual(results, [(False, sell_id + 1), (True, sell_id + 1), (True, sell_id + 1),
+                                               (False, sell_id + 1)])
+                    # The server keeps no statistics unless it is instrumented
+                    self.assertIsNone(buyer.get_stats())
+                # Requests on a closed session fail instead of raising
+                self.assertFalse(buyer.cancel_order(buy_id))
+                self.assertFalse(buyer.amend_order(buy_id, 1))
+            finally:
+                server.shutdown()
+                server.server_close()
+                thread.join()
+
+    def test_SessionOutbox(self):
+        class StalledWriter:
+            # Stream writer of a trader that does not read until it is told to
+            def __init__(self):
+                self.transport = self
+                self.frames = []
+                self.aborted = False
+                self.reading = asyncio.Event()
+
+            def write(self, frame):
+                self.frames.append(frame)
+
+            async def drain(self):
+                await self.reading.wait()
+                if self.aborted:
+                    raise ConnectionResetError()
+
+            def abort(self):
+                self.aborted = True
+                self.reading.set()
+
+        async def run():
+            # Frames are written in order and release the window of their request
+            writer = StalledWriter()
+            writer.reading.set()
+            outbox = SessionOutbox(None, writer, 2)
+            window = asyncio.Semaphore(1)
+            await window.acquire()
+            outbox.send(b'1', window)
+            outbox.send(b'2')
+            await outbox.close()
+            self.assertEqual(writer.frames, [b'1', b'2'])
+            self.assertFalse(window.locked())
+
+            # A session that stops reading is disconnected once its queue is full
+            writer = StalledWriter()
+            outbox = SessionOutbox(None, writer, 2)
+            await window.acquire()
+            outbox.send(b'1')
+            await asyncio.sleep(0)
+            outbox.send(b'2', window)
+            outbox.send(b'3')
+            self.assertFalse(writer.aborted)
+            with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+                outbox.send(b'4')
+                log.flush()
+            self.assertTrue(writer.aborted)
+            self.assertTrue(outbox.closed)
+            await outbox.close()
+            self.assertEqual(writer.frames, [b'1'])
+            # The request whose response was dropped does not hold its window
+            self.assertFalse(window.locked())
+
+        asyncio.run(run())
+
+    def test_ExchangeServer(self):
+        with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+            server = ExchangeServer(port=0)
+            thread = threading.Thread(target=server.serve_forever)
+            thread.start()
+            try:
+                with ExchangeClient(1, server_port=server.server_address[1]) as client:
+                    # A request the engine raises on is answered with a failure and the session goes on
+                    response = client.send_request(ExchangeRequest(ExchangeRequestType.SUBMIT, 1,
+                                                                   order_type=OrderType.LIMIT, order_side=Side.BUY,
+                                                                   ticker='FB', quantity=10)).result(5)
+                    self.assertFalse(response.success)
+                    self.assertIsNone(client.submit_order(OrderType.LIMIT, Side.BUY, 'FB', 10))
+                    self.assertIsNotNone(client.submit_order(OrderType.LIMIT, Side.BUY, 'FB', 10, 10))
+            finally:
+                server.shutdown()
+                server.server_close()
+                thread.join()
+
+    def test_EventLog(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            stream = io.StringIO()
+            event_log = EventLog(LogLevel.INFO, stream, capacity=3, interval=60)
+            path = os.path.join(tmp, 'events.bin')
+            event_log.capture(path)
+            event_log.debug("Not kept %d", 1)
+            event_log.info("SUBMIT order %d of %s: %s", 1, 'FB', True)
+            self.assertEqual(stream.getvalue(), '')
+            event_log.flush()
+            self.assertTrue(stream.getvalue().endswith(" INFO    SUBMIT order 1 of FB: True\n"))
+
+            # The oldest events are dropped once the buffer is full
+            for i in range(2, 6):
+                event_log.warning("Cancel order error: order id %d not found", i)
+            event_log.error("Failed %s request: %s", 'GET', None)
+            self.assertEqual(event_log.dropped, 2)
+            event_log.level = 'error'
+            event_log.warning("Not kept %d", 6)
+            event_log.close()
+            self.assertEqual(len(stream.getvalue().splitlines()), 4)
+            self.assertEqual([(level, message % args) for timestamp, level, message, args in
+                              EventLog.read_capture(path)],
+                             [(LogLevel.INFO, "SUBMIT order 1 of FB: True"),
+                              (LogLevel.WARNING, "Cancel order error: order id 4 not found"),
+                              (LogLevel.WARNING, "Cancel order error: order id 5 not found"),
+                              (LogLevel.ERROR, "Failed GET request: None")])
+
+    def test_LatencyStats(self):
+        histogram = LatencyHistogram(precision=4)
+        for value in range(1, 1001):
+            histogram.record(value)
+        # Percentiles are the largest value of their bucket, within 1 / 2 ** precision of the exact value
+        self.assertEqual(histogram.percentile(50), 511)
+        self.assertEqual(histogram.percentile(99.9), 1000)
+        self.assertEqual(histogram.summary(), {'count': 1000, 'mean': 500.5, 'p50': 511, 'p99': 991, 'p999': 1000,
+                                               'max': 1000})
+        for percent in (1, 10, 50, 90, 99):
+            self.assertLessEqual(abs(histogram.percentile(percent) - 10 * percent), 10 * percent / 16)
+
+        for server_class in (ExchangeServer, AsyncExchangeServer):
+            with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+                server = server_class(port=0, instrument=True)
+                thread = threading.Thread(target=server.serve_forever)
+                thread.start()
+                try:
+                    with ExchangeClient(1, server_port=server.server_address[1]) as client:
+                        order_id = client.submit_order(OrderType.LIMIT, Side.BUY, 'FB', 10, 10)
+                        client.cancel_order(order_id)
+                        client.get_order(order_id)
+                        stats = client.get_stats()
+                finally:
+                    server.shutdown()
+                    server.server_close()
+                    thread.join()
+            # Every stage of the requests is timed, and the requests of each ticker are counted
+            for stage in LatencyStats.STAGES:
+                for request_type in (ExchangeRequestType.SUBMIT, ExchangeRequestType.CANCEL, ExchangeRequestType.GET):
+                    summary = stats['latency'][(stage, request_type)]
+                    self.assertEqual(summary['count'], 1)
+                    self.assertGreaterEqual(summary['p999'], summary['p50'])
+            self.assertEqual(stats['tickers']['FB']['requests'], 2)
+            self.assertGreater(stats['elapsed'], 0)
+
+    def test_ShardedMatchingEngine(self):
+        with ShardedMatchingEngine(2) as engine:
+            # Pick two tickers living on different shards
+            tickers = ['T%d' % i for i in range(10)]
+            fb = tickers[0]
+            other = next(t for t in tickers if engine.shard_of(t) != engine.shard_of(fb))
+
+            buy = engine.create_order(1, 10, Side.BUY, fb, OrderType.LIMIT, 100)
+            self.assertFalse(engine.handle_order(buy))
+            # The active order of trader 1 blocks its orders on the other shard too
+            self.assertFalse(engine.handle_order(engine.create_order(1, 5, Side.BUY, other, OrderType.LIMIT, 100)))
+
+            # A fill on the first shard releases both traders
+            sell = engine.create_order(2, 10, Side.SELL, fb, OrderType.LIMIT, 100)
+            second = engine.create_order(1, 5, Side.BUY, other, OrderType.LIMIT, 100)
+            self.assertEqual(engine.handle_orders([(CommandType.NEW, sell), (CommandType.NEW, second)]), [True, False])
+            self.assertEqual((sell.filled, sell.trades), (10, [(buy.order_id, 1000)]))
+            self.assertEqual(engine.get_order(buy.order_id).filled, 10)
+            self.assertEqual(engine.trader_orders, {1: second.order_id})
+
+            self.assertTrue(engine.amend_order(second.order_id, 2))
+            self.assertEqual(engine.get_order(second.order_id).quantity, 2)
+            self.assertTrue(engine.cancel_order(second.order_id))
+            self.assertEqual(engine.trader_orders, {})
+            self.assertIsNone(engine.get_order(12345))
+
+    def test_RiskGate(self):
+        gate = RiskGate(MatchingEngine(), RiskLimits(max_quantity=100, max_notional=100000, max_position=150,
+                                                     price_collar=10))
+        gate.set_limits(3, RiskLimits(max_open_orders=0))
+        gate.reports = []
+        self.assertEqual(gate.engine.reports, [])
+        self.assertFalse(gate.handle_order(gate.create_order(1, 101, Side.BUY, 'FB', OrderType.LIMIT, 100)))
+        # 60 shares at 100 ticks of 1 cent are 6000 dollars, or 600000 cents
+        self.assertFalse(gate.handle_order(gate.create_order(1, 60, Side.BUY, 'FB', OrderType.LIMIT, 10000)))
+        self.assertFalse(gate.handle_order(gate.create_order(3, 1, Side.BUY, 'FB', OrderType.LIMIT, 100)))
+        self.assertEqual(gate.rejected, {'order size': 1, 'notional': 1, 'open orders': 1})
+
+        sell = gate.create_order(2, 100, Side.SELL, 'FB', OrderType.LIMIT, 100)
+        self.assertFalse(gate.handle_order(sell))
+        self.assertEqual((gate.open_orders, gate.exposures[(2, 'FB')].selling), ({2: 1}, 100))
+        self.assertTrue(gate.amend_order(sell.order_id, 80))
+        self.assertEqual(gate.exposures[(2, 'FB')].selling, 80)
+        self.assertTrue(gate.handle_order(gate.create_order(1, 60, Side.BUY, 'FB', OrderType.LIMIT, 100)))
+        self.assertEqual((gate.position(1, 'FB'), gate.position(2, 'FB')), (60, -60))
+        self.assertEqual((gate.exposures[(2, 'FB')].selling, gate.last_prices), (20, {'FB': 100}))
+
+        # The collar is 10 ticks around the last trade and MARKET orders are not collared
+        self.assertFalse(gate.handle_order(gate.create_order(1, 10, Side.BUY, 'FB', OrderType.LIMIT, 111)))
+        self.assertEqual(gate.rejected['price collar'], 1)
+        # Trader 2 is short 60, so it may sell 90 more
+        self.assertTrue(gate.cancel_order(sell.order_id))
+        self.assertEqual((gate.open_orders, gate.exposures[(2, 'FB')].selling), ({}, 0))
+        self.assertFalse(gate.handle_order(gate.create_order(2, 100, Side.SELL, 'FB', OrderType.LIMIT, 100)))
+        self.assertEqual(gate.rejected['position'], 1)
+        self.assertFalse(gate.handle_order(gate.create_order(2, 90, Side.SELL, 'FB', OrderType.MARKET)))
+        self.assertEqual(gate.exposures[(2, 'FB')].selling, 90)
+        self.assertEqual(gate.trader_orders, {2: gate.engine.books['FB'].offer_side.top().order_id})
+
+        # Without default limits only the traders with their own are tracked, until they get some
+        gate = RiskGate(MatchingEngine())
+        gate.set_limits(1, RiskLimits(max_position=100))
+        gate.handle_order(gate.create_order(1, 10, Side.BUY, 'FB', OrderType.LIMIT, 100))
+        gate.handle_order(gate.create_order(2, 30, Side.SELL, 'FB', OrderType.LIMIT, 100))
+        self.assertEqual({key: e.position for key, e in gate.exposures.items()}, {(1, 'FB'): 10})
+        self.assertEqual(gate.open_orders, {})
+        gate.set_limits(2, RiskLimits(max_position=100))
+        self.assertEqual((gate.position(2, 'FB'), gate.exposures[(2, 'FB')].selling), (-10, 20))
+        self.assertEqual(gate.open_orders, {2: 1})
+
+        # A recovered gate rebuilds the exposures from the recovered orders
+        with tempfile.TemporaryDirectory() as tmp:
+            limits = RiskLimits(max_open_orders=1)
+            gate = RiskGate(MatchingEngine(), limits)
+            gate.recover(Journal(os.path.join(tmp, 'journal')))
+            sell = gate.create_order(2, 100, Side.SELL, 'FB', OrderType.LIMIT, 100)
+            gate.handle_order(sell)
+            gate.handle_order(gate.create_order(1, 60, Side.BUY, 'FB', OrderType.LIMIT, 100))
+            gate.handle_order(gate.create_order(3, 5, Side.BUY, 'FB', OrderType.LIMIT, 99))
+            gate.engine.journal.close()
+            recovered = RiskGate(MatchingEngine(), limits)
+            self.assertEqual(recovered.recover(Journal(os.path.join(tmp, 'journal'))), 3)
+            self.assertEqual({key: (e.position, e.buying, e.selling) for key, e in recovered.exposures.items()},
+                             {key: (e.position, e.buying, e.selling) for key, e in gate.exposures.items()})
+            self.assertEqual(recovered.open_orders, {2: 1, 3: 1})
+            self.assertFalse(recovered.handle_order(recovered.create_order(3, 1, Side.BUY, 'GOOG', OrderType.LIMIT, 1)))
+            self.assertEqual(recovered.rejected, {'open orders': 1})
+            self.assertTrue(recovered.cancel_order(sell.order_id))
+            self.assertEqual((recovered.open_orders, recovered.exposures[(2, 'FB')].selling), ({3: 1}, 0))
+
+        # Filled orders archived before the snapshot still count in the recovered positions
+        with tempfile.TemporaryDirectory() as tmp:
+            limits = RiskLimits(max_position=100)
+            for restart in (False, True):
+                engine = MatchingEngine()
+                engine.archive_orders(OrderArchive(os.path.join(tmp, 'archive')))
+                gate = RiskGate(engine, limits)
+                gate.recover(Journal(os.path.join(tmp, 'journal')), Snapshot(os.path.join(tmp, 'snapshots')), 2)
+                if not restart:
+                    gate.handle_order(gate.create_order(2, 60, Side.SELL, 'FB', OrderType.LIMIT, 100))
+                    gate.handle_order(gate.create_order(1, 60, Side.BUY, 'FB', OrderType.LIMIT, 100))
+                    self.assertTrue(engine.snapshots.wait())
+                engine.journal.close()
+                engine.archive.close()
+            self.assertEqual((engine.order_history, gate.position(1, 'FB'), gate.position(2, 'FB')), ({}, 60, -60))
+            self.assertFalse(gate.handle_order(gate.create_order(1, 50, Side.BUY, 'FB', OrderType.LIMIT, 100)))
+            self.assertEqual(gate.rejected, {'position': 1})
+
+        # The servers answer a rejected order with a failed response without an order id
+        with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+            server = AsyncExchangeServer(port=0, matching_engine=RiskGate(MatchingEngine(), RiskLimits(max_quantity=10)))
+            thread = threading.Thread(target=server.serve_forever)
+            thread.start()
+            try:
+                with ExchangeClient(1, server_port=server.server_address[1]) as client:
+                    self.assertIsNone(client.submit_order(OrderType.LIMIT, Side.BUY, 'FB', 11, 10))
+                    self.assertEqual(client.submit_batch([(CommandType.NEW, OrderType.LIMIT, Side.BUY, 'FB', 11, 10),
+                                                          (CommandType.NEW, OrderType.LIMIT, Side.BUY, 'FB', 10, 10)]),
+                                     [(False, None), (False, 3)])
+            finally:
+                server.shutdown()
+                server.server_close()
+                thread.join()
+
+    def test_Multiple_Orders(self):
+        engine = MatchingEngine(multiple_orders=True)
+        engine.reports = []
+        quotes = [engine.create_order(1, 10, Side.BUY, 'FB', OrderType.LIMIT, 99),
+                  engine.create_order(1, 10, Side.SELL, 'FB', OrderType.LIMIT, 101),
+                  engine.create_order(1, 5, Side.BUY, 'GOOG', OrderType.LIMIT, 500)]
+        for quote in quotes:
+            self.assertFalse(engine.handle_order(quote))
+        self.assertEqual(engine.trader_orders, {})
+        self.assertEqual({ticker: list(orders) for ticker, orders in engine.trader_index[1].items()},
+                         {'FB': [quotes[0].order_id, quotes[1].order_id], 'GOOG': [quotes[2].order_id]})
+
+        # A filled order leaves the index of its trader
+        self.assertTrue(engine.handle_order(engine.create_order(2, 10, Side.BUY, 'FB', OrderType.LIMIT, 101)))
+        self.assertEqual(list(engine.trader_index[1]['FB']), [quotes[0].order_id])
+        self.assertEqual(engine.cancel_all(1, 'FB'), [quotes[0].order_id])
+        self.assertEqual(engine.cancel_all(1, 'FB'), [])
+        self.assertEqual(engine.cancel_all(1), [quotes[2].order_id])
+        self.assertEqual((engine.trader_index, engine.books['FB'].bids), ({}, []))
+        self.assertEqual([report_type for report_type, report in engine.reports],
+                         [ReportType.FILL, ReportType.FILL, ReportType.CANCEL_ACK, ReportType.CANCEL_ACK])
+
+        # A book cancels the orders of a trader on its own ticker
+        book = EquityBook('FB', trader_index={})
+        book.handle_order(Order(1, 1, 10, datetime.now(), Side.BUY, 'FB', OrderType.LIMIT, 99))
+        book.handle_order(Order(1, 2, 10, datetime.now(), Side.BUY, 'FB', OrderType.LIMIT, 98))
+        self.assertEqual((book.cancel_all(1), book.bids, book.trader_index), ([1, 2], [], {}))
+
+        # With one active order per trader, cancel_all cancels that order
+        single = MatchingEngine()
+        order = single.create_order(1, 10, Side.BUY, 'FB', OrderType.LIMIT, 99)
+        single.handle_order(order)
+        self.assertEqual(single.cancel_all(1, 'GOOG'), [])
+        self.assertEqual((single.cancel_all(1), single.trader_orders), ([order.order_id], {}))
+
+        # The open order limit of the risk gate counts the orders of each trader
+        gate = RiskGate(MatchingEngine(multiple_orders=True), RiskLimits(max_open_orders=2))
+        for price in (99, 98, 97):
+            gate.handle_order(gate.create_order(1, 10, Side.BUY, 'FB', OrderType.LIMIT, price))
+        self.assertEqual((gate.open_orders, gate.rejected), ({1: 2}, {'open orders': 1}))
+        self.assertEqual(len(gate.cancel_all(1)), 2)
+        self.assertEqual((gate.open_orders, gate.exposures[(1, 'FB')].buying), ({}, 0))
+
+    def test_WireCodec(self):
+        codec = BinaryCodec()
+        requests = [ExchangeRequest(ExchangeRequestType.SUBMIT, 3, order_type=OrderType.IOC, order_side='sell',
+                                    ticker='GOOG', quantity=12, price=10125, request_id=9),
+                    ExchangeRequest(ExchangeRequestType.SUBMIT, 3, order_type=OrderType.MARKET, order_side=Side.BUY,
+                                    ticker='FB', quantity=5, request_id=10),
+                    ExchangeRequest(ExchangeRequestType.AMEND, 3, order_id=2 ** 40, quantity=4, request_id=11),
+                    ExchangeRequest(ExchangeRequestType.CANCEL, 3, order_id=5, request_id=12),
+                    ExchangeRequest(ExchangeRequestType.GET, 3, order_id=6, request_id=13),
+                    ExchangeRequest(ExchangeRequestType.CANCEL_ALL, 3, ticker='FB', request_id=16),
+                    ExchangeRequest(ExchangeRequestType.CANCEL_ALL, 3, request_id=17)]
+        fields = ['request_id', 'request_type', 'trader_id', 'order_id', 'order_type', 'ticker', 'quantity', 'price']
+        for req in requests:
+            loaded = codec.decode_request(codec.encode_request(req))
+            self.assertEqual([getattr(loaded, f) for f in fields], [getattr(req, f) for f in fields])
+        self.assertEqual(codec.decode_request(codec.encode_request(requests[0])).order_side, Side.SELL)
+        self.assertEqual(codec.decode_request(codec.encode_request(requests[1])).price, None)
+        with self.assertRaises(ValueError):
+            codec.decode_request(codec.encode_request(requests[0])[:-3])
+
+        # A batch carries its commands in order, and its response the result of each command
+        batch = codec.decode_request(codec.encode_request(
+            ExchangeRequest(ExchangeRequestType.SUBMIT_BATCH, 3, commands=requests[:4], request_id=14)))
+        self.assertEqual((batch.request_type, batch.request_id), (ExchangeRequestType.SUBMIT_BATCH, 14))
+        self.assertEqual([[getattr(c, f) for f in fields[1:]] for c in batch.commands],
+                         [[getattr(r, f) for f in fields[1:]] for r in requests[:4]])
+        with self.assertRaises(ValueError):
+            codec.decode_request(codec.encode_request(ExchangeRequest(ExchangeRequestType.SUBMIT_BATCH, 3,
+                                                                      commands=requests[:2]))[:-1])
+        resp = codec.decode_response(codec.encode_response(ExchangeResponse(True, None, 15, [(True, 4), (False, 9)])))
+        self.assertEqual((resp.success, resp.request_id, resp.results), (True, 15, [(True, 4), (False, 9)]))
 
+        # Responses carry an execution report instead of the order and its trades
+        engine = MatchingEngine()
+        o1 = engine.create_order(1, 10, Side.BUY, 'FB', OrderType.LIMIT, 100)
+        o2 = engine.create_order(2, 4, Side.SELL, 'FB', OrderType.MARKET)
+        engine.handle_order(o1)
+        engine.handle_order(o2)
+        for c in [codec, PickleCodec()]:
+            resp = c.decode_response(c.encode_response(ExchangeResponse(True, o1, 7)))
+            report = resp.order
+            self.assertEqual((resp.success, resp.request_id), (True, 7))
+            self.assertEqual((report.order_id, report.trader_id, report.ticker, report.side, report.ordertype),
+                             (1, 1, 'FB', Side.BUY, OrderType.LIMIT))
+            self.assertEqual((report.quantity, report.filled, report.price, report.pnl, report.trade_count),
+                             (10, 4, 100, -400, 1))
+            self.assertEqual(report.is_fulfilled(), False)
+        resp = codec.decode_response(codec.encode_response(ExchangeResponse(False, None)))
+        self.assertEqual((resp.success, resp.order), (False, None))
+
+        # Execution reports are pushed without a request, with the report type
+        engine = MatchingEngine()
+        engine.reports = []
+        o1 = engine.create_order(1, 10, Side.BUY, 'FB', OrderType.LIMIT, 100)
+        o2 = engine.create_order(2, 4, Side.SELL, 'FB', OrderType.MARKET)
+        engine.handle_orders([(CommandType.NEW, o1), (CommandType.NEW, o2), (CommandType.AMEND, o1.order_id, 5),
+                              (CommandType.CANCEL, o1.order_id)])
+        self.assertEqual([(t, r.order_id, r.filled, r.quantity) for t, r in engine.reports],
+                         [(ReportType.FILL, o2.order_id, 4, 4), (ReportType.PARTIAL_FILL, o1.order_id, 4, 10),
+                          (ReportType.AMEND_ACK, o1.order_id, 4, 5), (ReportType.CANCEL_ACK, o1.order_id, 4, 5)])
+        for c in [codec, PickleCodec()]:
+            resp = c.decode_response(c.encode_response(ExchangeResponse(True, engine.reports[1][1], 0,
+                                                                        report_type=ReportType.PARTIAL_FILL)))
+            self.assertEqual((resp.report_type, resp.order.order_id, resp.order.pnl),
+                             (ReportType.PARTIAL_FILL, o1.order_id, -400))
+
+        # The server answers a hello with the first offered codec it allows
+        offered = WireCodec.load_hello(WireCodec.dump_hello([PickleCodec.CODEC_ID, BinaryCodec.CODEC_ID]))
+        self.assertEqual(WireCodec.choose(offered, (BinaryCodec.CODEC_ID,)), BinaryCodec.CODEC_ID)
+        self.assertEqual(WireCodec.choose([PickleCodec.CODEC_ID], (BinaryCodec.CODEC_ID,)), None)
+        with self.assertRaises(ValueError):
+            WireCodec.load_hello(b'HTTP/1.1')
 
     def test_EquityBook_bids_offers(self):
         # Test bids list sequences
@@ -85,6 +846,129 @@ class OrderInputsTest(unittest.TestCase):
         eb.handle_order(o2_s)
         self.assertEqual(eb.offers, [o2_s, o1_s])
 
+    def test_BookSide(self):
+        bs = BookSide(Side.BUY)
+        self.assertEqual(bs.top(), None)
+        self.assertEqual(bs.pop_top(), None)
+        o1 = Order(1, 1, 10, datetime.now(), Side.BUY, 'FB', OrderType.LIMIT, 100)
+        o2 = Order(2, 2, 10, datetime.now(), Side.BUY, 'FB', OrderType.LIMIT, 110)
+        o3 = Order(3, 3, 10, datetime.now(), Side.BUY, 'FB', OrderType.LIMIT, 100)
+        for o in [o1, o2, o3]:
+            bs.add(o)
+        self.assertEqual(len(bs), 3)
+        self.assertEqual(list(bs), [o2, o3, o1])
+        self.assertEqual(bs.best_level().price, 110)
+        self.assertEqual(bs.level_at(1).price, 100)
+        self.assertEqual(bs.level_at(2), None)
+
+        # Removing the last order of a level drops the level
+        self.assertEqual(bs.pop_top(), o2)
+        self.assertEqual(bs.best_level().price, 100)
+        self.assertEqual(bs.remove(o1.order_id), o1)
+        self.assertEqual(bs.remove(o1.order_id), None)
+        self.assertEqual(list(bs), [o3])
+
+        # MARKET orders have no price and rank ahead of every price level
+        o6 = Order(6, 6, 10, datetime.now(), Side.BUY, 'FB', OrderType.MARKET)
+        bs.add(o6)
+        self.assertEqual(bs.top(), o6)
+        self.assertEqual(o6.price, None)
+        self.assertEqual(bs.best_price(), 100)
+        self.assertEqual(bs.pop_top(), o6)
+
+        # Offers rank the lowest price first
+        bs = BookSide(Side.SELL)
+        o4 = Order(4, 4, 10, datetime.now(), Side.SELL, 'FB', OrderType.LIMIT, 120)
+        o5 = Order(5, 5, 10, datetime.now(), Side.SELL, 'FB', OrderType.LIMIT, 115)
+        bs.add(o4)
+        bs.add(o5)
+        self.assertEqual(bs.top(), o5)
+        self.assertEqual(list(bs), [o5, o4])
+
+    def test_BookSide_match(self):
+        bs = BookSide(Side.SELL)
+        o1 = Order(1, 1, 5, datetime.now(), Side.SELL, 'FB', OrderType.LIMIT, 101)
+        o2 = Order(2, 2, 5, datetime.now(), Side.SELL, 'FB', OrderType.LIMIT, 102)
+        o3 = Order(3, 3, 5, datetime.now(), Side.SELL, 'FB', OrderType.LIMIT, 103)
+        for o in [o1, o2, o3]:
+            bs.add(o)
+
+        # A BUY order sweeps the levels up to its price and the fills land in the buffer, which grows as needed
+        fills = [None] * 3
+        buy = Order(4, 4, 12, datetime.now(), Side.BUY, 'FB', OrderType.LIMIT, 102)
+        self.assertEqual(bs.match(buy, fills), 2)
+        self.assertEqual(fills, [o1, 5, 101, o2, 5, 102])
+        self.assertEqual(buy.filled, 10)
+        self.assertEqual(list(bs), [o3])
+
+        # An order with nothing left to trade leaves the book with a fill of 0
+        o3.quantity = 0
+        buy = Order(5, 5, 1, datetime.now(), Side.BUY, 'FB', OrderType.LIMIT, 110)
+        self.assertEqual(bs.match(buy, fills), 1)
+        self.assertEqual(fills[:3], [o3, 0, 103])
+        self.assertEqual((buy.filled, len(bs), bs.resting), (0, 0, {}))
+
+        # A partially filled order keeps its place
+        eb = EquityBook('FB')
+        for o in [Order(1, 1, 5, datetime.now(), Side.SELL, 'FB', OrderType.LIMIT, 101),
+                  Order(2, 2, 5, datetime.now(), Side.SELL, 'FB', OrderType.LIMIT, 101)]:
+            eb.handle_order(o)
+        eb.handle_order(Order(3, 3, 3, datetime.now(), Side.BUY, 'FB', OrderType.LIMIT, 101))
+        self.assertEqual(eb.fill_count, 1)
+        self.assertEqual([(o.order_id, o.filled) for o in eb.offers], [(2, 3), (1, 0)])
+        self.assertEqual(eb.offer_side.best_level().quantity, 7)
+
+    def test_EquityBook_depth(self):
+        eb = EquityBook('FB')
+        for o in [Order(1, 1, 10, datetime.now(), Side.BUY, 'FB', OrderType.LIMIT, 100),
+                  Order(2, 2, 5, datetime.now(), Side.BUY, 'FB', OrderType.LIMIT, 100),
+                  Order(3, 3, 7, datetime.now(), Side.BUY, 'FB', OrderType.LIMIT, 99),
+                  Order(4, 4, 4, datetime.now(), Side.SELL, 'FB', OrderType.LIMIT, 102),
+                  Order(5, 5, 6, datetime.now(), Side.SELL, 'FB', OrderType.LIMIT, 104)]:
+            eb.handle_order(o)
+        self.assertEqual(eb.depth(5), ([(100, 15, 2), (99, 7, 1)], [(102, 4, 1), (104, 6, 1)]))
+        self.assertEqual(eb.depth(1), ([(100, 15, 2)], [(102, 4, 1)]))
+        self.assertEqual(eb.liquidity_up_to(Side.BUY, 100), (15, 2))
+        self.assertEqual(eb.liquidity_up_to(Side.BUY, 90), (22, 3))
+        self.assertEqual(eb.liquidity_up_to(Side.SELL, 103), (4, 1))
+        self.assertEqual(eb.liquidity_up_to(Side.SELL, 101), (0, 0))
+
+        # The totals follow fills, amends and cancels, and count the resting MARKET orders
+        eb.handle_order(Order(6, 6, 3, datetime.now(), Side.SELL, 'FB', OrderType.LIMIT, 100))
+        eb.amend_order(3, 2)
+        eb.cancel_order(4)
+        eb.handle_order(Order(7, 7, 8, datetime.now(), Side.SELL, 'FB', OrderType.MARKET))
+        self.assertEqual(eb.depth(5), ([(100, 4, 1), (99, 2, 1)], [(104, 6, 1)]))
+        self.assertEqual(eb.liquidity_up_to(Side.BUY), (6, 2))
+        eb.handle_order(Order(8, 8, 20, datetime.now(), Side.SELL, 'FB', OrderType.MARKET))
+        self.assertEqual(eb.depth(5), ([], [(104, 6, 1)]))
+        self.assertEqual(eb.liquidity_up_to(Side.BUY), (0, 0))
+        self.assertEqual(eb.liquidity_up_to(Side.SELL, 103), (14, 1))
+        self.assertEqual(eb.liquidity_up_to(Side.SELL), (20, 2))
+
+    def test_EquityBook_resting_index(self):
+        eb = EquityBook('FB')
+        o1_b = Order(1, 1, 10, datetime.now(), Side.BUY, 'FB', OrderType.LIMIT, 100)
+        o2_b = Order(2, 2, 5, datetime.now(), Side.BUY, 'FB', OrderType.LIMIT, 110)
+        eb.handle_order(o1_b)
+        eb.handle_order(o2_b)
+        self.assertEqual(set(eb.resting), {1, 2})
+        self.assertEqual(eb.resting[1][0], eb.bid_side)
+        self.assertEqual(eb.resting[1][1].price, 100)
+
+        # A filled order leaves the index and can no longer be amended or cancelled
+        eb.handle_order(Order(3, 3, 7, datetime.now(), Side.SELL, 'FB', OrderType.LIMIT, 100))
+        self.assertEqual(set(eb.resting), {1})
+        self.assertEqual(eb.amend_order(2, 1), False)
+        self.assertEqual(eb.cancel_order(2), False)
+
+        # A partially filled order is amended and cancelled through the index
+        self.assertEqual(o1_b.filled, 2)
+        self.assertEqual(eb.amend_order(1, 4), True)
+        self.assertEqual(eb.cancel_order(1), True)
+        self.assertEqual(eb.resting, {})
+        self.assertEqual(eb.bids, [])
+
     def test_Constants_Amend_Cancel_Order(self):
         eb = EquityBook('FB')
         self.assertEqual(eb.ticker, 'FB')
@@ -309,37 +1193,99 @@ class OrderInputsTest(unittest.TestCase):
         self.assertEqual(eb.trader_orders, {1: 1, 2: 2, 3: 3, 4: 4, 5: 5})
         self.assertEqual(eb.trades, {1: [], 2: [], 3: [], 4: [], 5: []})
 
-        # Submit an IOC SELL Order that has greater quantity than the highest BUY order
+        # Submit an IOC SELL Order that sweeps the two highest BUY orders
         result = eb.handle_order(Order(6, 6, 17, datetime.now(), Side.SELL, 'FB', OrderType.IOC, 80))
         trades, orders, trader_orders, handled_order, pnl = result
         self.assertEqual(trader_orders, {1: 1, 3: 3, 4: 4, 5: 5})
-        self.assertEqual(trades, {1: [], 2: [(6, -960.0)], 3: [], 4: [], 5: [], 6: [(2, 960.0)]})
-        self.assertEqual(pnl, 960)
+        self.assertEqual(trades, {1: [(6, -900)], 2: [(6, -960)], 3: [], 4: [], 5: [], 6: [(2, 960), (1, 900)]})
+        self.assertEqual(pnl, 1860)
+        self.assertEqual((handled_order.filled, handled_order.is_executed), (17, True))
 
-        # Submit an IOC SELL Order that has lower quantity than the highest BUY order
+        # Submit an IOC SELL Order that fills the rest of the highest BUY order
         result = eb.handle_order(Order(7, 7, 1, datetime.now(), Side.SELL, 'FB', OrderType.IOC, 80))
         trades, orders, trader_orders, handled_order, pnl = result
-
-        self.assertEqual(trader_orders, {1: 1, 3: 3, 4: 4, 5: 5})
-        self.assertEqual(trades, {1: [(7, -100.0)], 2: [(6, -960.0)], 3: [], 4: [], 5: [], 6: [(2, 960.0)], 7: [(1, 100.0)]})
+        self.assertEqual(trader_orders, {3: 3, 4: 4, 5: 5})
+        self.assertEqual(trades[1], [(6, -900), (7, -100)])
+        self.assertEqual(trades[7], [(1, 100)])
         self.assertEqual(pnl, 100)
 
-
-        # Submit an outstanding IOC BUY order
+        # Submit an IOC BUY order that cannot trade. It is cancelled rather than left on the book.
         result = eb.handle_order(Order(8, 8, 20, datetime.now(), Side.BUY, 'FB', OrderType.IOC, 105))
         trades, orders, trader_orders, handled_order, pnl = result
-        self.assertEqual(trader_orders, {1: 1, 3: 3, 4: 4, 5: 5, 8: 8})
-        self.assertEqual(trades, {1: [(7, -100.0)], 2: [(6, -960.0)], 3: [], 4: [], 5: [], 6: [(2, 960.0)], 7: [(1, 100.0)], 8: []})
+        self.assertEqual(trader_orders, {3: 3, 4: 4, 5: 5})
+        self.assertEqual(trades[8], [])
         self.assertEqual(pnl, 0)
+        self.assertEqual(handled_order.is_executed, False)
+        self.assertEqual(eb.bids, [o3_b])
 
-        # Submit an IOC SELL order to execute the IOC BUY order
-        result = eb.handle_order(Order(9, 9, 5, datetime.now(), Side.SELL, 'FB', OrderType.IOC, 90))
+        # Submit an IOC BUY order larger than the offers up to its price. The remaining quantity is cancelled.
+        result = eb.handle_order(Order(9, 9, 4, datetime.now(), Side.BUY, 'FB', OrderType.IOC, 125))
         trades, orders, trader_orders, handled_order, pnl = result
+        self.assertEqual(trader_orders, {3: 3, 5: 5})
+        self.assertEqual(trades[9], [(4, -375)])
+        self.assertEqual(pnl, -375)
+        self.assertEqual((handled_order.filled, handled_order.is_executed), (3, True))
+        self.assertEqual(eb.bids, [o3_b])
+        self.assertEqual(eb.offers, [o2_s])
 
-        self.assertEqual(trader_orders, {1: 1, 3: 3, 4: 4, 5: 5})
-        self.assertEqual(trades,{1: [(7, -100.0)], 2: [(6, -960.0)], 3: [], 4: [], 5: [], 6: [(2, 960.0)], 7: [(1, 100.0)], 8: [(9, -525.0)], 9: [(8, 525.0)]})
-        self.assertEqual(pnl, 525)
+    def test_FOK_Order(self):
+        eb = EquityBook('FB')
+        o1_s = Order(1, 1, 3, datetime.now(), Side.SELL, 'FB', OrderType.LIMIT, 101)
+        o2_s = Order(2, 2, 2, datetime.now(), Side.SELL, 'FB', OrderType.LIMIT, 102)
+        o3_s = Order(3, 3, 4, datetime.now(), Side.SELL, 'FB', OrderType.LIMIT, 103)
+        for o in [o1_s, o2_s, o3_s]:
+            eb.handle_order(o)
+
+        # The offers up to the price of the FOK order hold 5, so an order of 6 is killed without trading
+        self.assertEqual(eb.offer_side.fillable(Order(4, 4, 6, datetime.now(), Side.BUY, 'FB', OrderType.FOK, 102)),
+                         False)
+        result = eb.handle_order(Order(4, 4, 6, datetime.now(), Side.BUY, 'FB', OrderType.FOK, 102))
+        trades, orders, trader_orders, handled_order, pnl = result
+        self.assertEqual((handled_order.filled, handled_order.is_executed, pnl), (0, False, 0))
+        self.assertEqual(trader_orders, {1: 1, 2: 2, 3: 3})
+        self.assertEqual(eb.offers, [o1_s, o2_s, o3_s])
+        self.assertEqual(eb.bids, [])
 
+        # A FOK order the offers can fill sweeps them in one pass
+        result = eb.handle_order(Order(5, 5, 6, datetime.now(), Side.BUY, 'FB', OrderType.FOK, 103))
+        trades, orders, trader_orders, handled_order, pnl = result
+        self.assertEqual((handled_order.filled, handled_order.is_executed, pnl), (6, True, -610))
+        self.assertEqual(trades[5], [(1, -303), (2, -204), (3, -103)])
+        self.assertEqual(trader_orders, {3: 3})
+        self.assertEqual(eb.offers, [o3_s])
+
+        # Resting MARKET orders count at the price of the FOK order
+        eb.handle_order(Order(6, 6, 2, datetime.now(), Side.SELL, 'FB', OrderType.MARKET))
+        self.assertEqual(eb.offer_side.fillable(Order(7, 7, 5, datetime.now(), Side.BUY, 'FB', OrderType.FOK, 103)),
+                         True)
+        self.assertEqual(eb.offer_side.fillable(Order(7, 7, 5, datetime.now(), Side.BUY, 'FB', OrderType.FOK, 102)),
+                         False)
+
+        # The engine releases the trader of a killed order
+        engine = MatchingEngine()
+        self.assertEqual(engine.handle_order(Order(1, 8, 1, datetime.now(), Side.SELL, 'FB', OrderType.FOK, 100)),
+                         False)
+        self.assertEqual(engine.trader_orders, {})
+        self.assertEqual(engine.handle_order(Order(1, 9, 1, datetime.now(), Side.SELL, 'FB', OrderType.LIMIT, 100)),
+                         False)
+        self.assertEqual(engine.handle_order(Order(2, 10, 1, datetime.now(), Side.BUY, 'FB', OrderType.FOK, 100)), True)
+        self.assertEqual(engine.trader_orders, {})
+
+        # IOC and FOK orders that are not filled end with an EXPIRED report of their filled quantity
+        engine = MatchingEngine()
+        engine.reports = []
+        ioc = engine.create_order(1, 5, Side.BUY, 'FB', OrderType.IOC, 100)
+        engine.handle_order(ioc)
+        engine.handle_order(engine.create_order(2, 3, Side.SELL, 'FB', OrderType.LIMIT, 100))
+        partial = engine.create_order(3, 5, Side.BUY, 'FB', OrderType.IOC, 100)
+        engine.handle_order(partial)
+        engine.handle_order(engine.create_order(2, 3, Side.SELL, 'FB', OrderType.LIMIT, 101))
+        fok = engine.create_order(4, 5, Side.BUY, 'FB', OrderType.FOK, 101)
+        engine.handle_order(fok)
+        self.assertEqual([(t, r.order_id, r.filled) for t, r in engine.reports],
+                         [(ReportType.EXPIRED, ioc.order_id, 0), (ReportType.PARTIAL_FILL, partial.order_id, 3),
+                          (ReportType.FILL, 2, 3), (ReportType.EXPIRED, partial.order_id, 3),
+                          (ReportType.EXPIRED, fok.order_id, 0)])
 
     def test_Matching_Engine(self):
         # Test initialized constants
@@ -349,8 +1295,8 @@ class OrderInputsTest(unittest.TestCase):
         self.assertEqual(engine.trader_orders, {})
         self.assertEqual(engine.order_history, {})
 
-        # Send IOC order
-        o1 = Order(1, 1, 20, datetime.now(), Side.BUY, 'GOOG', OrderType.IOC, 105)
+        # Send LIMIT order
+        o1 = Order(1, 1, 2, datetime.now(), Side.BUY, 'GOOG', OrderType.LIMIT, 105)
         result = engine.handle_order(o1)
         self.assertEqual(result, o1.is_fulfilled())
         self.assertEqual(len(engine.books), 1)
@@ -428,5 +1374,14 @@ class OrderInputsTest(unittest.TestCase):
         self.assertEqual(engine.trader_orders, {2: 8, 4: 5})
         self.assertEqual(engine.order_tickers, {1: 'GOOG', 3: 'GOOG', 4: 'FB', 5: 'FB', 7: 'NVDA', 8: 'NVDA', 9: 'NVDA'})
 
+        # Test a batch of commands handled in sequence order
+        o10 = Order(6, 10, 4, datetime.now(), Side.BUY, 'FB', OrderType.LIMIT, 110)
+        o11 = Order(4, 11, 1, datetime.now(), Side.BUY, 'FB', OrderType.LIMIT, 90)
+        result = engine.handle_orders([(CommandType.AMEND, 5, 4), (CommandType.NEW, o10), (CommandType.NEW, o11),
+                                       (CommandType.CANCEL, 8)])
+        self.assertEqual(result, [True, True, False, True])
+        self.assertEqual(o10.trades, [(5, -440)])
+        self.assertEqual(engine.trader_orders, {4: 11})
+
 if __name__ == '__main__':
     unittest.main()
\ No newline at end of file
@@ -0,0 +1,332 @@
+import struct
+
+from ExchangeRequest import ExchangeRequest, ExchangeRequestType
+from ExchangeResponse import ExchangeResponse
+from ExecutionReport import ExecutionReport, ReportType
+from LatencyStats import LatencyStats
+from Order import Order
+from OrderType import OrderType
+from Side import Side
+
+
+class PickleCodec:
+    """ Legacy codec sending base64 pickled objects. Only use it between trusted peers.
+    """
+    CODEC_ID = 1
+
+    def encode_request(self, request):
+        return request.dump()
+
+    def decode_request(self, data):
+        return ExchangeRequest.load(data)
+
+    def encode_response(self, response):
+        return response.dump()
+
+    def decode_response(self, data):
+        response = ExchangeResponse.load(data)
+        # Clients always see execution reports, whichever codec the session uses
+        if isinstance(response.order, Order):
+            response.order = ExecutionReport.from_order(response.order)
+        return response
+
+
+class BinaryCodec:
+    """ Fixed-layout binary codec. Every message starts with a header of the codec version, the message type and the
+    request id, followed by the fields of the message type in network byte order.
+    """
+    CODEC_ID = 2
+    VERSION = 1
+    RESPONSE = 0x80 # Message type of responses
+    BATCH_RESPONSE = 0x81 # Message type of the responses of SUBMIT_BATCH and CANCEL_ALL requests
+    EXECUTION_REPORT = 0x82 # Message type of the execution reports pushed without a request
+    STATS_RESPONSE = 0x83 # Message type of the responses of STATS requests
+
+    HEADER = struct.Struct('!BBQ') # version, message type, request id
+    SUBMIT = struct.Struct('!qBBqqB') # trader id, order type, side, quantity, price, has price
+    ORDER_REF = struct.Struct('!qq') # trader id, order id
+    TRADER = struct.Struct('!q') # trader id, followed by a ticker, empty for every ticker, in CANCEL_ALL requests
+    AMEND = struct.Struct('!qqqqBB') # trader id, order id, quantity, price, has quantity, has price
+    RESPONSE_HEAD = struct.Struct('!BB') # success, has report
+    REPORT = struct.Struct('!qqBBqqqBBqqI') # order id, trader id, side, order type, quantity, filled, price,
+                                            # has price, is executed, timestamp, pnl, trade count
+    TEXT = struct.Struct('!B') # length of a short UTF-8 string
+    COUNT = struct.Struct('!I') # number of commands or results of a batch
+    ENTRY = struct.Struct('!B') # request type of a command of a batch
+    RESULT = struct.Struct('!Bq') # success, order id
+    REPORT_TYPE = struct.Struct('!B') # report type of a pushed execution report
+    ELAPSED = struct.Struct('!d') # seconds the statistics cover
+    LATENCY = struct.Struct('!BBQdqqqq') # stage index, request type, count, mean, p50, p99, p999, max
+    THROUGHPUT = struct.Struct('!Qd') # requests and requests per second of a ticker
+
+    def encode_request(self, request):
+        """ Serialize an ExchangeRequest to bytes
+        """
+        request_type = request.request_type
+        header = self.HEADER.pack(self.VERSION, request_type.value, request.request_id or 0)
+        if request_type is ExchangeRequestType.SUBMIT_BATCH:
+            # The count of commands, then each command as its type followed by the fields of a single request
+            parts = [header, self.COUNT.pack(len(request.commands))]
+            for command in request.commands:
+                parts.append(self.ENTRY.pack(command.request_type.value))
+                parts.append(self.__encode_body(command))
+            return b''.join(parts)
+        return header + self.__encode_body(request)
+
+    def __encode_body(self, request):
+        """ Serialize the fields of a single request
+        """
+        request_type = request.request_type
+        if request_type is ExchangeRequestType.SUBMIT:
+            price = request.price
+            body = self.SUBMIT.pack(request.trader_id, self.__order_type(request.order_type).value,
+                                    self.__side(request.order_side).value, request.quantity,
+                                    price if price is not None else 0, price is not None)
+            return body + self.__text(request.ticker)
+        elif request_type is ExchangeRequestType.AMEND:
+            quantity, price = request.quantity, request.price
+            return self.AMEND.pack(request.trader_id, request.order_id,
+                                   quantity if quantity is not None else 0,
+                                   price if price is not None else 0,
+                                   quantity is not None, price is not None)
+        elif request_type is ExchangeRequestType.CANCEL or request_type is ExchangeRequestType.GET:
+            return self.ORDER_REF.pack(request.trader_id, request.order_id)
+        elif request_type is ExchangeRequestType.STATS:
+            return self.ORDER_REF.pack(request.trader_id, 0)
+        elif request_type is ExchangeRequestType.CANCEL_ALL:
+            return self.TRADER.pack(request.trader_id) + self.__text(request.ticker or '')
+        raise ValueError("Unsupported request type: " + str(request_type))
+
+    def decode_request(self, data):
+        """ Deserialize an ExchangeRequest from bytes
+        """
+        try:
+            view = memoryview(data)
+            version, message_type, request_id = self.HEADER.unpack_from(view)
+            if version != self.VERSION:
+                raise ValueError("Unsupported codec version: %d" % version)
+            offset = self.HEADER.size
+            request_type = ExchangeRequestType(message_type)
+            if request_type is ExchangeRequestType.SUBMIT_BATCH:
+                (count,) = self.COUNT.unpack_from(view, offset)
+                offset += self.COUNT.size
+                commands = []
+                for i in range(count):
+                    (entry_type,) = self.ENTRY.unpack_from(view, offset)
+                    entry_type = ExchangeRequestType(entry_type)
+                    if entry_type is ExchangeRequestType.SUBMIT_BATCH:
+                        raise ValueError("Nested batch request")
+                    command, offset = self.__decode_body(entry_type, view, offset + self.ENTRY.size, None)
+                    commands.append(command)
+                return ExchangeRequest(request_type, commands[0].trader_id if commands else 0, commands=commands,
+                                       request_id=request_id)
+            return self.__decode_body(request_type, view, offset, request_id)[0]
+        except struct.error as e:
+            raise ValueError("Truncated request: " + str(e))
+
+    def __decode_body(self, request_type, view, offset, request_id):
+        """ Deserialize the fields of a single request
+
+        :return: The ExchangeRequest and the offset following its fields
+        """
+        if request_type is ExchangeRequestType.SUBMIT:
+            trader_id, order_type, side, quantity, price, has_price = self.SUBMIT.unpack_from(view, offset)
+            ticker, offset = self.__read_text(view, offset + self.SUBMIT.size)
+            request = ExchangeRequest(request_type, trader_id, order_type=OrderType(order_type),
+                                      order_side=Side(side), ticker=ticker, quantity=quantity,
+                                      price=price if has_price else None, request_id=request_id)
+        elif request_type is ExchangeRequestType.AMEND:
+            trader_id, order_id, quantity, price, has_quantity, has_price = self.AMEND.unpack_from(view, offset)
+            request = ExchangeRequest(request_type, trader_id, order_id=order_id,
+                                      quantity=quantity if has_quantity else None,
+                                      price=price if has_price else None, request_id=request_id)
+            offset += self.AMEND.size
+        elif request_type is ExchangeRequestType.CANCEL_ALL:
+            (trader_id,) = self.TRADER.unpack_from(view, offset)
+            ticker, offset = self.__read_text(view, offset + self.TRADER.size)
+            request = ExchangeRequest(request_type, trader_id, ticker=ticker or None, request_id=request_id)
+        else:
+            trader_id, order_id = self.ORDER_REF.unpack_from(view, offset)
+            request = ExchangeRequest(request_type, trader_id,
+                                      order_id=order_id if request_type is not ExchangeRequestType.STATS else None,
+                                      request_id=request_id)
+            offset += self.ORDER_REF.size
+        return request, offset
+
+    def encode_response(self, response):
+        """ Serialize an ExchangeResponse to bytes. An Order is sent as its ExecutionReport.
+        """
+        if response.stats is not None:
+            header = self.HEADER.pack(self.VERSION, self.STATS_RESPONSE, response.request_id or 0)
+            return header + self.RESPONSE_HEAD.pack(bool(response.success), False) + self.__encode_stats(response.stats)
+        if response.results is not None:
+            header = self.HEADER.pack(self.VERSION, self.BATCH_RESPONSE, response.request_id or 0)
+            return b''.join([header, self.RESPONSE_HEAD.pack(bool(response.success), False),
+                             self.COUNT.pack(len(response.results))] +
+                            [self.RESULT.pack(bool(success), order_id or 0) for success, order_id in response.results])
+        if response.report_type is not None:
+            header = self.HEADER.pack(self.VERSION, self.EXECUTION_REPORT, response.request_id or 0)
+            return header + self.REPORT_TYPE.pack(response.report_type.value) + self.__encode_report(response.order)
+        header = self.HEADER.pack(self.VERSION, self.RESPONSE, response.request_id or 0)
+        report = response.order
+        if report is None:
+            return header + self.RESPONSE_HEAD.pack(bool(response.success), False)
+        return header + self.RESPONSE_HEAD.pack(bool(response.success), True) + self.__encode_report(report)
+
+    def __encode_report(self, report):
+        """ Serialize the ExecutionReport of a response, or of an Order
+        """
+        if isinstance(report, Order):
+            report = ExecutionReport.from_order(report)
+        price = report.price
+        return (self.REPORT.pack(report.order_id, report.trader_id, report.side.value, report.ordertype.value,
+                                 report.quantity, report.filled, price if price is not None else 0,
+                                 price is not None, report.is_executed, report.timestamp, report.pnl,
+                                 report.trade_count) +
+                self.__text(report.ticker))
+
+    def __encode_stats(self, stats):
+        """ Serialize the LatencyStats.report() of a STATS response
+        """
+        parts = [self.ELAPSED.pack(stats['elapsed']), self.COUNT.pack(len(stats['latency']))]
+        for (stage, request_type), summary in stats['latency'].items():
+            parts.append(self.LATENCY.pack(LatencyStats.STAGES.index(stage), request_type.value, summary['count'],
+                                           summary['mean'], summary['p50'], summary['p99'], summary['p999'],
+                                           summary['max']))
+        parts.append(self.COUNT.pack(len(stats['tickers'])))
+        for ticker, throughput in stats['tickers'].items():
+            parts.append(self.__text(ticker))
+            parts.append(self.THROUGHPUT.pack(throughput['requests'], throughput['per_second']))
+        return b''.join(parts)
+
+    def __decode_stats(self, view, offset):
+        """ Deserialize the LatencyStats.report() of a STATS response
+        """
+        (elapsed,) = self.ELAPSED.unpack_from(view, offset)
+        offset += self.ELAPSED.size
+        (count,) = self.COUNT.unpack_from(view, offset)
+        offset += self.COUNT.size
+        latency = {}
+        for i in range(count):
+            stage, request_type, values, mean, p50, p99, p999, maximum = self.LATENCY.unpack_from(view, offset)
+            offset += self.LATENCY.size
+            latency[(LatencyStats.STAGES[stage], ExchangeRequestType(request_type))] = {
+                'count': values, 'mean': mean, 'p50': p50, 'p99': p99, 'p999': p999, 'max': maximum}
+        (count,) = self.COUNT.unpack_from(view, offset)
+        offset += self.COUNT.size
+        tickers = {}
+        for i in range(count):
+            ticker, offset = self.__read_text(view, offset)
+            requests, per_second = self.THROUGHPUT.unpack_from(view, offset)
+            offset += self.THROUGHPUT.size
+            tickers[ticker] = {'requests': requests, 'per_second': per_second}
+        return {'elapsed': elapsed, 'latency': latency, 'tickers': tickers}
+
+    def decode_response(self, data):
+        """ Deserialize an ExchangeResponse from bytes
+        """
+        try:
+            view = memoryview(data)
+            version, message_type, request_id = self.HEADER.unpack_from(view)
+            if version != self.VERSION or message_type not in (self.RESPONSE, self.BATCH_RESPONSE,
+                                                               self.EXECUTION_REPORT, self.STATS_RESPONSE):
+                raise ValueError("Unsupported response version or type: %d/%d" % (version, message_type))
+            offset = self.HEADER.size
+            if message_type == self.EXECUTION_REPORT:
+                (report_type,) = self.REPORT_TYPE.unpack_from(view, offset)
+                report = self.__decode_report(view, offset + self.REPORT_TYPE.size)
+                return ExchangeResponse(True, report, request_id, report_type=ReportType(report_type))
+            success, has_report = self.RESPONSE_HEAD.unpack_from(view, offset)
+            offset += self.RESPONSE_HEAD.size
+            if message_type == self.STATS_RESPONSE:
+                return ExchangeResponse(bool(success), None, request_id, stats=self.__decode_stats(view, offset))
+            if message_type == self.BATCH_RESPONSE:
+                (count,) = self.COUNT.unpack_from(view, offset)
+                offset += self.COUNT.size
+                results = []
+                for i in range(count):
+                    result_success, order_id = self.RESULT.unpack_from(view, offset)
+                    # Order ids start at 1, and 0 stands for the missing id of a rejected order
+                    results.append((bool(result_success), order_id or None))
+                    offset += self.RESULT.size
+                return ExchangeResponse(bool(success), None, request_id, results)
+            report = self.__decode_report(view, offset) if has_report else None
+            return ExchangeResponse(bool(success), report, request_id)
+        except struct.error as e:
+            raise ValueError("Truncated response: " + str(e))
+
+    def __decode_report(self, view, offset):
+        """ Deserialize the ExecutionReport of a response
+        """
+        (order_id, trader_id, side, order_type, quantity, filled, price, has_price, is_executed, timestamp,
+         pnl, trade_count) = self.REPORT.unpack_from(view, offset)
+        ticker, offset = self.__read_text(view, offset + self.REPORT.size)
+        return ExecutionReport(order_id, trader_id, ticker, Side(side), OrderType(order_type), quantity, filled,
+                               price if has_price else None, bool(is_executed), timestamp, pnl, trade_count)
+
+
+    @staticmethod
+    def __order_type(value):
+        return value if isinstance(value, OrderType) else OrderType.from_str(value)
+
+    @staticmethod
+    def __side(value):
+        return value if isinstance(value, Side) else Side.from_str(value)
+
+    def __text(self, value):
+        data = str(value).encode('utf-8')
+        return self.TEXT.pack(len(data)) + data
+
+    def __read_text(self, view, offset):
+        (length,) = self.TEXT.unpack_from(view, offset)
+        offset += self.TEXT.size
+        if offset + length > len(view):
+            raise ValueError("Truncated text field")
+        return str(view[offset:offset + length], 'utf-8'), offset + length
+
+
+class WireCodec:
+    """ Registry of the codecs and the hello messages the client and the server use to agree on one of them.
+    The client lists the codecs it supports in its preferred order and the server answers with the first one it allows.
+    """
+    MAGIC = b'MEXH'
+    PROTOCOL_VERSION = 1
+    HELLO = struct.Struct('!4sBB') # magic, protocol version, number of codec ids that follow
+    CODECS = {PickleCodec.CODEC_ID: PickleCodec, BinaryCodec.CODEC_ID: BinaryCodec}
+
+    @classmethod
+    def get(cls, codec_id):
+        """ Create the codec with an id
+        """
+        return cls.CODECS[codec_id]()
+
+    @classmethod
+    def dump_hello(cls, codec_ids):
+        """ Serialize a hello message listing codec ids
+        """
+        return cls.HELLO.pack(cls.MAGIC, cls.PROTOCOL_VERSION, len(codec_ids)) + bytes(codec_ids)
+
+    @classmethod
+    def load_hello(cls, data):
+        """ Deserialize a hello message
+
+        :return: The list of codec ids
+        """
+        try:
+            magic, version, count = cls.HELLO.unpack_from(data)
+        except struct.error:
+            raise ValueError("Invalid hello message")
+        if magic != cls.MAGIC or version != cls.PROTOCOL_VERSION or len(data) != cls.HELLO.size + count:
+            raise ValueError("Invalid hello message")
+        return list(data[cls.HELLO.size:])
+
+    @classmethod
+    def choose(cls, offered, allowed):
+        """ Choose the first offered codec id that is allowed
+
+        :return: The chosen codec id, or None if there is none in common
+        """
+        for codec_id in offered:
+            if codec_id in allowed and codec_id in cls.CODECS:
+                return codec_id
+        return None